@@ -0,0 +1,124 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.db.models import Prefetch
+from django.test import RequestFactory
+from django.urls import resolve
+from rest_framework.response import Response
+from wagtail.api.v2.views import PagesAPIViewSet
+
+from blog.conditional import add_cache_headers, latest, make_etag, not_modified
+from blog.models import BlogPage, BlogPageGalleryImage, related_links_prefetch
+from blog.page_cache import PAGES_DEPENDENCY, current_versions, page_dependency, purge, version_time
+from blog.stale_cache import get_or_compute
+
+
+def with_api_relations(queryset):
+    """
+    Loads everything the BlogPage api_fields touch in a fixed number of
+    queries, rather than a handful per page.
+    """
+    return queryset.select_related('author', 'locale').prefetch_related(
+        'categories',
+        'references',
+        Prefetch(
+            'gallery_images',
+            queryset=BlogPageGalleryImage.objects.select_related('image').prefetch_related('image__renditions'),
+        ),
+        related_links_prefetch(),
+    )
+
+
+def refresh_api_payloads(queryset):
+    """
+    Rebuilds the stored api_payload of every page in the queryset, and
+    purges the cached responses that show it.
+    """
+    pages = list(with_api_relations(queryset))
+    for page in pages:
+        page.api_payload = page.build_api_payload()
+    BlogPage.objects.bulk_update(pages, ['api_payload'], batch_size=500)
+    if pages:
+        purge(PAGES_DEPENDENCY, *[page_dependency(page.pk) for page in pages])
+    return len(pages)
+
+
+def compute_listing(path, host, secure):
+    """
+    Runs the pages API listing at path on a request of its own: listings are
+    also recomputed in a background thread, after the request that found
+    them stale has been answered.
+    """
+    version = current_versions([PAGES_DEPENDENCY])[PAGES_DEPENDENCY]
+    request = RequestFactory().get(path, HTTP_HOST=host, secure=secure)
+    request.computing_listing = True
+    match = request.resolver_match = resolve(request.path_info)
+    response = match.func(request, *match.args, **match.kwargs)
+    return {
+        'data': dict(response.data),
+        'status': response.status_code,
+        'version': version,
+        'etag': make_etag(path, version),
+        'last_modified': version_time(version),
+    }
+
+
+class BlogPagesAPIViewSet(PagesAPIViewSet):
+    """
+    PagesAPIViewSet that serves BlogPages from their stored api_payload, so
+    listing ?type=blog.BlogPage does not touch the related tables.
+
+    Responses carry ETag and Last-Modified validators from the page cache
+    dependency versions, checked before anything is serialized. Listings are
+    cached with stale-while-revalidate (see blog/stale_cache.py).
+    """
+
+    def listing_view(self, request):
+        if getattr(request, 'computing_listing', False):
+            return super().listing_view(request)
+
+        # Any published change may alter any listing
+        version = current_versions([PAGES_DEPENDENCY])[PAGES_DEPENDENCY]
+        etag = make_etag(request.get_full_path(), version)
+        last_modified = version_time(version)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return add_cache_headers(response, etag, last_modified, [PAGES_DEPENDENCY])
+
+        hard_ttl = getattr(settings, 'API_LISTING_CACHE_HARD_TTL', 3600)
+        if not hard_ttl:
+            return add_cache_headers(super().listing_view(request), etag, last_modified, [PAGES_DEPENDENCY])
+
+        # Listings are served stale while one worker recomputes them, and the
+        # validators are those of the listing actually served.
+        listing = get_or_compute(
+            'pages-listing:' + hashlib.md5(request.get_full_path().encode()).hexdigest(),
+            functools.partial(compute_listing, request.get_full_path(), request.get_host(), request.is_secure()),
+            soft_ttl=getattr(settings, 'API_LISTING_CACHE_SOFT_TTL', 60),
+            hard_ttl=hard_ttl,
+            lock_timeout=getattr(settings, 'API_LISTING_CACHE_LOCK_TIMEOUT', 30),
+            is_current=lambda listing: listing['version'] == current_versions([PAGES_DEPENDENCY])[PAGES_DEPENDENCY],
+        )
+        response = not_modified(request, listing['etag'], listing['last_modified'])
+        if response is None:
+            response = Response(listing['data'], status=listing['status'])
+        return add_cache_headers(response, listing['etag'], listing['last_modified'], [PAGES_DEPENDENCY])
+
+    def detail_view(self, request, pk):
+        instance = self.get_object()
+        dependency = page_dependency(instance.pk)
+        version = current_versions([dependency])[dependency]
+        # ?fields= and the like change the representation, so they are part of the ETag
+        etag = make_etag(request.get_full_path(), instance.last_published_at, version)
+        last_modified = latest(instance.last_published_at, version_time(version))
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(self.get_serializer(instance).data)
+        return add_cache_headers(response, etag, last_modified, [dependency])
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if issubclass(queryset.model, BlogPage):
+            queryset = queryset.select_related('locale')
+        return queryset
@@ -0,0 +1,60 @@
+"""
+Cache operations that have to be atomic across processes.
+
+Redis carries out add() and incr() atomically, but FileBasedCache, the
+default without REDIS_URL, reads the entry and then writes it, so two
+gunicorn workers can both add the same key or lose an increment. Its
+entries are on local disk, shared only by the processes of one machine, so
+for it each operation here holds an exclusive flock on a file beside them.
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.filebased import FileBasedCache
+
+LOCK_FILE = 'atomic.lock'
+
+
+@contextmanager
+def exclusive():
+    backend = caches['default']
+    if not isinstance(backend, FileBasedCache):
+        yield
+        return
+    os.makedirs(backend._dir, exist_ok=True)
+    with open(os.path.join(backend._dir, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def add(key, value, timeout):
+    """cache.add(), which only one caller can win."""
+    with exclusive():
+        return cache.add(key, value, timeout)
+
+
+def delete_if(key, value):
+    """Deletes key if it still holds value, as a lock's owner does to release it."""
+    with exclusive():
+        if cache.get(key) == value:
+            cache.delete(key)
+
+
+def increment(key, timeout):
+    """
+    Adds one to the count at key and returns it, starting a count that
+    expires after timeout seconds if there is none.
+    """
+    with exclusive():
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, timeout)
+            return 1
@@ -0,0 +1,225 @@
+"""
+In-memory prefix index for search autocomplete.
+
+Every word of a live BlogPage title, tag or category name starts a key in a
+sorted list, so a prefix lookup is two bisections. Suggestions are ranked by
+how often their text has been searched for (Wagtail's search hit counts),
+then by kind and text. The top results per prefix are memoized until a
+suggestion starting with that prefix changes, and single-character prefixes,
+which match the most keys, are computed when the index is built.
+
+Each process builds its own index. Publishing updates the publishing
+process's index in place; other processes see the content version move and
+rebuild theirs in the background, answering from the old one meanwhile.
+They also rebuild every AUTOCOMPLETE_REFRESH_INTERVAL seconds to pick up new
+hit counts.
+"""
+import bisect
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from taggit.models import Tag
+from wagtail.search.models import Query
+from wagtail.search.utils import normalise_query_string
+
+from blog.models import BlogCategory, BlogPage
+from blog.page_cache import PAGES_DEPENDENCY, current_versions
+from blog.stale_cache import get_executor
+
+# Ties in hits go to categories, then tags, then posts
+KIND_RANK = {'category': 0, 'tag': 1, 'page': 2}
+
+MAX_MEMOIZED = 10000
+
+# Results memoized per prefix; requests may ask for fewer
+MAX_LIMIT = 20
+
+
+def content_version():
+    return current_versions([PAGES_DEPENDENCY])[PAGES_DEPENDENCY]
+
+
+def word_keys(text):
+    """
+    Returns the normalized text from each of its words onwards.
+    """
+    words = normalise_query_string(text).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class PrefixIndex:
+
+    def __init__(self, hits=None):
+        self.keys = []  # sorted (key, entry id) pairs
+        self.entries = {}  # entry id -> suggestion
+        self.hits = hits or {}
+        self.memo = {}
+
+    def add(self, entry_id, text, **data):
+        self.remove(entry_id)
+        keys = word_keys(text)
+        if not keys:
+            return
+        suggestion = {'text': text, 'type': entry_id[0], **data}
+        weight = self.hits.get(keys[0], 0)
+        self.entries[entry_id] = (suggestion, keys, (-weight, KIND_RANK[entry_id[0]], keys[0]))
+        for key in keys:
+            bisect.insort(self.keys, (key, entry_id))
+        self.forget(keys)
+
+    def remove(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            i = bisect.bisect_left(self.keys, (key, entry_id))
+            if i < len(self.keys) and self.keys[i] == (key, entry_id):
+                del self.keys[i]
+        self.forget(entry[1])
+
+    def forget(self, keys):
+        """
+        Drops the memoized results of every prefix of the given keys.
+        """
+        for key in keys:
+            for i in range(1, len(key) + 1):
+                self.memo.pop(key[:i], None)
+
+    def complete(self, prefix, limit=10):
+        prefix = normalise_query_string(prefix)
+        if not prefix:
+            return []
+        results = self.memo.get(prefix)
+        if results is None:
+            start = bisect.bisect_left(self.keys, (prefix,))
+            end = bisect.bisect_left(self.keys, (prefix + '\uffff',), start)
+            entry_ids = {entry_id for _, entry_id in self.keys[start:end]}
+            best = heapq.nsmallest(MAX_LIMIT, entry_ids, key=lambda entry_id: self.entries[entry_id][2])
+            results = [self.entries[entry_id][0] for entry_id in best]
+            if len(self.memo) >= MAX_MEMOIZED:
+                self.memo.clear()
+            self.memo[prefix] = results
+        return results[:limit]
+
+    def warm(self):
+        for initial in {key[0] for key, _ in self.keys}:
+            self.complete(initial)
+
+    def add_page(self, page):
+        self.add(('page', page.pk), page.title, id=page.pk, url=page.get_url())
+
+    def replace(self, kind, suggestions):
+        """
+        Makes suggestions, a dict of entry id -> (text, data), the entries of
+        the given kind, touching only those that changed.
+        """
+        for entry_id in [entry_id for entry_id in self.entries if entry_id[0] == kind]:
+            if entry_id not in suggestions:
+                self.remove(entry_id)
+        for entry_id, (text, data) in suggestions.items():
+            current = self.entries.get(entry_id)
+            if current is None or current[0] != {'text': text, 'type': kind, **data}:
+                self.add(entry_id, text, **data)
+
+    def refresh_tags(self):
+        self.replace('tag', {('tag', tag.pk): (tag.name, {'slug': tag.slug}) for tag in live_tags()})
+
+    def refresh_categories(self):
+        self.replace('category', {
+            ('category', category.pk): (category.name, {'id': category.pk})
+            for category in BlogCategory.objects.all()
+        })
+
+
+def live_tags():
+    return Tag.objects.filter(blog_blogpagetag_items__content_object__live=True).distinct()
+
+
+def build_index():
+    hits = dict(
+        Query.objects.annotate(total=Sum('daily_hits__hits')).filter(total__gt=0).values_list('query_string', 'total')
+    )
+    index = PrefixIndex(hits)
+    for page in BlogPage.objects.live().only('id', 'title', 'url_path', 'locale_id'):
+        index.add_page(page)
+    index.refresh_tags()
+    index.refresh_categories()
+    index.warm()
+    return index
+
+
+class AutocompleteState:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.index = None
+        self.version = None
+        self.built_at = 0
+        self.rebuilding = False
+
+    def get_index(self):
+        version = content_version()
+        with self.lock:
+            if self.index is None:
+                self.index, self.version, self.built_at = build_index(), version, time.monotonic()
+            else:
+                interval = getattr(settings, 'AUTOCOMPLETE_REFRESH_INTERVAL', 600)
+                stale = version != self.version or time.monotonic() - self.built_at > interval
+                if stale and not self.rebuilding:
+                    self.rebuilding = True
+                    get_executor().submit(self.rebuild, version)
+            return self.index
+
+    def complete(self, prefix, limit):
+        index = self.get_index()
+        # Updates change the index in place
+        with self.lock:
+            return index.complete(prefix, limit)
+
+    def rebuild(self, version):
+        try:
+            index = build_index()
+            with self.lock:
+                self.index, self.version, self.built_at = index, version, time.monotonic()
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def update(self, change):
+        """
+        Applies change(index) to this process's index, if it has one, and
+        marks it current.
+        """
+        with self.lock:
+            if self.index is not None:
+                change(self.index)
+                self.version = content_version()
+
+
+state = AutocompleteState()
+
+
+def complete(prefix, limit=10):
+    return state.complete(prefix, limit)
+
+
+def page_published(page):
+    def change(index):
+        index.add_page(page)
+        index.refresh_tags()
+    state.update(change)
+
+
+def page_removed(page):
+    def change(index):
+        index.remove(('page', page.pk))
+        index.refresh_tags()
+    state.update(change)
+
+
+def categories_changed():
+    state.update(lambda index: index.refresh_categories())
@@ -0,0 +1,63 @@
+"""
+HTTP validators and CDN headers for pages and API responses.
+
+ETags and Last-Modified dates are built from values that are known before a
+response is rendered: page publish dates and the page cache dependency
+versions (see blog/page_cache.py), which change whenever anything a response
+shows is published or edited. A client or CDN holding a current copy gets a
+304 without the page being rendered or serialized.
+"""
+import hashlib
+import re
+from calendar import timegm
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+def make_etag(*parts):
+    return '"%s"' % hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def latest(*times):
+    return max((time for time in times if time), default=None)
+
+
+def not_modified(request, etag=None, last_modified=None):
+    """
+    Returns a 304 response if the client's copy is still current, else None.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=last_modified and timegm(last_modified.utctimetuple()),
+    )
+
+
+def surrogate_key(dependency):
+    # Surrogate keys are space separated, and tag names may contain spaces
+    return re.sub(r'\s+', '_', dependency)
+
+
+def add_cache_headers(response, etag=None, last_modified=None, dependencies=()):
+    """
+    Sets the validators on a response, and the headers that let browsers
+    and a CDN keep it. The Surrogate-Key header lists the page cache
+    dependencies, so a CDN can purge the response along with the page cache.
+    """
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=getattr(settings, 'HTTP_CACHE_MAX_AGE', 60),
+        s_maxage=getattr(settings, 'HTTP_CACHE_S_MAXAGE', 300),
+    )
+    if dependencies:
+        response['Surrogate-Key'] = ' '.join(sorted(surrogate_key(dependency) for dependency in dependencies))
+    return response
@@ -0,0 +1,113 @@
+"""
+Filtering and facet counts for blog post listings.
+
+Posts can be filtered by any combination of categories, tags, authors and a
+date range. Several values of one facet match posts with any of them; the
+facets and the date range are combined with AND. Each facet is counted over
+the posts matching every filter except its own, so a sidebar can offer the
+alternatives to what is already selected, and all three are counted in one
+grouped query.
+"""
+from django.db.models import CharField, Count, F, IntegerField, Value
+from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_date
+
+from blog.models import BlogPage, BlogPageTag
+
+FACETS = ('category', 'tag', 'author')
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def parse_ids(values, name):
+    try:
+        return {int(value) for value in values}
+    except ValueError:
+        raise InvalidFilter(f"{name} must be a number")
+
+
+def parse_day(value, name):
+    day = parse_date(value) if value else None
+    if value and day is None:
+        raise InvalidFilter(f"{name} must be a date (YYYY-MM-DD)")
+    return day
+
+
+def parse_filters(params):
+    """
+    Reads ?category=, ?tag= and ?author= (each repeatable) and ?date_from=
+    and ?date_to= from a QueryDict. Raises InvalidFilter for bad values.
+    """
+    return {
+        'category': parse_ids(params.getlist('category'), 'category'),
+        'tag': set(params.getlist('tag')),
+        'author': parse_ids(params.getlist('author'), 'author'),
+        'date_from': parse_day(params.get('date_from'), 'date_from'),
+        'date_to': parse_day(params.get('date_to'), 'date_to'),
+    }
+
+
+def filter_posts(queryset, filters, ignore=None):
+    """
+    Applies the filters, except the facet named by ignore, to a BlogPage
+    queryset. The join tables are only ever used in subqueries, so posts are
+    not repeated.
+    """
+    if filters['category'] and ignore != 'category':
+        queryset = queryset.filter(pk__in=BlogPage.categories.through.objects.filter(
+            blogcategory_id__in=filters['category']
+        ).values('blogpage_id'))
+    if filters['tag'] and ignore != 'tag':
+        queryset = queryset.filter(pk__in=BlogPageTag.objects.filter(
+            tag__name__in=filters['tag']
+        ).values('content_object_id'))
+    if filters['author'] and ignore != 'author':
+        queryset = queryset.filter(author_id__in=filters['author'])
+    if filters['date_from']:
+        queryset = queryset.filter(date__gte=filters['date_from'])
+    if filters['date_to']:
+        queryset = queryset.filter(date__lte=filters['date_to'])
+    return queryset
+
+
+def facet_query(rows, facet, value, name):
+    return rows.values(
+        facet=Value(facet, output_field=CharField()),
+        value=F(value),
+        name=F(name) if isinstance(name, str) else name,
+    ).annotate(count=Count('*', output_field=IntegerField())).order_by()
+
+
+def facet_counts(queryset, filters):
+    """
+    Returns {"category": [...], "tag": [...], "author": [...]}, each a list
+    of {"id", "name", "count"} (tags have no id, their name is the filter
+    value), most posts first.
+    """
+    def post_ids(facet):
+        return filter_posts(queryset, filters, ignore=facet).values('pk')
+
+    categories = facet_query(
+        BlogPage.categories.through.objects.filter(blogpage_id__in=post_ids('category')),
+        'category', 'blogcategory_id', 'blogcategory__name',
+    )
+    tags = facet_query(
+        BlogPageTag.objects.filter(content_object_id__in=post_ids('tag')),
+        'tag', 'tag_id', 'tag__name',
+    )
+    authors = facet_query(
+        BlogPage.objects.filter(pk__in=post_ids('author'), author__isnull=False),
+        'author', 'author_id', Coalesce('author__name', 'author__user__username'),
+    )
+
+    facets = {facet: [] for facet in FACETS}
+    for row in categories.union(tags, authors, all=True):
+        item = {'name': row['name'], 'count': row['count']}
+        if row['facet'] != 'tag':
+            item = {'id': row['value'], **item}
+        facets[row['facet']].append(item)
+    for items in facets.values():
+        items.sort(key=lambda item: (-item['count'], item['name']))
+    return facets
@@ -0,0 +1,164 @@
+"""
+A small database-backed queue for fetching Unsplash images outside of the
+request cycle. Views enqueue an ImageJob and return straight away; the
+`run_image_worker` management command claims due jobs and processes them.
+Async views can also run a job themselves with arun_job.
+"""
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from blog.models import BlogPageGalleryImage, ImageJob
+from blog.unsplash import (
+    InvalidImageError, adownload_image, asearch_unsplash, download_image, search_unsplash,
+)
+
+
+def max_attempts():
+    return getattr(settings, 'IMAGE_JOB_MAX_ATTEMPTS', 3)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt, doubling after each failure."""
+    return getattr(settings, 'IMAGE_JOB_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+
+
+def enqueue_image_job(page):
+    return ImageJob.objects.create(page=page, query=page.title)
+
+
+def requeue_stale_jobs():
+    """
+    Puts jobs back in the queue whose worker died while running them.
+    """
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'IMAGE_JOB_TIMEOUT', 300))
+    return ImageJob.objects.filter(status=ImageJob.RUNNING, updated_at__lt=cutoff).update(
+        status=ImageJob.PENDING, updated_at=timezone.now()
+    )
+
+
+# Key of the PostgreSQL advisory lock that serialises claims
+CLAIM_LOCK_ID = 4207
+
+
+def lock_claims():
+    """
+    Makes claims in other transactions wait until the current one commits, so
+    each counts the running jobs after the one before it has claimed its own.
+    SQLite refuses the second of two overlapping writes instead.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CLAIM_LOCK_ID])
+
+
+def claim(jobs, now):
+    """
+    Marks as many of the pending `jobs` running as IMAGE_JOB_CONCURRENCY
+    allows and returns them.
+    """
+    with transaction.atomic():
+        lock_claims()
+        due = list(jobs.values_list('pk', flat=True))
+        running = ImageJob.objects.filter(status=ImageJob.RUNNING).count()
+        # Without the lock another worker may have claimed a job since it
+        # was read, so only the jobs still pending are taken.
+        claimed = [
+            pk for pk in due[:max(getattr(settings, 'IMAGE_JOB_CONCURRENCY', 4) - running, 0)]
+            if ImageJob.objects.filter(pk=pk, status=ImageJob.PENDING).update(
+                status=ImageJob.RUNNING, attempts=F('attempts') + 1, updated_at=now
+            )
+        ]
+    return list(ImageJob.objects.filter(pk__in=claimed).select_related('page'))
+
+
+def claim_jobs(limit):
+    """
+    Marks up to `limit` due jobs as running and returns them, never letting
+    more than IMAGE_JOB_CONCURRENCY jobs run at once across all workers.
+    """
+    now = timezone.now()
+    due = ImageJob.objects.filter(status=ImageJob.PENDING, run_after__lte=now).order_by('run_after', 'id')
+    return claim(due[:limit], now)
+
+
+def claim_job(job):
+    """
+    Claims a pending job for the caller to run straight away, or returns None
+    when IMAGE_JOB_CONCURRENCY jobs are already running.
+    """
+    claimed = claim(ImageJob.objects.filter(pk=job.pk, status=ImageJob.PENDING), timezone.now())
+    return claimed[0] if claimed else None
+
+
+def add_to_gallery(job, image):
+    page = job.page
+    BlogPageGalleryImage.objects.create(page=page, image=image, sort_order=page.gallery_images.count())
+    job.image = image
+    job.status = ImageJob.DONE
+    job.error = ''
+
+
+def record_failure(job, error):
+    job.error = str(error)
+    if isinstance(error, InvalidImageError):
+        # Retrying would download the same unusable file again
+        job.status = ImageJob.FAILED
+    elif job.attempts < max_attempts():
+        job.status = ImageJob.PENDING
+        job.run_after = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+    else:
+        job.status = ImageJob.FAILED
+
+
+def run_job(job):
+    """
+    Searches Unsplash for the job's query and adds the first result to the
+    page's gallery. Failures are retried until IMAGE_JOB_MAX_ATTEMPTS.
+    """
+    page = job.page
+    try:
+        image_url = search_unsplash(job.query)
+        if image_url is None:
+            job.status = ImageJob.FAILED
+            job.error = "No image found"
+        else:
+            add_to_gallery(job, download_image(image_url, page.title, page.slug))
+    except Exception as e:
+        record_failure(job, e)
+    job.save()
+    return job
+
+
+async def arun_job(job):
+    """
+    run_job for async code, with the async Unsplash client. The job's page
+    must already be loaded.
+    """
+    page = job.page
+    try:
+        image_url = await asearch_unsplash(job.query)
+        if image_url is None:
+            job.status = ImageJob.FAILED
+            job.error = "No image found"
+        else:
+            image = await adownload_image(image_url, page.title, page.slug)
+            await sync_to_async(add_to_gallery)(job, image)
+    except Exception as e:
+        record_failure(job, e)
+    await job.asave()
+    return job
+
+
+def work_off(limit=100):
+    """
+    Runs due jobs one after another in the current thread.
+    """
+    jobs = claim_jobs(limit)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from blog.related import build
+
+
+class Command(BaseCommand):
+    help = "Finds the most similar posts to every live BlogPage and stores them as its related posts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help="Only update the posts published or removed since the last build, "
+                                 "keeping its vocabulary. Does a full build if there is none.")
+
+    def handle(self, *args, **options):
+        count = build(incremental=options['incremental'])
+        self.stdout.write(f"Updated the related posts of {count} blog pages")
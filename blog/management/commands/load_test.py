@@ -0,0 +1,72 @@
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends requests to a running server from many concurrent clients and reports "
+        "the throughput and latency. {n} in the URL is replaced by the request number."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url')
+        parser.add_argument('--requests', type=int, default=200, help="Number of requests to send.")
+        parser.add_argument('--concurrency', type=int, default=50, help="Number of requests in flight at once.")
+        parser.add_argument('--method', default='GET')
+        parser.add_argument('--data', help="JSON body to send; {n} is replaced as in the URL.")
+        parser.add_argument('--timeout', type=float, default=60.0, help="Seconds before a request fails.")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+        if options['data']:
+            try:
+                json.loads(options['data'].replace('{n}', '0'))
+            except ValueError as e:
+                raise CommandError(f"--data is not JSON: {e}")
+        results, elapsed = asyncio.run(self.run(options))
+
+        latencies = sorted(latency for status, latency in results if status and status < 500)
+        failures = len(results) - len(latencies)
+        self.stdout.write(
+            f"{len(results)} requests, {options['concurrency']} at a time, in {elapsed:.2f}s: "
+            f"{len(results) / elapsed:.1f} requests/s, {failures} failed"
+        )
+        if latencies:
+            self.stdout.write(
+                f"Latency: median {statistics.median(latencies) * 1000:.0f}ms, "
+                f"95th percentile {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms, "
+                f"max {latencies[-1] * 1000:.0f}ms"
+            )
+
+    async def run(self, options):
+        queue = asyncio.Queue()
+        for n in range(options['requests']):
+            queue.put_nowait(n)
+        results = []
+
+        async def client(http):
+            while not queue.empty():
+                n = queue.get_nowait()
+                body = options['data'].replace('{n}', str(n)) if options['data'] else None
+                start = time.monotonic()
+                try:
+                    response = await http.request(
+                        options['method'], options['url'].replace('{n}', str(n)),
+                        content=body, headers={'Content-Type': 'application/json'} if body else None,
+                    )
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = None
+                results.append((status, time.monotonic() - start))
+
+        limits = httpx.Limits(max_connections=options['concurrency'])
+        async with httpx.AsyncClient(limits=limits, timeout=options['timeout']) as http:
+            start = time.monotonic()
+            await asyncio.gather(*[client(http) for _ in range(options['concurrency'])])
+            return results, time.monotonic() - start
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from blog.prerender import prerender, prerender_workers
+
+
+class Command(BaseCommand):
+    help = "Renders the live blog pages, index pages and tag pages to static HTML in PRERENDER_DIR."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help="Only render the pages whose files are missing or out of date.")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Size of the process pool (0 runs inline). Defaults to PRERENDER_WORKERS.")
+
+    def handle(self, *args, **options):
+        processes = prerender_workers() if options['processes'] is None else options['processes']
+        self.stdout.write(f"Rendering with {processes or 'no'} worker processes")
+
+        rendered = failed = 0
+        for url, error in prerender(options['incremental'], processes):
+            if error:
+                failed += 1
+                self.stderr.write(f"{url}: {error}")
+            else:
+                rendered += 1
+        self.stdout.write(f"Done, {rendered} rendered and {failed} failed")
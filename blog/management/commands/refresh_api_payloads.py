@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from blog.api import refresh_api_payloads
+from blog.models import BlogPage
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the stored API payload of every live BlogPage."
+
+    def handle(self, *args, **options):
+        count = refresh_api_payloads(BlogPage.objects.live())
+        self.stdout.write(f"Refreshed {count} blog pages")
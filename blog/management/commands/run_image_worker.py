@@ -0,0 +1,64 @@
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from blog.jobs import claim_jobs, requeue_stale_jobs, run_job
+
+logger = logging.getLogger(__name__)
+
+
+def run_job_in_thread(job):
+    try:
+        run_job(job)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Processes queued Unsplash image jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=2,
+                            help="Number of jobs this worker runs at once.")
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once the queue is empty instead of polling.")
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not self.stopping:
+                in_flight = {future for future in in_flight if not future.done()}
+                try:
+                    requeue_stale_jobs()
+                    jobs = claim_jobs(concurrency - len(in_flight))
+                except DatabaseError:
+                    # Try again with a new connection once the database is back
+                    logger.exception("Could not claim image jobs")
+                    connection.close()
+                    time.sleep(options['poll_interval'])
+                    continue
+                for job in jobs:
+                    self.stdout.write(f"Running image job {job.pk}: {job.query}")
+                    in_flight.add(executor.submit(run_job_in_thread, job))
+
+                if not jobs:
+                    if options['once'] and not in_flight:
+                        break
+                    time.sleep(options['poll_interval'])
+
+        self.stdout.write("Image worker stopped")
+
+    def stop(self, signum, frame):
+        # Finish the running jobs, but don't claim any more.
+        self.stopping = True
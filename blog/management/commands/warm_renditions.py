@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from wagtail.images import get_image_model
+
+from blog.renditions import image_rendition_specs, warm_renditions
+
+
+class Command(BaseCommand):
+    help = "Generates the configured renditions for every image that is missing some."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help="Size of the process pool (0 runs inline).")
+        parser.add_argument('--spec', action='append', dest='specs',
+                            help="Rendition spec to generate; repeat for several. "
+                                 "Defaults to BLOG_RENDITION_SPECS and the responsive API renditions.")
+
+    def handle(self, *args, **options):
+        specs = options['specs']
+        processes = options['processes']
+
+        image_ids = [
+            image.pk for image in get_image_model().objects.prefetch_related('renditions')
+            if not set(specs or image_rendition_specs(image)) <= {
+                rendition.filter_spec for rendition in image.renditions.all()
+            }
+        ]
+        self.stdout.write(f"Warming {len(image_ids)} images with {processes or 'no'} worker processes")
+
+        failed = 0
+        for image_id, error in warm_renditions(image_ids, specs, processes):
+            if error:
+                failed += 1
+                self.stderr.write(f"Image {image_id}: {error}")
+        self.stdout.write(f"Done, {len(image_ids) - failed} warmed and {failed} failed")
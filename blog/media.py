@@ -0,0 +1,216 @@
+"""
+Serves uploaded media in production.
+
+Responses support single byte ranges (Range and If-Range), conditional
+requests and long-lived caching. Each file's ETag is the hash of its
+contents, computed once per file version and kept in the cache; images and
+renditions get theirs when they are saved. URLs made by versioned_url carry
+that hash, and are cached as immutable as long as it matches the file:
+file names alone are not enough, as a replaced file can reuse its name.
+
+The transfer itself is handed to the front-end server when
+MEDIA_ACCEL_REDIRECT_PREFIX (nginx's X-Accel-Redirect) or MEDIA_X_SENDFILE
+(Apache's or lighttpd's X-Sendfile) is set. Otherwise the file is returned
+as a FileResponse, which gunicorn sends with the sendfile() system call,
+ranges included, without copying it through the worker.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from blog.conditional import not_modified
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+ONE_YEAR = 365 * 24 * 3600
+
+# Characters of the content hash put in versioned URLs
+VERSION_LENGTH = 12
+
+
+def etag_key(name, stat):
+    return f'media-etag:{hashlib.md5(name.encode()).hexdigest()}:{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def file_etag(path, name, stat):
+    """
+    Returns the ETag of the media file at path, hashing it only if this
+    version of the file has not been hashed before.
+    """
+    key = etag_key(name, stat)
+    etag = cache.get(key)
+    if etag is None:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()}"'
+        cache.set(key, etag, None)
+    return etag
+
+
+def precompute_etag(name):
+    """
+    Hashes the media file with the given storage name ahead of its first
+    request.
+    """
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    try:
+        file_etag(path, name, os.stat(path))
+    except FileNotFoundError:
+        pass
+
+
+def versioned_url(file):
+    """
+    Returns the URL of a stored media file with a hash of its contents
+    added, so the URL changes whenever the file does.
+    """
+    path = os.path.join(settings.MEDIA_ROOT, file.name)
+    try:
+        etag = file_etag(path, file.name, os.stat(path))
+    except FileNotFoundError:
+        return file.url
+    return f'{file.url}?v={etag[1:1 + VERSION_LENGTH]}'
+
+
+def is_current_version(request, etag):
+    return request.GET.get('v') == etag[1:1 + VERSION_LENGTH]
+
+
+def byte_range(request, size, etag, last_modified):
+    """
+    Returns the (start, end) of the single byte range requested, end
+    inclusive, None to send the whole file, or False if the range cannot be
+    satisfied. Several ranges get the whole file, which RFC 9110 allows.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        # If-Range holds either the ETag or the Last-Modified date
+        if parse_http_date_safe(if_range) != int(last_modified.timestamp()):
+            return None
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        # The last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+class RangeFile:
+    """
+    The part of a file between two offsets. It has a fileno() and starts at
+    the right offset, so a server's wsgi.file_wrapper can send it with
+    sendfile(); other servers read it in chunks.
+    """
+
+    def __init__(self, f, start, length):
+        self.file = f
+        self.file.seek(start)
+        self.remaining = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def add_headers(request, response, etag, last_modified, content_type=None):
+    if content_type:
+        response['Content-Type'] = content_type
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(int(last_modified.timestamp()))
+    response['Accept-Ranges'] = 'bytes'
+    if is_current_version(request, etag):
+        patch_cache_control(response, public=True, max_age=ONE_YEAR, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600))
+    return response
+
+
+def handoff(name, path):
+    """
+    Returns a response telling the front-end server to send the file, or
+    None if there is no front-end server to hand it to.
+    """
+    prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', None)
+    if prefix:
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + name
+        return response
+    if getattr(settings, 'MEDIA_X_SENDFILE', False):
+        response = HttpResponse()
+        response['X-Sendfile'] = path
+        return response
+    return None
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, FileNotFoundError, NotADirectoryError):
+        raise Http404("Not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Not found")
+
+    name = path.replace(os.sep, '/')
+    etag = file_etag(full_path, name, stat)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return add_headers(request, response, etag, last_modified)
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    # The front-end server handles ranges and the transfer itself
+    response = handoff(name, full_path)
+    if response is not None:
+        return add_headers(request, response, etag, last_modified, content_type)
+
+    size = stat.st_size
+    requested = byte_range(request, size, etag, last_modified)
+    if requested is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    start, end = requested or (0, size - 1)
+    length = max(end - start + 1, 0)
+    if request.method == 'HEAD':
+        response = HttpResponse(status=206 if requested else 200)
+    else:
+        response = FileResponse(RangeFile(open(full_path, 'rb'), start, length), status=206 if requested else 200)
+    response['Content-Length'] = str(length)
+    if requested:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return add_headers(request, response, etag, last_modified, content_type)
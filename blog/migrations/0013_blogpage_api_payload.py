@@ -0,0 +1,19 @@
+# Generated by Django 4.2.3 on 2026-10-17 03:12
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0012_reference_blogpage_references'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogpage',
+            name='api_payload',
+            field=models.JSONField(blank=True, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2026-10-17 03:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0014_imagejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnsplashSearch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=255, unique=True)),
+                ('url', models.URLField(blank=True, max_length=1000, null=True)),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def set_missing_first_published_at(apps, schema_editor):
+    # Live pages made by the create-blog API were never published through
+    # Wagtail, so they have no first_published_at to paginate on.
+    Page = apps.get_model('wagtailcore', 'Page')
+    for page in Page.objects.filter(live=True, first_published_at__isnull=True):
+        page.first_published_at = page.last_published_at or page.latest_revision_created_at or timezone.now()
+        page.save(update_fields=['first_published_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0015_unsplashsearch'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_missing_first_published_at, migrations.RunPython.noop),
+        # Supports keyset pagination of blog listings on (first_published_at, id)
+        migrations.RunSQL(
+            'CREATE INDEX blog_page_first_published_at_id_idx ON wagtailcore_page (first_published_at, id)',
+            'DROP INDEX blog_page_first_published_at_id_idx',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-17 03:29
+
+from django.db import migrations, models
+
+from blog.text import excerpt_from_html
+
+
+def set_excerpts(apps, schema_editor):
+    BlogPage = apps.get_model('blog', 'BlogPage')
+    for page in BlogPage.objects.only('body'):
+        BlogPage.objects.filter(pk=page.pk).update(excerpt=excerpt_from_html(page.body))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0016_page_first_published_at_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blogpage',
+            name='excerpt',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(set_excerpts, migrations.RunPython.noop),
+    ]
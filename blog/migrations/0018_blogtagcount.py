@@ -0,0 +1,35 @@
+# Generated by Django 4.2.3 on 2026-10-17 03:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def count_tags(apps, schema_editor):
+    BlogPageTag = apps.get_model('blog', 'BlogPageTag')
+    BlogTagCount = apps.get_model('blog', 'BlogTagCount')
+    counts = (
+        BlogPageTag.objects.filter(content_object__live=True)
+        .values_list('tag_id')
+        .annotate(count=Count('content_object_id', distinct=True))
+    )
+    BlogTagCount.objects.bulk_create([BlogTagCount(tag_id=tag_id, count=count) for tag_id, count in counts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0005_auto_20220424_2025'),
+        ('blog', '0017_blogpage_excerpt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlogTagCount',
+            fields=[
+                ('tag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='blog_count', serialize=False, to='taggit.tag')),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-17 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0018_blogtagcount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blogpagetag',
+            index=models.Index(fields=['tag', 'content_object'], name='blog_pagetag_tag_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='blogpagetag',
+            index=models.Index(fields=['content_object', 'tag'], name='blog_pagetag_page_tag_idx'),
+        ),
+        # Django manages the categories join table, which already has a unique
+        # index on (blogpage_id, blogcategory_id); this one filters by category
+        migrations.RunSQL(
+            'CREATE INDEX blog_pagecategory_category_page_idx '
+            'ON blog_blogpage_categories (blogcategory_id, blogpage_id)',
+            'DROP INDEX blog_pagecategory_category_page_idx',
+        ),
+    ]
@@ -1,13 +1,17 @@
 import os
 
 from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Count, Prefetch, prefetch_related_objects
+from django.http import Http404
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 from modelcluster.fields import ParentalKey, ParentalManyToManyField
 from modelcluster.contrib.taggit import ClusterTaggableManager
 from rest_framework import serializers
-from taggit.models import TaggedItemBase
+from taggit.models import Tag, TaggedItemBase
 
 from wagtail.api import APIField
 from wagtail.images.api.fields import ImageRenditionField
@@ -17,6 +21,11 @@ from wagtail.admin.panels import FieldPanel, InlinePanel, MultiFieldPanel, Panel
 from wagtail.search import index
 from wagtail.snippets.models import register_snippet
 
+from blog.page_cache import CachedPageMixin, add_cache_dependency, page_dependency
+from blog.pagination import InvalidCursor, keyset_paginate
+from blog.renditions import responsive_renditions
+from blog.text import excerpt_from_html
+
 
 @register_snippet
 class BlogCategory(models.Model):
@@ -38,18 +47,41 @@ class BlogCategory(models.Model):
         verbose_name_plural = 'blog categories'
 
 
-class BlogIndexPage(Page):
+class BlogIndexPage(CachedPageMixin, Page):
     intro = RichTextField(blank=True)
 
     content_panels = Page.content_panels + [
         FieldPanel('intro')
     ]
 
+    posts_per_page = 20
+    cache_query_params = ('cursor',)
+
+    def listed_posts(self):
+        """
+        The live BlogPages below this index, loaded as BlogPages in one query
+        along with their gallery images, without the bodies.
+        """
+        return BlogPage.objects.child_of(self).live().defer('body', 'api_payload').prefetch_related(
+            Prefetch(
+                'gallery_images',
+                queryset=BlogPageGalleryImage.objects.select_related('image').prefetch_related('image__renditions'),
+            )
+        )
+
     def get_context(self, request):
-        # Update context to include only published posts, ordered by reverse-chron
+        # Update context to include only published posts, ordered by reverse-chron,
+        # one page at a time from the ?cursor= position
         context = super().get_context(request)
-        blogpages = self.get_children().live().order_by('-first_published_at')
+        try:
+            blogpages, next_cursor = keyset_paginate(
+                self.listed_posts(), request.GET.get('cursor'), self.posts_per_page
+            )
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
         context['blogpages'] = blogpages
+        context['next_cursor'] = next_cursor
+        add_cache_dependency(request, *[page_dependency(post.id) for post in blogpages])
         return context
 
     # Only allow BlogPages beneath this page.
@@ -63,6 +95,44 @@ class BlogPageTag(TaggedItemBase):
         on_delete=models.CASCADE
     )
 
+    class Meta:
+        # Filtering posts by tag, and counting the tags of a set of posts,
+        # are answered from these indexes alone
+        indexes = [
+            models.Index(fields=['tag', 'content_object'], name='blog_pagetag_tag_page_idx'),
+            models.Index(fields=['content_object', 'tag'], name='blog_pagetag_page_tag_idx'),
+        ]
+
+
+class BlogTagCount(models.Model):
+    """
+    The number of live BlogPages with each tag, kept up to date on publish,
+    unpublish and delete so the tag cloud is a read of one table. Tags on no
+    live page have no row.
+    """
+    tag = models.OneToOneField(Tag, primary_key=True, on_delete=models.CASCADE, related_name='blog_count')
+    count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def recount(cls, tag_ids):
+        """
+        Recounts the given tags with one grouped query and writes them back
+        in one upsert.
+        """
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return
+        counts = dict(
+            BlogPageTag.objects.filter(tag_id__in=tag_ids, content_object__live=True)
+            .values_list('tag_id')
+            .annotate(count=Count('content_object_id', distinct=True))
+        )
+        cls.objects.filter(tag_id__in=tag_ids - set(counts)).delete()
+        cls.objects.bulk_create(
+            [cls(tag_id=tag_id, count=count) for tag_id, count in counts.items()],
+            update_conflicts=True, unique_fields=['tag'], update_fields=['count'],
+        )
+
 
 from django.contrib.auth.models import User
 
@@ -86,6 +156,23 @@ class BlogCategorySerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class PayloadField(serializers.Field):
+    """
+    Serves an API field from BlogPage.api_payload, only computing the
+    payload when the page has not been materialized yet.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, page):
+        if page.api_payload is None or self.field_name not in page.api_payload:
+            page.api_payload = page.build_api_payload()
+        return page.api_payload[self.field_name]
+
+
 class Reference(models.Model):
     """
     A model representing a bibliographic reference.
@@ -129,6 +216,21 @@ class CustomInlinePanel(InlinePanel):
                                ?.split('=')[1];
                        }
 
+                       // The image is fetched in the background; reload once the job has finished
+                       function waitForJob(jobId) {
+                           const status_url = window.location.origin + '/api/blog/image-jobs/' + jobId + '/';
+                           fetch(status_url, {headers: {'Accept': 'application/json'}})
+                               .then(response => response.json())
+                               .then(response => {
+                                   console.log(response);
+                                   if (response.status === 'done' || response.status === 'failed') {
+                                       location.reload();
+                                   } else {
+                                       setTimeout(() => waitForJob(jobId), 2000);
+                                   }
+                               });
+                       }
+
                        document.querySelectorAll(".custom-inline-panel-button").forEach(function(button) {
                            button.addEventListener("click", function() {
                                 const url = window.location.pathname;
@@ -146,8 +248,7 @@ class CustomInlinePanel(InlinePanel):
                                     body: JSON.stringify({ "id": id })
                                 })
                                    .then(response => response.json())
-                                   .then(response => console.log(response))
-                                   .then(response => location.reload())
+                                   .then(response => waitForJob(response.job))
                                    .catch(error => console.error('Error:', error));
                            });
                        });
@@ -161,7 +262,7 @@ class CustomInlinePanel(InlinePanel):
             return mark_safe(html + custom_js)
 
 
-class BlogPage(Page):
+class BlogPage(CachedPageMixin, Page):
     date = models.DateField("Post date")
     intro = models.CharField(max_length=250, null=True, blank=True)
     body = RichTextField(blank=True)
@@ -175,15 +276,50 @@ class BlogPage(Page):
         on_delete=models.SET_NULL,
     )
     references = ParentalManyToManyField('Reference', blank=True)
+    # Plain text start of the body, shown on the index instead of the full body.
+    excerpt = models.TextField(blank=True, editable=False)
+    # Serialized api_fields, rebuilt on publish and when related snippets change.
+    api_payload = models.JSONField(null=True, blank=True, editable=False, encoder=DjangoJSONEncoder)
+
+    excerpt_length = 300
+
+    def get_context(self, request, *args, **kwargs):
+        context = super().get_context(request, *args, **kwargs)
+        prefetch_related_objects([self], related_links_prefetch())
+        context['related_posts'] = self.related_posts()
+        if self.author_id:
+            add_cache_dependency(request, f'author:{self.author_id}')
+        add_cache_dependency(request, *[f'category:{category.pk}' for category in self.categories.all()])
+        add_cache_dependency(request, *[page_dependency(post.pk) for post in context['related_posts']])
+        return context
 
-    def main_image(self):
-        gallery_item = self.gallery_images.first()
+    def save(self, *args, **kwargs):
+        self.excerpt = excerpt_from_html(self.body, self.excerpt_length)
+        return super().save(*args, **kwargs)
+
+    def main_gallery_image(self):
+        # Iterate rather than .first() so a prefetched gallery is reused.
+        gallery_item = next(iter(self.gallery_images.all()), None)
         if gallery_item and gallery_item.image:
-            rendition = gallery_item.image
-            return rendition.file.url
+            return gallery_item.image
+        return None
+
+    def main_image(self):
+        image = self.main_gallery_image()
+        if image:
+            return image.file.url
         else:
             return None
 
+    def main_image_renditions(self):
+        """
+        Resized WebP/AVIF versions of the main image, ready for a srcset.
+        """
+        image = self.main_gallery_image()
+        if image:
+            return responsive_renditions(image)
+        return None
+
     def author_obj(self):
         url = None
         if not self.author:
@@ -214,15 +350,44 @@ class BlogPage(Page):
             })
         return return_val
 
+    def related_posts(self):
+        """
+        The live posts most like this one, most similar first, as last found
+        by `manage.py build_related_posts` (see blog/related.py).
+        """
+        return [link.related for link in self.related_links.all() if link.related.live]
+
+    def related_posts_serialized(self):
+        return [
+            {"id": post.id, "title": post.title, "url": post.url}
+            for post in self.related_posts()
+        ]
+
+    def build_api_payload(self):
+        return {
+            "main_image": self.main_image(),
+            "main_image_renditions": self.main_image_renditions(),
+            "references_serialized": self.references_serialized(),
+            "categories": [
+                {"id": category.id, "meta": {"type": "blog.BlogCategory"}}
+                for category in self.categories.all()
+            ],
+            "categories_str": self.categories_str(),
+            "author_obj": self.author_obj(),
+            "related_posts": self.related_posts_serialized(),
+        }
+
     api_fields = [
         APIField("intro"),
         APIField("body"),
         APIField('date'),
-        APIField('main_image'),
-        APIField('references_serialized'),
-        APIField('categories', serializer=BlogCategorySerializer),
-        APIField('categories_str'),
-        APIField('author_obj'),
+        APIField('main_image', serializer=PayloadField()),
+        APIField('main_image_renditions', serializer=PayloadField()),
+        APIField('references_serialized', serializer=PayloadField()),
+        APIField('categories', serializer=PayloadField()),
+        APIField('categories_str', serializer=PayloadField()),
+        APIField('author_obj', serializer=PayloadField()),
+        APIField('related_posts', serializer=PayloadField()),
 
     ]
 
@@ -263,14 +428,110 @@ class BlogPageGalleryImage(Orderable):
     ]
 
 
-class BlogTagIndexPage(Page):
+class RelatedPost(models.Model):
+    """
+    One of the posts most similar to a BlogPage, written by
+    `manage.py build_related_posts` (see blog/related.py).
+    """
+    page = models.ForeignKey(BlogPage, on_delete=models.CASCADE, related_name='related_links')
+    related = models.ForeignKey(BlogPage, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['page', '-score', 'related']
+        constraints = [
+            models.UniqueConstraint(fields=['page', 'related'], name='blog_relatedpost_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.page_id} -> {self.related_id} ({self.score:.3f})"
+
+
+def related_links_prefetch():
+    return Prefetch('related_links', queryset=RelatedPost.objects.select_related('related').defer(
+        'related__body', 'related__api_payload'
+    ))
+
+
+class ImageJob(models.Model):
+    """
+    A queued request to find an Unsplash image for a BlogPage and add it to
+    its gallery. Processed by `manage.py run_image_worker`.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    page = models.ForeignKey(BlogPage, on_delete=models.CASCADE, related_name='image_jobs')
+    query = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    image = models.ForeignKey(
+        'wagtailimages.Image', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    run_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.query} ({self.status})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+
+class UnsplashSearch(models.Model):
+    """
+    The result of an Unsplash search, cached by blog.unsplash so repeated
+    queries skip the API, also across restarts.
+    """
+    query = models.CharField(max_length=255, unique=True)
+    url = models.URLField(max_length=1000, null=True, blank=True)
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.query
+
+
+class BlogTagIndexPage(CachedPageMixin, Page):
+    posts_per_page = 20
+    cache_query_params = ('tag', 'cursor')
+
+    def tagged_posts(self, tag):
+        """
+        The live BlogPages with the tag, with their authors, without the bodies.
+        """
+        return BlogPage.objects.live().filter(tags__name=tag).defer('body', 'api_payload').select_related(
+            'author__user'
+        )
 
     def get_context(self, request):
-        # Filter by tag
+        # Filter by tag, one page at a time from the ?cursor= position
         tag = request.GET.get('tag')
-        blogpages = BlogPage.objects.filter(tags__name=tag)
+        try:
+            blogpages, next_cursor = keyset_paginate(
+                self.tagged_posts(tag), request.GET.get('cursor'), self.posts_per_page
+            )
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
 
         # Update template context
         context = super().get_context(request)
         context['blogpages'] = blogpages
+        context['next_cursor'] = next_cursor
+        add_cache_dependency(request, f'tag:{tag}')
+        for blogpage in blogpages:
+            add_cache_dependency(request, page_dependency(blogpage.id))
+            if blogpage.author_id:
+                add_cache_dependency(request, f'author:{blogpage.author_id}')
         return context
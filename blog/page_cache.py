@@ -0,0 +1,153 @@
+"""
+Full-page response cache for pages served by Wagtail.
+
+Pages using CachedPageMixin store their rendered response for anonymous
+GET requests, keyed by page id and the query parameters listed in the
+page's cache_query_params. Each cached response also records the
+dependencies it was rendered from: the page itself plus anything added
+with add_cache_dependency(), e.g. "author:3" or "page:12" for a post shown
+on an index. Every dependency has a version in the cache; purge() replaces
+the versions, and a cached response whose recorded versions no longer
+match is treated as a miss.
+
+Versions start with the time they were set, which gives the cached
+responses their Last-Modified date.
+"""
+import hashlib
+import time
+import uuid
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlencode
+
+from blog import atomic_cache
+from blog.conditional import add_cache_headers, latest, make_etag, not_modified
+
+KEY_PREFIX = 'pagecache'
+
+# Purged along with every page, for responses that may list any of them
+PAGES_DEPENDENCY = 'pages'
+
+# Sent with the purged dependencies, for copies of pages kept elsewhere
+dependencies_purged = Signal()
+
+
+def page_dependency(page_id):
+    return f'page:{page_id}'
+
+
+def add_cache_dependency(request, *dependencies):
+    """
+    Records that the page being rendered for the request shows the given
+    dependencies, so purging any of them purges the page.
+    """
+    if hasattr(request, 'page_cache_dependencies'):
+        request.page_cache_dependencies.update(dependencies)
+
+
+def dependency_key(dependency):
+    return f'{KEY_PREFIX}:dep:{dependency}'
+
+
+def new_version():
+    return f'{time.time():.6f}-{uuid.uuid4().hex[:8]}'
+
+
+def version_time(version):
+    return datetime.fromtimestamp(float(version.split('-')[0]), tz=timezone.utc)
+
+
+def purge(*dependencies):
+    """
+    Invalidates every cached page rendered from any of the dependencies.
+    """
+    cache.set_many({dependency_key(dependency): new_version() for dependency in dependencies}, None)
+    dependencies_purged.send(sender=None, dependencies=dependencies)
+
+
+def current_versions(dependencies):
+    keys = {dependency: dependency_key(dependency) for dependency in dependencies}
+    for key in keys.values():
+        cache.add(key, new_version(), None)
+    found = cache.get_many(keys.values())
+    return {dependency: found.get(key) for dependency, key in keys.items()}
+
+
+def count(name):
+    atomic_cache.increment(f'{KEY_PREFIX}:stats:{name}', None)
+
+
+def page_cache_stats():
+    stats = cache.get_many([f'{KEY_PREFIX}:stats:hits', f'{KEY_PREFIX}:stats:misses'])
+    return {
+        'hits': stats.get(f'{KEY_PREFIX}:stats:hits', 0),
+        'misses': stats.get(f'{KEY_PREFIX}:stats:misses', 0),
+    }
+
+
+class CachedPageMixin:
+    # Query parameters that change what the page shows; all others are ignored.
+    cache_query_params = ()
+
+    def page_cache_key(self, request):
+        query = urlencode(sorted(
+            (name, value) for name in self.cache_query_params for value in request.GET.getlist(name)
+        ))
+        return f'{KEY_PREFIX}:page:{self.pk}:{hashlib.md5(query.encode()).hexdigest()}'
+
+    def is_cacheable_request(self, request):
+        return (
+            request.method in ('GET', 'HEAD')
+            and not getattr(request, 'is_preview', False)
+            and not request.user.is_authenticated
+        )
+
+    def serve(self, request, *args, **kwargs):
+        if self.get_view_restrictions().exists():
+            # Only visitors who passed the restriction get this far, so the
+            # page must not be shared with anyone else
+            response = super().serve(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        if not self.is_cacheable_request(request):
+            return super().serve(request, *args, **kwargs)
+
+        key = self.page_cache_key(request)
+        cached = cache.get(key)
+        if cached and current_versions(cached['dependencies']) == cached['dependencies']:
+            count('hits')
+            response = not_modified(request, cached['etag'], cached['last_modified'])
+            if response is None:
+                response = HttpResponse(cached['content'], content_type=cached['content_type'])
+            response['X-Page-Cache'] = 'HIT'
+            return add_cache_headers(response, cached['etag'], cached['last_modified'], cached['dependencies'])
+
+        count('misses')
+        request.page_cache_dependencies = {page_dependency(self.pk)}
+        response = super().serve(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        response['X-Page-Cache'] = 'MISS'
+        if response.status_code != 200 or response.cookies:
+            return response
+
+        versions = current_versions(request.page_cache_dependencies)
+        etag = make_etag(key, self.last_published_at, *sorted(versions.items()))
+        last_modified = latest(self.last_published_at, *(version_time(version) for version in versions.values()))
+        cache.set(key, {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'dependencies': versions,
+            'etag': etag,
+            'last_modified': last_modified,
+        }, getattr(settings, 'PAGE_CACHE_TIMEOUT', 24 * 3600))
+
+        # The client may still hold this exact page from before it dropped out of the cache
+        response = not_modified(request, etag, last_modified) or response
+        response['X-Page-Cache'] = 'MISS'
+        return add_cache_headers(response, etag, last_modified, versions)
@@ -0,0 +1,315 @@
+"""
+Static HTML copies of the blog's pages, served without running any views.
+
+`manage.py prerender` renders every live, public BlogPage, BlogIndexPage
+(each ?cursor= page of it) and BlogTagIndexPage (each page of each tag in
+use) into PRERENDER_DIR, in a process pool of PRERENDER_WORKERS processes.
+Files are written to a temporary name and renamed into place, along with a
+gzipped copy.
+
+PrerenderedPagesMiddleware is WhiteNoise over that directory: it answers
+anonymous GET and HEAD requests with the file for their path and query
+string, if there is one, and passes everything else on to Wagtail.
+
+A page's file records the page cache dependencies it was rendered from
+(see blog/page_cache.py) in manifest.json. Purging any of them deletes the
+file straight away, so Wagtail serves the page until it is rendered again;
+`manage.py prerender --incremental` renders only the pages whose files are
+missing or out of date, and removes those of pages no longer published.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory
+from django.utils.http import urlencode
+from wagtail.models import Page, Site
+from whitenoise.base import WhiteNoise
+
+from blog.models import BlogIndexPage, BlogPage, BlogTagCount, BlogTagIndexPage
+from blog.page_cache import CachedPageMixin, current_versions, page_dependency
+from blog.pagination import keyset_paginate
+from blog.renditions import make_pool
+from blog.static import StaticFilesMiddleware
+
+MANIFEST = 'manifest.json'
+
+# Where the files of pages requested with a query string go, below the page's own
+VARIANTS_DIR = '_q'
+
+
+def prerender_dir():
+    return getattr(settings, 'PRERENDER_DIR', os.path.join(settings.BASE_DIR, 'prerendered'))
+
+
+def prerender_workers():
+    return getattr(settings, 'PRERENDER_WORKERS', 2)
+
+
+def file_url(path, query=()):
+    """
+    The URL, relative to PRERENDER_DIR, of the file for a request to path
+    with the given (name, value) query parameters.
+    """
+    query = sorted(query)
+    if query:
+        path += f'{VARIANTS_DIR}/{hashlib.md5(urlencode(query).encode()).hexdigest()}/'
+    return path
+
+
+def file_path(url):
+    return os.path.join(prerender_dir(), *url.strip('/').split('/'), 'index.html')
+
+
+class PrerenderedPagesMiddleware(StaticFilesMiddleware):
+    """
+    Serves prerendered pages from PRERENDER_DIR ahead of Wagtail.
+
+    Files are looked up on every request, as WhiteNoise does with
+    autorefresh on, so pages rendered or deleted while the server runs are
+    picked up.
+    """
+
+    def __init__(self, get_response=None, settings=settings):
+        self.get_response = get_response
+        WhiteNoise.__init__(
+            self, application=None, autorefresh=True, index_file=True,
+            max_age=getattr(settings, 'HTTP_CACHE_MAX_AGE', 60),
+        )
+        self.use_finders = False
+        self.init_async_mode()
+
+    def candidate_paths_for_url(self, url):
+        yield os.path.join(prerender_dir(), *url.strip('/').split('/'))
+
+    def immutable_file_test(self, path, url):
+        # Pages change when they are published
+        return False
+
+    def prerendered(self, request):
+        """
+        Returns the response with the page's file, if there is one.
+        """
+        query = [(name, value) for name, values in request.GET.lists() for value in values]
+        static_file = self.find_file(file_url(request.path_info, query))
+        if static_file is None:
+            return None
+        response = self.serve(static_file, request)
+        response['X-Prerendered'] = '1'
+        return response
+
+    @staticmethod
+    def wants_page(request):
+        return request.method in ('GET', 'HEAD') and request.path_info.endswith('/')
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.wants_page(request) and not request.user.is_authenticated:
+            response = self.prerendered(request)
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.wants_page(request) and not await is_authenticated(request):
+            response = self.prerendered(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+
+async def is_authenticated(request):
+    # Visitors without a session are anonymous, and loading the user of
+    # those with one reads the database, which has to happen in a thread
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return False
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+def page_path(page):
+    return urlparse(page.get_url()).path
+
+
+def cursor_pages(queryset, page_size):
+    """
+    Yields the ?cursor= of every page but the first of a keyset paginated
+    listing.
+    """
+    queryset = queryset.select_related(None).only('id', 'first_published_at')
+    cursor = None
+    while True:
+        _, cursor = keyset_paginate(queryset, cursor, page_size)
+        if cursor is None:
+            return
+        yield cursor
+
+
+def targets():
+    """
+    Yields (page id, path, query) for everything that is prerendered, query
+    being a list of (name, value) pairs.
+    """
+    for page in BlogPage.objects.live().public().iterator():
+        yield page.pk, page_path(page), []
+
+    for index in BlogIndexPage.objects.live().public():
+        path = page_path(index)
+        yield index.pk, path, []
+        posts = BlogPage.objects.child_of(index).live()
+        for cursor in cursor_pages(posts, index.posts_per_page):
+            yield index.pk, path, [('cursor', cursor)]
+
+    tags = list(BlogTagCount.objects.values_list('tag__name', flat=True))
+    for tag_page in BlogTagIndexPage.objects.live().public():
+        path = page_path(tag_page)
+        yield tag_page.pk, path, []
+        for tag in tags:
+            yield tag_page.pk, path, [('tag', tag)]
+            for cursor in cursor_pages(tag_page.tagged_posts(tag), tag_page.posts_per_page):
+                yield tag_page.pk, path, [('tag', tag), ('cursor', cursor)]
+
+
+class NotRendered(Exception):
+    pass
+
+
+def write_atomically(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove(url):
+    for path in (file_path(url) + '.gz', file_path(url)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def render(page_id, path, query):
+    """
+    Renders the page as an anonymous visitor would see it at path?query and
+    writes it to its file. Returns the file's manifest entry.
+    """
+    page = Page.objects.get(pk=page_id).specific
+    site = page.get_site() or Site.objects.get(is_default_site=True)
+    request = RequestFactory(SERVER_NAME=site.hostname, SERVER_PORT=site.port).get(path, query)
+    request.user = AnonymousUser()
+    request.page_cache_dependencies = {page_dependency(page.pk)}
+
+    # Page.serve itself, rather than the page cache
+    serve = super(CachedPageMixin, page).serve if isinstance(page, CachedPageMixin) else page.serve
+    response = serve(request)
+    if hasattr(response, 'render'):
+        response.render()
+    if response.status_code != 200:
+        raise NotRendered(f"Responded with status {response.status_code}")
+
+    url = file_url(path, query)
+    write_atomically(file_path(url) + '.gz', gzip.compress(response.content, mtime=0))
+    write_atomically(file_path(url), response.content)
+    return {
+        'page': page.pk,
+        'path': path,
+        'query': query,
+        'dependencies': current_versions(request.page_cache_dependencies),
+    }
+
+
+def render_all(todo, processes):
+    """
+    Renders the (page id, path, query) targets, spread over a process pool.
+    Yields (target, manifest entry, error) as each finishes.
+    """
+    if not processes:
+        for target in todo:
+            try:
+                yield target, render(*target), None
+            except Exception as e:
+                yield target, None, e
+        return
+
+    with make_pool(processes) as pool:
+        futures = [(pool.submit(render, *target), target) for target in todo]
+        for future, target in futures:
+            error = future.exception()
+            yield target, None if error else future.result(), error
+
+
+def load_manifest():
+    try:
+        with open(os.path.join(prerender_dir(), MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest):
+    write_atomically(os.path.join(prerender_dir(), MANIFEST), json.dumps(manifest).encode())
+
+
+def is_current(url, entry):
+    return (
+        os.path.exists(file_path(url))
+        and current_versions(entry['dependencies']) == entry['dependencies']
+    )
+
+
+def prerender(incremental=False, processes=None):
+    """
+    Renders every prerendered page, or with incremental=True those whose
+    files are missing or out of date, and deletes the files of pages that
+    are no longer prerendered. Yields (url, error) as each page finishes.
+    """
+    manifest = load_manifest()
+    wanted = {file_url(path, query): (page_id, path, query) for page_id, path, query in targets()}
+    for url in set(manifest) - set(wanted):
+        remove(url)
+        del manifest[url]
+
+    todo = [
+        target for url, target in wanted.items()
+        if not (incremental and url in manifest and is_current(url, manifest[url]))
+    ]
+    processes = prerender_workers() if processes is None else processes
+    for (_, path, query), entry, error in render_all(todo, processes):
+        url = file_url(path, query)
+        if error is None:
+            manifest[url] = entry
+        else:
+            remove(url)
+            manifest.pop(url, None)
+        yield url, error
+
+    # Pages published while rendering may have been rendered from before
+    for url, entry in manifest.items():
+        if not is_current(url, entry):
+            remove(url)
+    save_manifest(manifest)
+
+
+def invalidate(dependencies):
+    """
+    Deletes the files of the pages rendered from any of the dependencies.
+    """
+    if not os.path.exists(os.path.join(prerender_dir(), MANIFEST)):
+        return
+    dependencies = set(dependencies)
+    for url, entry in load_manifest().items():
+        if dependencies.intersection(entry['dependencies']):
+            remove(url)
@@ -0,0 +1,194 @@
+"""
+Per-request database query accounting.
+
+Every connection gets an execute wrapper that counts the queries and times
+them for the request being handled, which it finds in a context variable,
+so queries run by async views in Django's sync threads are counted as well.
+QueryBudgetMiddleware totals them by resolved view, adds a Server-Timing
+header, and flags requests that run more queries than their budget:
+QUERY_BUDGETS[view name], or QUERY_BUDGET for views without their own. A
+view handling a batch of items can have an (overhead, per item) budget,
+and tell the middleware the batch size with scale_query_budget(). Requests
+over QUERY_TIME_BUDGET seconds of database time are flagged too.
+
+Flagged requests are logged. With QUERY_BUDGET_STRICT on, as it is in the
+tests, going over the query budget raises QueryBudgetExceeded instead.
+
+Totals are kept per process; query_stats() returns this process's.
+"""
+import contextvars
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 50
+DEFAULT_TIME_BUDGET = 0.5  # seconds
+
+_current = contextvars.ContextVar('request_queries', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestQueries:
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    queries = _current.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.count += 1
+        queries.time += time.perf_counter() - start
+
+
+def install(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    install(connection)
+
+
+def install_all():
+    # Connections opened before this module was imported
+    for connection in connections.all(initialized_only=True):
+        install(connection)
+
+
+class ViewStats:
+    """Totals for one view, guarded by the lock of the stats they are in."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.time = 0.0
+        self.max_queries = 0
+        self.over_budget = 0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'avg_queries': round(self.queries / self.requests, 2),
+            'max_queries': self.max_queries,
+            'db_time_ms': round(self.time * 1000, 1),
+            'avg_db_time_ms': round(self.time * 1000 / self.requests, 2),
+            'over_budget': self.over_budget,
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def query_stats():
+    """
+    Returns {view name: {"requests", "queries", "avg_queries", ...}} for the
+    requests this process has handled, the views with the most queries first.
+    """
+    with _stats_lock:
+        rows = {view: stats.as_dict() for view, stats in _stats.items()}
+    return dict(sorted(rows.items(), key=lambda item: -item[1]['queries']))
+
+
+def reset_query_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def query_budget(view_name, items=1):
+    budget = getattr(settings, 'QUERY_BUDGETS', {}).get(view_name, getattr(settings, 'QUERY_BUDGET', DEFAULT_BUDGET))
+    if isinstance(budget, tuple):
+        overhead, per_item = budget
+        return overhead + per_item * items
+    return budget
+
+
+def scale_query_budget(request, items):
+    """
+    Sets the number of items the request handles, for a view with an
+    (overhead, per item) budget.
+    """
+    # DRF views get a Request wrapping the HttpRequest the middleware sees
+    getattr(request, '_request', request).query_budget_items = items
+
+
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        queries = RequestQueries()
+        token = _current.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.account(request, response, queries)
+
+    async def __acall__(self, request):
+        queries = RequestQueries()
+        token = _current.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.account(request, response, queries)
+
+    def account(self, request, response, queries):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # Answered by a middleware, such as a static or prerendered file
+            return response
+
+        view = match.view_name
+        response['Server-Timing'] = f'db;dur={queries.time * 1000:.1f};desc="{queries.count} queries"'
+        budget = query_budget(view, getattr(request, 'query_budget_items', 1))
+        over_budget = queries.count > budget
+        slow = queries.time > getattr(settings, 'QUERY_TIME_BUDGET', DEFAULT_TIME_BUDGET)
+
+        with _stats_lock:
+            stats = _stats.setdefault(view, ViewStats())
+            stats.requests += 1
+            stats.queries += queries.count
+            stats.time += queries.time
+            stats.max_queries = max(stats.max_queries, queries.count)
+            stats.over_budget += over_budget or slow
+
+        if over_budget and getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(
+                f"{request.method} {request.path} ({view}) ran {queries.count} queries, the budget is {budget}"
+            )
+        if over_budget or slow:
+            logger.warning(
+                "%s %s (%s) ran %d queries in %.1fms; the budget is %d",
+                request.method, request.path, view, queries.count, queries.time * 1000, budget,
+            )
+        return response
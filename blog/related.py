@@ -0,0 +1,375 @@
+"""
+Related posts by TF-IDF similarity.
+
+`manage.py build_related_posts` turns the title, intro and body of every live
+BlogPage, along with its tags and categories, into an L2-normalized TF-IDF
+vector and stores each post's RELATED_POSTS_COUNT nearest neighbours by
+cosine similarity as RelatedPost rows. Similarities are computed a block of
+RELATED_POSTS_BLOCK_SIZE posts against a block at a time, so memory use does
+not grow with the square of the number of posts.
+
+The vocabulary, vectors and neighbours are saved in RELATED_POSTS_DIR. With
+--incremental only the posts published or removed since the last run are
+re-vectorized, against the saved vocabulary, and only the posts whose
+neighbours may have changed are recomputed: the changed posts, the posts
+that listed one of them, and the posts one of them is now closer to than
+their last neighbour. Words first seen since the last full build are left
+out until the next one.
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from blog.api import refresh_api_payloads
+from blog.models import BlogPage, RelatedPost
+from blog.text import text_from_html
+
+TOKEN_RE = re.compile(r'\w\w+')
+
+# How many times each field counts towards a post's term frequencies
+FIELD_WEIGHTS = {'title': 3, 'intro': 2, 'body': 1}
+TAG_WEIGHT = 3
+CATEGORY_WEIGHT = 2
+
+# Words in fewer posts than this are left out of the vocabulary
+MIN_DOCUMENT_FREQUENCY = 2
+
+
+def index_dir():
+    return getattr(settings, 'RELATED_POSTS_DIR', os.path.join(settings.BASE_DIR, 'related_index'))
+
+
+def post_terms(page):
+    """
+    Returns the weighted frequency of each feature of the page: its words,
+    and its tags and categories as "tag:" and "category:" features.
+    """
+    terms = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        text = getattr(page, field) or ''
+        if field == 'body':
+            text = text_from_html(text)
+        for word in TOKEN_RE.findall(text.lower()):
+            terms[word] += weight
+    for tag in page.tags.all():
+        terms[f'tag:{tag.name.lower()}'] += TAG_WEIGHT
+    for category in page.categories.all():
+        terms[f'category:{category.pk}'] += CATEGORY_WEIGHT
+    return terms
+
+
+def load_terms(queryset):
+    """
+    Returns the ids of the pages in the queryset and their post_terms().
+    """
+    page_ids, terms = [], []
+    pages = queryset.only('id', 'title', 'intro', 'body').prefetch_related('tags', 'categories')
+    for page in pages.order_by('id').iterator(chunk_size=2000):
+        page_ids.append(page.pk)
+        terms.append(post_terms(page))
+    return page_ids, terms
+
+
+def build_vocabulary(terms, max_features):
+    """
+    Returns the vocabulary, the max_features terms in most posts, in order,
+    and the inverse document frequency of each.
+    """
+    document_frequency = Counter()
+    for post in terms:
+        document_frequency.update(post.keys())
+    common = [
+        (term, count) for term, count in document_frequency.most_common(max_features)
+        if count >= MIN_DOCUMENT_FREQUENCY
+    ]
+    common.sort()
+    vocabulary = [term for term, _ in common]
+    idf = np.array([math.log((1 + len(terms)) / (1 + count)) + 1 for _, count in common], dtype=np.float32)
+    return vocabulary, idf
+
+
+class Matrix:
+    """
+    Posts' TF-IDF vectors as a sparse matrix, one row per post, in
+    compressed sparse row form.
+    """
+
+    def __init__(self, indptr, indices, data, width):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.width = width
+
+    @classmethod
+    def from_terms(cls, terms, columns, idf):
+        indptr = [0]
+        indices = []
+        data = []
+        for post in terms:
+            row = sorted((columns[term], 1 + math.log(count)) for term, count in post.items() if term in columns)
+            weights = np.array([tf for _, tf in row], dtype=np.float32) * idf[[column for column, _ in row]]
+            norm = np.linalg.norm(weights)
+            indices += [column for column, _ in row]
+            data += list(weights / norm) if norm else list(weights)
+            indptr.append(len(indices))
+        return cls(
+            np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32),
+            np.array(data, dtype=np.float32), len(idf),
+        )
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def take(self, rows):
+        """
+        Returns a new Matrix of the given rows, in order.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        positions = np.concatenate(
+            [np.arange(start, end) for start, end in zip(starts, ends)] or [[]]
+        ).astype(np.int64)
+        indptr = np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64)
+        return Matrix(indptr, self.indices[positions], self.data[positions], self.width)
+
+    def append(self, other):
+        return Matrix(
+            np.concatenate([self.indptr, other.indptr[1:] + self.indptr[-1]]),
+            np.concatenate([self.indices, other.indices]),
+            np.concatenate([self.data, other.data]),
+            self.width,
+        )
+
+    def dense(self, rows):
+        """
+        Returns the given rows as a dense array.
+        """
+        part = self.take(rows)
+        block = np.zeros((len(part), self.width), dtype=np.float32)
+        block[np.repeat(np.arange(len(part)), np.diff(part.indptr)), part.indices] = part.data
+        return block
+
+
+def blocks(count, block_size):
+    for start in range(0, count, block_size):
+        yield np.arange(start, min(start + block_size, count))
+
+
+def nearest(matrix, rows, k, block_size):
+    """
+    Returns the column indices and similarities of the k rows of the matrix
+    nearest each of the given rows, as two len(rows) x k arrays, nearest
+    first. Missing neighbours have index -1 and similarity 0.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    neighbours = np.full((len(rows), k), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), k), dtype=np.float32)
+    for row_block in blocks(len(rows), block_size):
+        block_rows = rows[row_block]
+        vectors = matrix.dense(block_rows)
+        best = np.full((len(block_rows), k), -1, dtype=np.int64)
+        best_scores = np.zeros((len(block_rows), k), dtype=np.float32)
+        for columns in blocks(len(matrix), block_size):
+            similarity = vectors @ matrix.dense(columns).T
+            similarity[block_rows[:, None] == columns[None, :]] = 0
+            candidates = np.concatenate([best, np.broadcast_to(columns, similarity.shape)], axis=1)
+            candidate_scores = np.concatenate([best_scores, similarity], axis=1)
+            top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            best = np.take_along_axis(candidates, top, axis=1)
+            best_scores = np.take_along_axis(candidate_scores, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best[best_scores <= 0] = -1
+        neighbours[row_block] = best
+        scores[row_block] = np.maximum(best_scores, 0)
+    return neighbours, scores
+
+
+def closest_to(matrix, rows, block_size):
+    """
+    Returns, for every row of the matrix, its highest similarity to any of
+    the given rows (other than itself).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    closest = np.zeros(len(matrix), dtype=np.float32)
+    if not len(rows):
+        return closest
+    for row_block in blocks(len(rows), block_size):
+        vectors = matrix.dense(rows[row_block])
+        for columns in blocks(len(matrix), block_size):
+            similarity = matrix.dense(columns) @ vectors.T
+            similarity[columns[:, None] == rows[row_block][None, :]] = 0
+            closest[columns] = np.maximum(closest[columns], similarity.max(axis=1))
+    return closest
+
+
+class RelatedIndex:
+    """
+    What a build of the related posts leaves behind for the next
+    incremental one: the vocabulary and its IDF, and every post's page id,
+    vector, and neighbours' page ids (-1 for none) and similarities.
+    """
+
+    def __init__(self, built_at, vocabulary, idf, page_ids, matrix, neighbours, scores):
+        self.built_at = built_at
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.page_ids = page_ids
+        self.matrix = matrix
+        self.neighbours = neighbours
+        self.scores = scores
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'vectors.npz.tmp'), 'wb') as f:
+            np.savez(
+                f, idf=self.idf, page_ids=self.page_ids, indptr=self.matrix.indptr, indices=self.matrix.indices,
+                data=self.matrix.data, neighbours=self.neighbours, scores=self.scores,
+            )
+        with open(os.path.join(path, 'vocabulary.json.tmp'), 'w') as f:
+            json.dump({'built_at': self.built_at.isoformat(), 'vocabulary': self.vocabulary}, f)
+        # The vocabulary is replaced last, and only read along with matching vectors
+        os.replace(os.path.join(path, 'vectors.npz.tmp'), os.path.join(path, 'vectors.npz'))
+        os.replace(os.path.join(path, 'vocabulary.json.tmp'), os.path.join(path, 'vocabulary.json'))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the saved index, or None if there is none.
+        """
+        try:
+            with open(os.path.join(path, 'vocabulary.json')) as f:
+                meta = json.load(f)
+            arrays = np.load(os.path.join(path, 'vectors.npz'))
+        except FileNotFoundError:
+            return None
+        if len(arrays['idf']) != len(meta['vocabulary']):
+            return None
+        return cls(
+            parse_datetime(meta['built_at']), meta['vocabulary'], arrays['idf'], arrays['page_ids'],
+            Matrix(arrays['indptr'], arrays['indices'], arrays['data'], len(arrays['idf'])),
+            arrays['neighbours'], arrays['scores'],
+        )
+
+
+def neighbour_ids(page_ids, matrix, rows, k, block_size):
+    """
+    nearest(), with the neighbours as page ids.
+    """
+    found, scores = nearest(matrix, rows, k, block_size)
+    return np.where(found >= 0, page_ids[found], -1), scores
+
+
+def neighbour_lists(index, rows):
+    """
+    Returns {page id: [(related page id, score), ...]} for the given rows.
+    """
+    return {
+        int(index.page_ids[row]): [
+            (int(page_id), float(score))
+            for page_id, score in zip(index.neighbours[row], index.scores[row]) if page_id >= 0
+        ]
+        for row in rows
+    }
+
+
+def store(related, removed_ids=()):
+    """
+    Replaces the RelatedPost rows of the pages in related, a dict of page id
+    -> [(related page id, score), ...], and of the removed pages, keeping
+    those that have not changed. Returns the ids of the live pages whose
+    related posts changed.
+    """
+    current = {}
+    for page_id, related_id, score in RelatedPost.objects.filter(
+        page_id__in=[*related, *removed_ids]
+    ).values_list('page_id', 'related_id', 'score'):
+        current.setdefault(page_id, []).append((related_id, score))
+
+    def unchanged(page_id):
+        old = sorted(current.get(page_id, []), key=lambda item: (-item[1], item[0]))
+        new = related[page_id]
+        return [i for i, _ in old] == [i for i, _ in new] and all(
+            math.isclose(a, b, abs_tol=1e-6) for (_, a), (_, b) in zip(old, new)
+        )
+
+    changed = [page_id for page_id in related if not unchanged(page_id)]
+    with transaction.atomic():
+        RelatedPost.objects.filter(page_id__in=[*changed, *removed_ids]).delete()
+        RelatedPost.objects.bulk_create([
+            RelatedPost(page_id=page_id, related_id=related_id, score=score)
+            for page_id in changed
+            for related_id, score in related[page_id]
+        ], batch_size=1000)
+    return changed
+
+
+def build(incremental=False):
+    """
+    Finds the related posts of every live post, or with incremental=True
+    those that may have changed since the last build, and stores them.
+    Returns the number of posts whose related posts changed.
+    """
+    path = index_dir()
+    k = getattr(settings, 'RELATED_POSTS_COUNT', 5)
+    block_size = getattr(settings, 'RELATED_POSTS_BLOCK_SIZE', 512)
+    started_at = timezone.now()
+
+    previous = RelatedIndex.load(path) if incremental else None
+    if previous is None or previous.neighbours.shape[1] != k:
+        page_ids, terms = load_terms(BlogPage.objects.live())
+        vocabulary, idf = build_vocabulary(terms, getattr(settings, 'RELATED_POSTS_MAX_FEATURES', 20000))
+        matrix = Matrix.from_terms(terms, {term: i for i, term in enumerate(vocabulary)}, idf)
+        page_ids = np.array(page_ids, dtype=np.int64)
+        index = RelatedIndex(
+            started_at, vocabulary, idf, page_ids, matrix,
+            *neighbour_ids(page_ids, matrix, np.arange(len(page_ids)), k, block_size),
+        )
+        index.save(path)
+        removed_ids = set(RelatedPost.objects.exclude(page_id__in=page_ids).values_list('page_id', flat=True))
+        changed = store(neighbour_lists(index, range(len(page_ids))), removed_ids)
+    else:
+        index, changed = update(previous, started_at, k, block_size)
+        index.save(path)
+
+    refresh_api_payloads(BlogPage.objects.live().filter(pk__in=changed))
+    return len(changed)
+
+
+def update(previous, started_at, k, block_size):
+    """
+    Returns the index updated for the posts published or removed since it
+    was built, and the ids of the pages whose related posts changed.
+    """
+    live_ids = set(BlogPage.objects.live().values_list('pk', flat=True))
+    changed_ids, terms = load_terms(BlogPage.objects.live().filter(last_published_at__gte=previous.built_at))
+    removed_ids = {int(page_id) for page_id in previous.page_ids if page_id not in live_ids}
+    gone = list(removed_ids | set(changed_ids))
+
+    # Keep the vectors of the posts that have not changed and add the others'
+    kept = np.flatnonzero(~np.isin(previous.page_ids, gone))
+    columns = {term: i for i, term in enumerate(previous.vocabulary)}
+    matrix = previous.matrix.take(kept).append(Matrix.from_terms(terms, columns, previous.idf))
+    page_ids = np.concatenate([previous.page_ids[kept], np.array(changed_ids, dtype=np.int64)])
+    neighbours = np.concatenate([previous.neighbours[kept], np.full((len(changed_ids), k), -1, dtype=np.int64)])
+    scores = np.concatenate([previous.scores[kept], np.zeros((len(changed_ids), k), dtype=np.float32)])
+
+    changed_rows = np.arange(len(kept), len(page_ids))
+    affected = np.zeros(len(page_ids), dtype=bool)
+    affected[changed_rows] = True
+    affected |= np.isin(neighbours, gone).any(axis=1)
+    affected |= closest_to(matrix, changed_rows, block_size) > scores[:, -1]
+    rows = np.flatnonzero(affected)
+    neighbours[rows], scores[rows] = neighbour_ids(page_ids, matrix, rows, k, block_size)
+
+    index = RelatedIndex(started_at, previous.vocabulary, previous.idf, page_ids, matrix, neighbours, scores)
+    return index, store(neighbour_lists(index, rows), removed_ids)
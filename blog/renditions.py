@@ -0,0 +1,183 @@
+"""
+Generates image renditions ahead of time, so the first visitor after a
+publish does not wait for Pillow. Which renditions are made is set by
+BLOG_RENDITION_SPECS, plus the responsive ones served by the API (one per
+BLOG_RESPONSIVE_WIDTHS width in each BLOG_RESPONSIVE_FORMATS format).
+Web processes make them on a background thread, or, with
+BLOG_RENDITION_WORKERS set, in a pool of that many processes.
+BLOG_RENDITION_BACKGROUND = False makes them inline instead, in the
+calling thread.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connections
+from wagtail.images import get_image_model
+
+from blog.media import versioned_url
+
+logger = logging.getLogger(__name__)
+
+# The renditions used by the blog templates
+DEFAULT_RENDITION_SPECS = ['fill-320x240', 'fill-160x100', 'fill-32x32']
+
+DEFAULT_RESPONSIVE_WIDTHS = [320, 640, 1024, 1600]
+DEFAULT_RESPONSIVE_FORMATS = ['avif', 'webp']
+
+
+def rendition_specs():
+    return getattr(settings, 'BLOG_RENDITION_SPECS', DEFAULT_RENDITION_SPECS)
+
+
+def responsive_specs(image):
+    """
+    Returns {format: [spec, ...]} for the image's width-bucketed renditions.
+    Buckets wider than the original collapse into one full-width rendition,
+    since Wagtail does not upscale.
+    """
+    widths = sorted(getattr(settings, 'BLOG_RESPONSIVE_WIDTHS', DEFAULT_RESPONSIVE_WIDTHS))
+    formats = getattr(settings, 'BLOG_RESPONSIVE_FORMATS', DEFAULT_RESPONSIVE_FORMATS)
+    buckets = [width for width in widths if width < image.width]
+    if len(buckets) < len(widths):
+        buckets.append(image.width)
+    return {fmt: [f'width-{width}|format-{fmt}' for width in buckets] for fmt in formats}
+
+
+def image_rendition_specs(image):
+    """
+    Every rendition spec that is generated ahead of time for the image.
+    """
+    specs = list(rendition_specs())
+    for format_specs in responsive_specs(image).values():
+        specs += format_specs
+    return specs
+
+
+def responsive_renditions(image):
+    """
+    Describes the image's responsive renditions for a srcset. Only those that
+    have been made are listed; missing ones are left to schedule_renditions,
+    which refreshes the payloads of the pages using the image once they exist.
+
+        {"width": 1080, "height": 720, "sources": [
+            {"type": "image/webp", "srcset": "... 320w, ... 640w",
+             "renditions": [{"url": ..., "width": 320, "height": 213}, ...]}]}
+    """
+    # Iterate rather than filter so prefetched renditions are reused
+    renditions = {rendition.filter_spec: rendition for rendition in image.renditions.all()}
+
+    sources = []
+    for fmt, format_specs in responsive_specs(image).items():
+        format_renditions = [
+            {"url": versioned_url(rendition.file), "width": rendition.width, "height": rendition.height}
+            for rendition in (renditions[spec] for spec in format_specs if spec in renditions)
+        ]
+        if format_renditions:
+            sources.append({
+                "type": f"image/{fmt}",
+                "srcset": ", ".join(f"{r['url']} {r['width']}w" for r in format_renditions),
+                "renditions": format_renditions,
+            })
+    return {"width": image.width, "height": image.height, "sources": sources}
+
+
+def rendition_workers():
+    return getattr(settings, 'BLOG_RENDITION_WORKERS', 0)
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def make_pool(processes):
+    # Spawned rather than forked, so no database connection is shared with the parent.
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'mysite.settings'),),
+    )
+
+
+def generate_renditions(image_id, specs=None):
+    """
+    Creates any missing renditions of the image, by default all of those in
+    image_rendition_specs(), and refreshes the API payloads that list them.
+    Returns how many specs the image now has renditions for.
+    """
+    from blog.api import refresh_api_payloads
+    from blog.models import BlogPage
+
+    try:
+        image = get_image_model().objects.get(pk=image_id)
+    except get_image_model().DoesNotExist:
+        return 0
+    specs = set(specs or image_rendition_specs(image))
+    missing = specs - set(image.renditions.filter(filter_spec__in=specs).values_list('filter_spec', flat=True))
+    if missing:
+        image.get_renditions(*missing)
+        refresh_api_payloads(BlogPage.objects.live().filter(gallery_images__image=image).distinct())
+    return len(specs)
+
+
+def warm_renditions(image_ids, specs=None, processes=None):
+    """
+    Generates renditions for many images, spread over a process pool.
+    Yields (image_id, error) as each image finishes, in the order they
+    finish.
+    """
+    processes = rendition_workers() if processes is None else processes
+    if not processes:
+        for image_id in image_ids:
+            try:
+                generate_renditions(image_id, specs)
+                yield image_id, None
+            except Exception as e:
+                yield image_id, e
+        return
+
+    with make_pool(processes) as pool:
+        futures = {pool.submit(generate_renditions, image_id, specs): image_id for image_id in image_ids}
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def log_failure(future):
+    if future.exception():
+        logger.error("Generating renditions failed: %s", future.exception())
+
+
+def generate_in_thread(image_id):
+    try:
+        generate_renditions(image_id)
+    finally:
+        # The thread outlives the request, so it must not keep a connection open
+        connections.close_all()
+
+
+def schedule_renditions(image_id):
+    """
+    Generates the image's renditions without blocking the caller, on a
+    thread or pool of processes shared by the whole process.
+    """
+    global _pool
+    processes = rendition_workers()
+    if not processes and not getattr(settings, 'BLOG_RENDITION_BACKGROUND', True):
+        generate_renditions(image_id)
+        return
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = make_pool(processes) if processes else ThreadPoolExecutor(1, thread_name_prefix='renditions')
+    task = generate_renditions if processes else generate_in_thread
+    _pool.submit(task, image_id).add_done_callback(log_failure)
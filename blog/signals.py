@@ -0,0 +1,186 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from wagtail.images import get_image_model
+from wagtail.signals import page_published, page_unpublished, post_page_move
+
+from blog import autocomplete, prerender
+from blog.api import refresh_api_payloads
+from blog.media import precompute_etag
+from blog.page_cache import PAGES_DEPENDENCY, dependencies_purged, page_dependency, purge
+from blog.models import Author, BlogCategory, BlogPage, BlogPageGalleryImage, BlogPageTag, BlogTagCount, Reference
+from blog.renditions import schedule_renditions
+
+# How each snippet is reached from a BlogPage
+SNIPPET_LOOKUPS = {
+    Author: 'author',
+    BlogCategory: 'categories',
+    Reference: 'references',
+}
+
+# The page cache dependency of the snippets that are shown on pages
+SNIPPET_DEPENDENCIES = {
+    Author: 'author',
+    BlogCategory: 'category',
+}
+
+
+def pages_using(instance):
+    lookup = SNIPPET_LOOKUPS[type(instance)]
+    return BlogPage.objects.live().filter(**{lookup: instance})
+
+
+def purge_snippet(instance):
+    if type(instance) in SNIPPET_DEPENDENCIES:
+        purge(f'{SNIPPET_DEPENDENCIES[type(instance)]}:{instance.pk}')
+
+
+def purge_page(page):
+    """
+    Purges the cached page, its parent index and, for a BlogPage, the
+    listings of its tags.
+    """
+    dependencies = [page_dependency(page.pk), page_dependency(page.get_parent().pk), PAGES_DEPENDENCY]
+    if isinstance(page, BlogPage):
+        dependencies += [f'tag:{tag.name}' for tag in page.tags.all()]
+    purge(*dependencies)
+
+
+@receiver(post_page_move)
+def page_moved(sender, instance, parent_page_before, **kwargs):
+    # The page and everything beneath it have new URLs, and the old parent
+    # no longer lists it
+    purge_page(instance)
+    purge(page_dependency(parent_page_before.pk),
+          *[page_dependency(pk) for pk in instance.get_descendants().values_list('pk', flat=True)])
+
+
+def pages_linking_to(page):
+    """The live posts that list the page among their related posts."""
+    return BlogPage.objects.live().filter(related_links__related=page).exclude(pk=page.pk).distinct()
+
+
+@receiver(page_published, sender=BlogPage)
+def blog_page_published(sender, instance, **kwargs):
+    refresh_api_payloads(BlogPage.objects.filter(pk=instance.pk))
+    refresh_api_payloads(pages_linking_to(instance))
+
+
+# Related posts are stored in the payloads with their titles and URLs
+@receiver(page_unpublished, sender=BlogPage)
+@receiver(post_page_move, sender=BlogPage)
+def blog_page_unpublished_or_moved(sender, instance, **kwargs):
+    refresh_api_payloads(pages_linking_to(instance))
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def page_changed(sender, instance, **kwargs):
+    purge_page(instance)
+
+
+def saved_tag_ids(page):
+    return set(BlogPageTag.objects.filter(content_object_id=page.pk).values_list('tag_id', flat=True))
+
+
+@receiver(pre_save, sender=BlogPage)
+def blog_page_saving(sender, instance, **kwargs):
+    # Publishing replaces the page's tags, so remember the ones it had for
+    # recounting them afterwards.
+    if instance.pk:
+        instance._blog_tag_ids = saved_tag_ids(instance)
+
+
+@receiver(page_published, sender=BlogPage)
+@receiver(page_unpublished, sender=BlogPage)
+def blog_page_tags_changed(sender, instance, **kwargs):
+    BlogTagCount.recount(getattr(instance, '_blog_tag_ids', set()) | saved_tag_ids(instance))
+
+
+@receiver(pre_delete, sender=BlogPage)
+def blog_page_deleting(sender, instance, **kwargs):
+    purge_page(instance)
+    autocomplete.page_removed(instance)
+    instance._blog_tag_ids = saved_tag_ids(instance)
+    instance._linking_page_ids = list(pages_linking_to(instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=BlogPage)
+def blog_page_deleted(sender, instance, **kwargs):
+    BlogTagCount.recount(getattr(instance, '_blog_tag_ids', set()))
+    refresh_api_payloads(BlogPage.objects.filter(pk__in=getattr(instance, '_linking_page_ids', [])))
+
+
+# After page_changed, so the autocomplete index is marked current after the purge
+@receiver(page_published, sender=BlogPage)
+@receiver(page_unpublished, sender=BlogPage)
+def blog_page_autocomplete(sender, instance, **kwargs):
+    if instance.live:
+        autocomplete.page_published(instance)
+    else:
+        autocomplete.page_removed(instance)
+
+
+@receiver(dependencies_purged)
+def prerendered_pages_purged(sender, dependencies, **kwargs):
+    prerender.invalidate(dependencies)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=BlogCategory)
+@receiver(post_save, sender=Reference)
+def snippet_saved(sender, instance, **kwargs):
+    refresh_api_payloads(pages_using(instance))
+    purge_snippet(instance)
+    if isinstance(instance, BlogCategory):
+        autocomplete.categories_changed()
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=BlogCategory)
+@receiver(pre_delete, sender=Reference)
+def snippet_deleting(sender, instance, **kwargs):
+    # The relations are gone by post_delete, so remember who used the snippet.
+    instance._blog_page_ids = list(pages_using(instance).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=BlogCategory)
+@receiver(post_delete, sender=Reference)
+def snippet_deleted(sender, instance, **kwargs):
+    page_ids = getattr(instance, '_blog_page_ids', [])
+    refresh_api_payloads(BlogPage.objects.filter(pk__in=page_ids))
+    purge_snippet(instance)
+    if isinstance(instance, BlogCategory):
+        autocomplete.categories_changed()
+
+
+@receiver(post_save, sender=BlogPageGalleryImage)
+@receiver(post_delete, sender=BlogPageGalleryImage)
+def gallery_image_changed(sender, instance, **kwargs):
+    refresh_api_payloads(BlogPage.objects.live().filter(pk=instance.page_id))
+
+
+def image_file_version(image):
+    return image.file.name, image.file_hash
+
+
+@receiver(pre_save, sender=get_image_model())
+def image_saving(sender, instance, **kwargs):
+    # Renditions only need making again when the file changes, not on every
+    # edit of the title or tags.
+    if instance.pk:
+        saved = sender.objects.filter(pk=instance.pk).values_list('file', 'file_hash').first()
+        instance._file_changed = saved != image_file_version(instance)
+
+
+@receiver(post_save, sender=get_image_model())
+def image_saved(sender, instance, created, **kwargs):
+    if created or getattr(instance, '_file_changed', True):
+        transaction.on_commit(lambda: schedule_renditions(instance.pk))
+        transaction.on_commit(lambda: precompute_etag(instance.file.name))
+
+
+@receiver(post_save, sender=get_image_model().get_rendition_model())
+def rendition_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: precompute_etag(instance.file.name))
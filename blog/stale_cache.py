@@ -0,0 +1,100 @@
+"""
+Stale-while-revalidate caching with stampede protection.
+
+A value is fresh for soft_ttl seconds and kept for hard_ttl. Past the soft
+TTL, or once it is no longer current, callers keep getting the stale value
+while one of them, holding a lock in the cache, recomputes it in a
+background thread. When there is no value at all, the lock holder computes
+it and the other callers wait for its result instead of computing their own.
+The lock is taken through blog/atomic_cache.py, so that only one worker
+process holds it with the file-based cache too.
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection
+
+from blog import atomic_cache
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'swr'
+
+# How often callers waiting on another caller's computation check for it
+WAIT_INTERVAL = 0.05
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='swr-refresh')
+    return _executor
+
+
+def acquire_lock(key, timeout):
+    token = uuid.uuid4().hex
+    if atomic_cache.add(f'{KEY_PREFIX}:lock:{key}', token, timeout):
+        return token
+    return None
+
+
+def release_lock(key, token):
+    atomic_cache.delete_if(f'{KEY_PREFIX}:lock:{key}', token)
+
+
+def store(key, value, soft_ttl, hard_ttl):
+    cache.set(f'{KEY_PREFIX}:value:{key}', {'value': value, 'stale_at': time.time() + soft_ttl}, hard_ttl)
+    return value
+
+
+def get_or_compute(key, compute, soft_ttl, hard_ttl, lock_timeout=30, is_current=None):
+    """
+    Returns the cached value for key, computing it with compute() when there
+    is none. A stale value, past soft_ttl or failing is_current(value), is
+    returned as is and refreshed in the background.
+    """
+    entry = cache.get(f'{KEY_PREFIX}:value:{key}')
+    if entry is not None:
+        stale = entry['stale_at'] <= time.time() or (is_current and not is_current(entry['value']))
+        if stale:
+            token = acquire_lock(key, lock_timeout)
+            if token:
+                get_executor().submit(refresh, key, token, compute, soft_ttl, hard_ttl)
+        return entry['value']
+
+    deadline = time.monotonic() + lock_timeout
+    while True:
+        token = acquire_lock(key, lock_timeout)
+        if token:
+            break
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(f'{KEY_PREFIX}:value:{key}')
+        if entry is not None:
+            return entry['value']
+        if time.monotonic() > deadline:
+            # Whoever holds the lock is taking too long; don't wait forever
+            return compute()
+
+    try:
+        return store(key, compute(), soft_ttl, hard_ttl)
+    finally:
+        release_lock(key, token)
+
+
+def refresh(key, token, compute, soft_ttl, hard_ttl):
+    try:
+        store(key, compute(), soft_ttl, hard_ttl)
+    except Exception:
+        logger.exception("Refreshing %s failed", key)
+    finally:
+        release_lock(key, token)
+        # Runs in a pool thread, which has its own connection
+        connection.close()
@@ -0,0 +1,41 @@
+"""
+WhiteNoise for both of Django's request paths.
+
+WhiteNoiseMiddleware only runs synchronously, so under ASGI Django would
+hand every request to a thread at that point in the middleware, async API
+views included, and bring the response back. StaticFilesMiddleware also
+runs in the async path: looking up and opening a static file is quick
+enough to do on the event loop.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        self.init_async_mode()
+
+    def init_async_mode(self):
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            # Django calls the instance directly, so __call__ switches to __acall__
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
@@ -1,3 +1,1760 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import Http404
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection
+from django.template import engines
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from wagtail.images.tests.utils import get_test_image_file
+from wagtail.images import get_image_model
+from wagtail.api.v2.views import PagesAPIViewSet
+from wagtail.models import Page, PageViewRestriction
+from wagtail.search.backends import get_search_backend
+from wagtail.search.models import Query, QueryDailyHits
+
+from blog import atomic_cache, autocomplete, prerender, query_budget, related, stale_cache
+from blog.jobs import claim, claim_job, claim_jobs, work_off
+from blog.media import serve_media, versioned_url
+from blog.renditions import generate_renditions
+from blog.warmup import warm_up
+from blog.pagination import keyset_paginate
+from blog.models import (
+    Author, BlogCategory, BlogIndexPage, BlogPage, BlogTagIndexPage, ImageJob, Reference, UnsplashSearch,
+    related_links_prefetch,
+)
+from blog.unsplash import (
+    AsyncUnsplashClient, InvalidImageError, UnsplashClient, download_image, fetch_unsplash_image,
+)
+from search import hits, result_cache
+from search.backends import bm25
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp()
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# The manifest only exists once collectstatic has run
+TEST_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+# AVIF encoding is slow, so only ResponsiveRenditionTests makes AVIF renditions
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, CACHES=TEST_CACHES, STORAGES=TEST_STORAGES,
+                   BLOG_RESPONSIVE_FORMATS=['webp'], API_LISTING_CACHE_HARD_TTL=0,
+                   PRERENDER_DIR=os.path.join(TEST_MEDIA_ROOT, 'prerendered'), QUERY_BUDGET_STRICT=True)
+class BlogTestCase(TestCase):
+
+    def setUp(self):
+        # Renditions are cached by image id, which the database may reuse between tests
+        cache.clear()
+        root = Page.objects.get(depth=2)
+        self.index = root.add_child(instance=BlogIndexPage(title='Blog', slug='blog'))
+        self.category = BlogCategory.objects.create(name='Economics')
+        self.reference = Reference.objects.create(title='A reference', url='https://example.com')
+        self.author = Author.objects.create(
+            user=User.objects.create(username='writer'), name='Writer', title='Editor'
+        )
+
+    def create_post(self, title, with_image=True, **kwargs):
+        slug = '-'.join(title.lower().split())
+        kwargs.setdefault('body', '<p>Body</p>')
+        kwargs.setdefault('date', '2025-01-03')
+        kwargs.setdefault('author', self.author)
+        post = self.index.add_child(instance=BlogPage(title=title, slug=slug, intro='Intro', **kwargs))
+        post.categories.add(self.category)
+        post.references.add(self.reference)
+        if with_image:
+            image = get_image_model().objects.create(title=title, file=get_test_image_file())
+            post.gallery_images.create(image=image)
+        post.save_revision().publish()
+        return BlogPage.objects.get(pk=post.pk)
+
+
+class BlogPagesAPITests(BlogTestCase):
+
+    def count_listing_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': '*'})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_listing_query_count_is_constant(self):
+        self.create_post('First post')
+        self.count_listing_queries()  # warm up the site root paths cache
+        few, data = self.count_listing_queries()
+        self.assertEqual(data['meta']['total_count'], 1)
+
+        for i in range(10):
+            self.create_post(f'Post {i}')
+        many, data = self.count_listing_queries()
+        self.assertEqual(data['meta']['total_count'], 11)
+        self.assertEqual(few, many)
+
+    def test_listing_fields(self):
+        self.create_post('First post')
+        _, data = self.count_listing_queries()
+        item = data['items'][0]
+        self.assertEqual(item['author_obj'], {'name': 'Writer', 'image': None, 'title': 'Editor'})
+        self.assertEqual(item['categories_str'], 'Economics')
+        self.assertEqual(item['references_serialized'][0]['title'], 'A reference')
+        self.assertTrue(item['main_image'].endswith('.png'))
+
+
+class APIPayloadTests(BlogTestCase):
+
+    def get_item(self):
+        response = self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': '*'})
+        return response.json()['items'][0]
+
+    def test_payload_stored_on_publish(self):
+        post = self.create_post('First post')
+        self.assertEqual(post.api_payload['categories_str'], 'Economics')
+        self.assertEqual(post.api_payload['author_obj']['name'], 'Writer')
+
+    def test_listing_is_a_single_read(self):
+        for i in range(3):
+            self.create_post(f'Post {i}')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': '*'})
+        tables = {'blog_blogcategory', 'blog_reference', 'blog_author', 'blog_blogpagegalleryimage'}
+        for query in queries:
+            self.assertFalse(any(table in query['sql'] for table in tables), query['sql'])
+
+    def test_snippet_edits_refresh_payload(self):
+        self.create_post('First post')
+        self.author.name = 'Renamed'
+        self.author.save()
+        self.category.name = 'Finance'
+        self.category.save()
+        self.reference.delete()
+
+        item = self.get_item()
+        self.assertEqual(item['author_obj']['name'], 'Renamed')
+        self.assertEqual(item['categories_str'], 'Finance')
+        self.assertEqual(item['references_serialized'], [])
+
+
+class CreateBlogsTests(BlogTestCase):
+
+    def post_data(self, i, draft=True):
+        return {
+            "date": "2025-01-03",
+            "draft": draft,
+            "intro": "Intro",
+            "body": "<p>Body</p>",
+            "title": f"Bulk post {i}",
+            "categories": [self.category.pk],
+            "references": [
+                {"author": "Bob Mackie", "title": "Shared reference", "url": "https://example.com/shared",
+                 "publication_date": "2025-01-03"},
+                {"author": None, "title": f"Reference {i}", "url": None, "publication_date": None},
+            ],
+        }
+
+    def test_creates_posts_with_per_item_results(self):
+        Reference.objects.create(title='Shared reference', author='Bob Mackie',
+                                 url='https://example.com/shared', publication_date='2025-01-03')
+        items = [self.post_data(0, False), {"title": "No date"}, self.post_data(1, False), self.post_data(0), "Post"]
+        response = self.client.post('/api/blog/create-blogs/', items, content_type='application/json')
+        results = response.json()['results']
+
+        self.assertEqual(results[1], {"error": "Date is required"})
+        self.assertIn("already in use", results[3]['error'])
+        self.assertEqual(results[4], {"error": "Expected a blog post object"})
+        posts = BlogPage.objects.filter(pk__in=[results[0]['id'], results[2]['id']])
+        self.assertEqual(posts.count(), 2)
+        for post in posts:
+            self.assertEqual(post.get_parent().pk, self.index.pk)
+            self.assertEqual(list(post.categories.all()), [self.category])
+            self.assertEqual(post.references.count(), 2)
+            self.assertEqual(post.api_payload['categories_str'], 'Economics')
+            self.assertEqual(post.image_jobs.get().status, ImageJob.PENDING)
+        self.assertEqual(Reference.objects.filter(title='Shared reference').count(), 1)
+
+        self.index.refresh_from_db()
+        self.assertEqual(self.index.numchild, 2)
+        self.assertEqual(self.index.get_children().count(), 2)
+        self.index.add_child(instance=BlogPage(title='After', slug='after', date='2025-01-03'))
+
+    def test_malformed_items_get_their_own_errors(self):
+        bad = [
+            {"references": [{"author": "Nobody"}]},
+            {"references": [{"title": "x" * 300}]},
+            {"references": [{"title": "A reference", "author": {"name": "Bob"}}]},
+            {"references": "Shared reference"},
+            {"categories": [{"id": self.category.pk}]},
+            {"categories": [[self.category.pk]]},
+        ]
+        items = [self.post_data(0)] + [{**self.post_data(i + 1), **fields} for i, fields in enumerate(bad)]
+        response = self.client.post('/api/blog/create-blogs/', items, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertIn('id', results[0])
+        self.assertIn("Invalid reference", results[1]['error'])
+        self.assertIn("Invalid reference", results[2]['error'])
+        self.assertEqual(results[3], {"error": "Reference fields must be strings"})
+        self.assertEqual(results[4], {"error": "References must be a list"})
+        self.assertEqual(results[5:], [{"error": "Categories must be a list of ids"}] * 2)
+        self.assertEqual(BlogPage.objects.count(), 1)
+
+    def test_fewer_queries_than_sequential_create_blog(self):
+        with CaptureQueriesContext(connection) as sequential:
+            for i in range(10):
+                self.client.post('/api/blog/create-blog/', self.post_data(i), content_type='application/json')
+        items = [self.post_data(i) for i in range(10, 20)]
+        with CaptureQueriesContext(connection) as bulk:
+            self.client.post('/api/blog/create-blogs/', items, content_type='application/json')
+        self.assertEqual(BlogPage.objects.count(), 20)
+        self.assertLess(len(bulk), len(sequential) / 2)
+
+    def test_full_batch_within_query_budget(self):
+        # QUERY_BUDGET_STRICT is on, so going over the budget would raise
+        items = [self.post_data(i) for i in range(settings.BLOG_CREATE_BATCH_LIMIT)]
+        response = self.client.post('/api/blog/create-blogs/', items, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(BlogPage.objects.count(), 500)
+
+    @override_settings(BLOG_CREATE_BATCH_LIMIT=2)
+    def test_batch_size_is_limited(self):
+        items = [self.post_data(i) for i in range(3)]
+        response = self.client.post('/api/blog/create-blogs/', items, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(BlogPage.objects.count(), 0)
+
+
+@override_settings(IMAGE_JOB_MAX_ATTEMPTS=2, IMAGE_JOB_RETRY_DELAY=0)
+class ImageJobTests(BlogTestCase):
+
+    def download(self, url, title, slug):
+        return get_image_model().objects.create(title=title, file=get_test_image_file())
+
+    def test_endpoint_only_enqueues(self):
+        post = self.create_post('First post', with_image=False)
+        with mock.patch('blog.jobs.search_unsplash') as search:
+            response = self.client.post('/api/blog/add-unsplash-image/', {'id': post.pk},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        search.assert_not_called()
+
+        job_id = response.json()['job']
+        response = self.client.get(f'/api/blog/image-jobs/{job_id}/')
+        self.assertEqual(response.json()['status'], ImageJob.PENDING)
+
+    def test_worker_adds_image_to_gallery(self):
+        post = self.create_post('First post', with_image=False)
+        job = ImageJob.objects.create(page=post, query=post.title)
+        with mock.patch('blog.jobs.search_unsplash', return_value='https://images.unsplash.com/x'), \
+                mock.patch('blog.jobs.download_image', side_effect=self.download):
+            self.assertEqual(work_off(), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImageJob.DONE)
+        self.assertEqual(post.gallery_images.get().image, job.image)
+        post.refresh_from_db()
+        self.assertTrue(post.api_payload['main_image'])
+
+    def test_failed_jobs_are_retried(self):
+        post = self.create_post('First post', with_image=False)
+        job = ImageJob.objects.create(page=post, query=post.title)
+        with mock.patch('blog.jobs.search_unsplash', side_effect=ConnectionError('timed out')):
+            work_off()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (ImageJob.PENDING, 1))
+            work_off()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (ImageJob.FAILED, 2))
+            self.assertEqual(job.error, 'timed out')
+
+    @override_settings(IMAGE_JOB_CONCURRENCY=1)
+    def test_concurrency_limit(self):
+        post = self.create_post('First post', with_image=False)
+        ImageJob.objects.create(page=post, query=post.title, status=ImageJob.RUNNING)
+        ImageJob.objects.create(page=post, query=post.title)
+        self.assertEqual(work_off(), 0)
+
+    @override_settings(IMAGE_JOB_CONCURRENCY=2)
+    def test_claims_stop_at_concurrency_limit(self):
+        post = self.create_post('First post', with_image=False)
+        for _ in range(3):
+            ImageJob.objects.create(page=post, query=post.title)
+        self.assertEqual(len(claim_jobs(10)), 2)
+        self.assertEqual(claim_jobs(10), [])
+        self.assertEqual(ImageJob.objects.filter(status=ImageJob.RUNNING).count(), 2)
+
+    def test_jobs_claimed_elsewhere_are_not_claimed_again(self):
+        post = self.create_post('First post', with_image=False)
+        job = ImageJob.objects.create(page=post, query=post.title, status=ImageJob.RUNNING, attempts=1)
+        # As if another worker claimed it after this one read it as due
+        self.assertEqual(claim(ImageJob.objects.filter(pk=job.pk), timezone.now()), [])
+        self.assertEqual(ImageJob.objects.get(pk=job.pk).attempts, 1)
+
+    def test_worker_survives_database_errors(self):
+        out = StringIO()
+        command = 'blog.management.commands.run_image_worker'
+        with mock.patch(f'{command}.claim_jobs', side_effect=[OperationalError('gone away'), []]) as claim_jobs, \
+                mock.patch(f'{command}.connection'), mock.patch(f'{command}.time.sleep') as sleep, \
+                self.assertLogs(command, 'ERROR'):
+            call_command('run_image_worker', once=True, stdout=out)
+        self.assertEqual(claim_jobs.call_count, 2)
+        sleep.assert_called_once()
+        self.assertIn("Image worker stopped", out.getvalue())
+
+    @override_settings(IMAGE_JOB_CONCURRENCY=1)
+    def test_claim_job_respects_concurrency_limit(self):
+        post = self.create_post('First post', with_image=False)
+        first, second = [ImageJob.objects.create(page=post, query=post.title) for _ in range(2)]
+        self.assertEqual(claim_job(first), first)
+        self.assertIsNone(claim_job(second))
+        self.assertIsNone(claim_job(first))
+        self.assertEqual(ImageJob.objects.get(pk=first.pk).attempts, 1)
+
+
+class KeysetPaginationTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.posts = [self.create_post(f'Post {i}', with_image=False) for i in range(7)]
+        # Ties on first_published_at are broken by id
+        Page.objects.filter(pk__in=[post.pk for post in self.posts[2:5]]).update(
+            first_published_at=self.posts[2].first_published_at
+        )
+        self.expected = [post.pk for post in sorted(
+            BlogPage.objects.filter(pk__in=[post.pk for post in self.posts]),
+            key=lambda post: (post.first_published_at, post.id), reverse=True
+        )]
+
+    def test_api_walks_every_post_once(self):
+        seen = []
+        query_counts = []
+        params = {'limit': 2}
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get('/api/blog/posts/', params).json()
+            query_counts.append(len(queries))
+            seen += [item['id'] for item in data['items']]
+            if not data['next']:
+                break
+            params['cursor'] = data['next']
+
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(len(set(query_counts[1:])), 1)
+        self.assertEqual(data['items'][-1]['categories_str'], 'Economics')
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/blog/posts/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_page_context(self):
+        self.index.posts_per_page = 4
+        request = RequestFactory().get('/blog/')
+        context = self.index.get_context(request)
+        self.assertEqual([post.pk for post in context['blogpages']], self.expected[:4])
+
+        request = RequestFactory().get('/blog/', {'cursor': context['next_cursor']})
+        context = self.index.get_context(request)
+        self.assertEqual([post.pk for post in context['blogpages']], self.expected[4:])
+        self.assertIsNone(context['next_cursor'])
+
+        with self.assertRaises(Http404):
+            self.index.get_context(RequestFactory().get('/blog/', {'cursor': 'bad'}))
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class BlogIndexPageRenderTests(BlogTestCase):
+
+    def render_index(self):
+        self.client.get('/blog/')  # generate any missing renditions first
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/blog/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.content.decode()
+
+    def test_excerpt_generated_on_save(self):
+        post = self.create_post('First post', body='<p>Markets &amp; <b>bonds</b></p><p>' + 'word ' * 200 + '</p>')
+        self.assertTrue(post.excerpt.startswith('Markets & bonds word'))
+        self.assertLessEqual(len(post.excerpt), post.excerpt_length)
+
+    def test_render_cost_independent_of_post_count_and_length(self):
+        for i in range(2):
+            self.create_post(f'Post {i}')
+        few, _ = self.render_index()
+        for i in range(2, 8):
+            self.create_post(f'Post {i}', body='<p>' + 'Lorem ipsum dolor. ' * 2000 + '</p>')
+        many, content = self.render_index()
+
+        self.assertEqual(few, many)
+        self.assertIn('Post 7', content)
+        self.assertIn('Lorem ipsum dolor.', content)
+        self.assertLess(len(content), 20000)
+
+
+class PageCacheTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.post = self.create_post('First post')
+        self.tags_page = self.index.add_child(instance=BlogTagIndexPage(title='Tags', slug='tags'))
+
+    def assertCache(self, url, status):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Page-Cache'], status)
+        return response.content.decode()
+
+    def test_hit_after_miss(self):
+        with CaptureQueriesContext(connection) as miss:
+            self.assertCache('/blog/first-post/', 'MISS')
+        # Only Wagtail's routing runs on a hit; the page is not rendered
+        with CaptureQueriesContext(connection) as hit:
+            self.assertCache('/blog/first-post/', 'HIT')
+        self.assertLess(len(hit), len(miss))
+        self.assertFalse([q for q in hit.captured_queries if 'blog_blogcategory' in q['sql']])
+        self.assertEqual(self.client.get('/api/blog/page-cache/').json(), {'hits': 1, 'misses': 1})
+
+    def test_keyed_by_listed_query_params_only(self):
+        self.assertCache('/blog/', 'MISS')
+        self.assertCache('/blog/?utm_source=feed', 'HIT')
+        self.post.tags.add('bonds')
+        self.post.save_revision().publish()
+        self.assertIn('First post', self.assertCache('/blog/tags/?tag=bonds', 'MISS'))
+        self.assertCache('/blog/tags/?tag=bonds', 'HIT')
+        self.assertCache('/blog/tags/?tag=stocks', 'MISS')
+
+    def test_publish_purges_page_and_index(self):
+        self.assertCache('/blog/first-post/', 'MISS')
+        self.assertCache('/blog/', 'MISS')
+        self.create_post('Second post')
+        self.assertCache('/blog/first-post/', 'HIT')
+        self.assertIn('Second post', self.assertCache('/blog/', 'MISS'))
+
+        self.post.title = 'Renamed post'
+        self.post.save_revision().publish()
+        self.assertIn('Renamed post', self.assertCache('/blog/first-post/', 'MISS'))
+        self.assertIn('Renamed post', self.assertCache('/blog/', 'MISS'))
+
+    def test_move_purges_page_and_both_parents(self):
+        news = Page.objects.get(depth=2).add_child(instance=BlogIndexPage(title='News', slug='news'))
+        self.assertCache('/blog/', 'MISS')
+        self.assertCache('/news/', 'MISS')
+        self.assertCache('/blog/first-post/', 'MISS')
+        self.post.move(news, pos='last-child')
+        self.assertNotIn('First post', self.assertCache('/blog/', 'MISS'))
+        self.assertIn('First post', self.assertCache('/news/', 'MISS'))
+        self.assertEqual(self.client.get('/blog/first-post/').status_code, 404)
+        self.assertCache('/news/first-post/', 'MISS')
+
+    def test_restricted_pages_are_not_shared(self):
+        restriction = PageViewRestriction.objects.create(
+            page=self.post, restriction_type=PageViewRestriction.PASSWORD, password='secret'
+        )
+        self.client.post(
+            reverse('wagtailcore_authenticate_with_password', args=[restriction.pk, self.post.pk]),
+            {'password': 'secret', 'return_url': '/blog/first-post/'},
+        )
+        for _ in range(2):
+            response = self.client.get('/blog/first-post/')
+            self.assertContains(response, 'First post')
+            self.assertNotIn('X-Page-Cache', response)
+            self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertEqual(self.client.get('/api/blog/page-cache/').json(), {'hits': 0, 'misses': 0})
+
+    def test_publish_purges_tag_listing(self):
+        self.post.tags.add('bonds')
+        self.post.save_revision().publish()
+        self.assertCache('/blog/tags/?tag=bonds', 'MISS')
+        self.assertCache('/blog/tags/?tag=bonds', 'HIT')
+        self.post.unpublish()
+        self.assertCache('/blog/tags/?tag=bonds', 'MISS')
+
+    def test_snippet_edit_purges_pages_showing_it(self):
+        self.assertCache('/blog/first-post/', 'MISS')
+        self.author.name = 'Renamed writer'
+        self.author.save()
+        self.assertCache('/blog/first-post/', 'MISS')
+
+        self.category.name = 'Finance'
+        self.category.save()
+        self.assertIn('Finance', self.assertCache('/blog/first-post/', 'MISS'))
+        other = BlogCategory.objects.create(name='Other')
+        other.save()
+        self.assertCache('/blog/first-post/', 'HIT')
+
+    def test_not_cached_for_logged_in_users(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get('/blog/first-post/')
+        self.assertNotIn('X-Page-Cache', response)
+
+
+class ConditionalGetTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.post = self.create_post('First post')
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_page_not_modified(self):
+        response = self.client.get('/blog/first-post/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('s-maxage', response['Cache-Control'])
+        self.assertIn('page:%d' % self.post.pk, response['Surrogate-Key'].split())
+        self.assertIn('Last-Modified', response)
+
+        with CaptureQueriesContext(connection) as queries:
+            revalidated = self.revalidate('/blog/first-post/', response)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        self.assertFalse([q for q in queries.captured_queries if 'blog_blogcategory' in q['sql']])
+
+        self.category.name = 'Finance'
+        self.category.save()
+        self.assertEqual(self.revalidate('/blog/first-post/', response).status_code, 200)
+
+    def test_index_revalidates_after_publish(self):
+        response = self.client.get('/blog/')
+        self.assertEqual(self.revalidate('/blog/', response).status_code, 304)
+        self.create_post('Second post')
+        self.assertEqual(self.revalidate('/blog/', response).status_code, 200)
+
+    def test_api_listing_not_modified_before_serialization(self):
+        url = '/api/v2/pages/'
+        params = {'type': 'blog.BlogPage', 'fields': '*'}
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Surrogate-Key'], 'pages')
+
+        with mock.patch('wagtail.api.v2.views.PagesAPIViewSet.listing_view') as listing_view:
+            self.assertEqual(self.revalidate(url, response, **params).status_code, 304)
+        listing_view.assert_not_called()
+        # Different parameters are a different response
+        self.assertEqual(self.revalidate(url, response, type='blog.BlogPage').status_code, 200)
+
+        self.author.name = 'Renamed writer'
+        self.author.save()
+        self.assertEqual(self.revalidate(url, response, **params).status_code, 200)
+
+    def test_api_detail_not_modified(self):
+        url = f'/api/v2/pages/{self.post.pk}/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        # Another representation of the page has another validator
+        self.assertEqual(self.revalidate(url, response, fields='title').status_code, 200)
+
+        self.post.intro = 'New intro'
+        self.post.save_revision().publish()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+
+class SearchTestCase(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        result_cache.results.clear()
+        self.addCleanup(hits.buffer.flush)
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        backends = override_settings(SEARCH_BACKEND='bm25', WAGTAILSEARCH_BACKENDS={
+            'default': {'BACKEND': 'wagtail.search.backends.database'},
+            'bm25': {'BACKEND': 'search.backends.bm25', 'INDEX_DIR': index_dir, 'AUTO_UPDATE': False},
+        })
+        backends.enable()
+        self.addCleanup(backends.disable)
+        self.backend = get_search_backend('bm25')
+        # Deploys build the index before serving, see update_index_if_missing
+        call_command('update_index', backend_name='bm25', stdout=StringIO())
+
+    def search(self, query, **kwargs):
+        return [page.title for page in Page.objects.live().search(query, backend='bm25', **kwargs)]
+
+    def publish(self, title, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.create_post(title, with_image=False, **kwargs)
+
+
+class BM25SearchTests(SearchTestCase):
+
+    def test_ranking(self):
+        self.create_post('Bond markets', with_image=False, body='<p>Yields rose.</p>')
+        self.create_post('Equities', with_image=False, body='<p>Stocks fell while bond yields rose.</p>')
+        self.create_post('Housing', with_image=False, body='<p>Prices are flat.</p>')
+        call_command('update_index', backend_name='bm25', stdout=StringIO())
+
+        # Title matches are boosted
+        self.assertEqual(self.search('bond'), ['Bond markets', 'Equities'])
+        self.assertEqual(self.search('bond yields stocks')[0], 'Equities')
+        self.assertEqual(self.search('bond prices'), ['Housing', 'Bond markets', 'Equities'])
+        self.assertEqual(self.search('bond prices', operator='and'), [])
+        self.assertEqual(self.search('unknown'), [])
+
+    def test_publish_and_unpublish_update_the_index(self):
+        self.create_post('Bond markets', with_image=False)
+        call_command('update_index', backend_name='bm25', stdout=StringIO())
+        post = self.publish('Bond auctions')
+        self.assertEqual(sorted(self.search('bond')), ['Bond auctions', 'Bond markets'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.unpublish()
+        self.assertEqual(self.search('bond'), ['Bond markets'])
+
+        # A fresh process reads the segment and replays its delta log
+        bm25._readers.clear()
+        self.assertEqual(self.search('bond'), ['Bond markets'])
+
+        # Rebuilding folds the log into a new segment
+        self.publish('Bond funds')
+        call_command('update_index', backend_name='bm25', stdout=StringIO())
+        self.assertEqual(sorted(self.search('bond')), ['Bond funds', 'Bond markets'])
+
+    def test_search_view(self):
+        self.publish('Bond markets')
+        response = self.client.get('/search/', {'query': 'bond'})
+        self.assertContains(response, 'Bond markets')
+
+    def test_database_backend_used_until_the_index_is_built(self):
+        shutil.rmtree(self.backend.index_dir)
+        self.publish('Bond markets')
+        # Publishing does not start an index that would hold only this page
+        self.assertFalse(self.backend.is_built())
+        self.assertContains(self.client.get('/search/', {'query': 'bond'}), 'Bond markets')
+
+        out = StringIO()
+        call_command('update_index_if_missing', stdout=out)
+        self.assertTrue(self.backend.is_built())
+        self.assertEqual(self.search('bond'), ['Bond markets'])
+        call_command('update_index_if_missing', stdout=out)
+        self.assertIn("The bm25 index is already built", out.getvalue())
+
+    def test_changes_during_the_first_build_are_kept(self):
+        shutil.rmtree(self.backend.index_dir)
+        self.publish('Bond markets')
+        rebuilder = self.backend.rebuilder_class(self.backend.index)
+        index = rebuilder.start()
+        index.add_items(BlogPage, BlogPage.objects.live())
+        # Published and unpublished after the build read the pages
+        self.publish('Bond funds')
+        with self.captureOnCommitCallbacks(execute=True):
+            BlogPage.objects.get(title='Bond markets').unpublish()
+        rebuilder.finish()
+        self.assertEqual(self.search('bond'), ['Bond funds'])
+        self.assertFalse(os.path.exists(os.path.join(self.backend.index_dir, bm25.PENDING_LOG)))
+
+
+class SearchResultCacheTests(SearchTestCase):
+
+    def setUp(self):
+        super().setUp()
+        search = mock.patch.object(bm25.BM25SearchBackend, 'search', autospec=True, side_effect=bm25.BM25SearchBackend.search)
+        self.backend_search = search.start()
+        self.addCleanup(search.stop)
+
+    def test_repeated_queries_served_from_cache(self):
+        self.publish('Bond markets')
+        self.assertContains(self.client.get('/search/', {'query': 'Bond'}), 'Bond markets')
+        self.assertContains(self.client.get('/search/', {'query': '  bond '}), 'Bond markets')
+        self.assertEqual(self.backend_search.call_count, 1)
+
+    def test_publish_invalidates(self):
+        self.publish('Bond markets')
+        self.client.get('/search/', {'query': 'bond'})
+        self.publish('Bond auctions')
+        self.assertContains(self.client.get('/search/', {'query': 'bond'}), 'Bond auctions')
+        self.assertEqual(self.backend_search.call_count, 2)
+
+    @override_settings(SEARCH_CACHE_SIZE=2)
+    def test_least_recently_used_query_evicted(self):
+        for query in ['bond', 'stocks', 'bond', 'gilts', 'bond', 'stocks']:
+            result_cache.search_page_ids(query, 'bm25')
+        # stocks was evicted by gilts, bond never was
+        self.assertEqual(self.backend_search.call_count, 4)
+
+    def test_results_page_loaded_in_one_query(self):
+        posts = [self.publish(f'Bond issue {i}') for i in range(12)]
+        page_ids = result_cache.search_page_ids('bond', 'bm25')
+        self.assertCountEqual(page_ids, [post.pk for post in posts])
+        with self.assertNumQueries(1):
+            pages = result_cache.load_pages(page_ids[:10])
+        self.assertEqual([page.pk for page in pages], page_ids[:10])
+
+
+@override_settings(SEARCH_HITS_FLUSH_SIZE=5, SEARCH_HITS_FLUSH_INTERVAL=3600)
+class SearchHitTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(hits.buffer.flush)
+
+    def daily_hits(self, query_string):
+        return QueryDailyHits.objects.get(query__query_string=query_string).hits
+
+    def test_hits_written_in_batches(self):
+        for query in ['Bonds', ' bonds ', 'stocks', 'BONDS']:
+            self.client.get('/search/', {'query': query})
+        self.assertFalse(Query.objects.exists())
+
+        # The fifth hit fills the batch, written in five statements however many queries it holds
+        with self.assertNumQueries(7):
+            hits.record_hit('gilts')
+        self.assertEqual(self.daily_hits('bonds'), 3)
+        self.assertEqual(self.daily_hits('stocks'), 1)
+        self.assertEqual(self.daily_hits('gilts'), 1)
+
+    def test_hits_added_to_existing_counts(self):
+        QueryDailyHits.objects.create(query=Query.objects.create(query_string='bonds'), date=timezone.now().date(), hits=3)
+        hits.record_hit('bonds')
+        hits.record_hit('Bonds')
+        hits.buffer.flush()
+        self.assertEqual(self.daily_hits('bonds'), 5)
+
+    def test_hits_kept_when_a_flush_fails(self):
+        hits.record_hit('bonds')
+        with mock.patch('search.hits.write_hits', side_effect=DatabaseError), self.assertLogs('search.hits'):
+            hits.buffer.flush()
+        self.assertFalse(Query.objects.exists())
+        hits.buffer.flush()
+        self.assertEqual(self.daily_hits('bonds'), 1)
+
+
+class FacetedListingTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.finance = BlogCategory.objects.create(name='Finance')
+        self.other_author = Author.objects.create(user=User.objects.create(username='other'), name='Other')
+        self.bonds = self.create_post('Bonds', with_image=False, date='2025-01-01')
+        self.bonds.tags.add('bonds', 'rates')
+        self.bonds.save_revision().publish()
+        self.stocks = self.create_post('Stocks', with_image=False, date='2025-02-01', author=self.other_author)
+        self.stocks.categories.add(self.finance)
+        self.stocks.tags.add('stocks')
+        self.stocks.save_revision().publish()
+        self.draft = self.create_post('Draft', with_image=False)
+        self.draft.tags.add('bonds')
+        self.draft.save_revision().publish()
+        self.draft.unpublish()
+
+    def get(self, **params):
+        response = self.client.get('/api/blog/posts/', {'facets': 1, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def titles(self, data):
+        return sorted(item['title'] for item in data['items'])
+
+    def test_filters_combine(self):
+        self.assertEqual(self.titles(self.get()), ['Bonds', 'Stocks'])
+        self.assertEqual(self.titles(self.get(category=self.finance.pk)), ['Stocks'])
+        self.assertEqual(self.titles(self.get(tag=['bonds', 'stocks'])), ['Bonds', 'Stocks'])
+        self.assertEqual(self.titles(self.get(tag='bonds', author=self.other_author.pk)), [])
+        self.assertEqual(self.titles(self.get(author=self.author.pk, category=self.category.pk)), ['Bonds'])
+        self.assertEqual(self.titles(self.get(date_from='2025-01-15')), ['Stocks'])
+        self.assertEqual(self.titles(self.get(date_to='2025-01-15')), ['Bonds'])
+
+    def test_invalid_filters(self):
+        self.assertEqual(self.client.get('/api/blog/posts/', {'author': 'me'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/blog/posts/', {'date_from': 'yesterday'}).status_code, 400)
+
+    def test_facet_counts(self):
+        facets = self.get()['facets']
+        self.assertEqual(facets['category'], [
+            {'id': self.category.pk, 'name': 'Economics', 'count': 2},
+            {'id': self.finance.pk, 'name': 'Finance', 'count': 1},
+        ])
+        self.assertEqual(facets['tag'], [
+            {'name': 'bonds', 'count': 1}, {'name': 'rates', 'count': 1}, {'name': 'stocks', 'count': 1},
+        ])
+        self.assertEqual(facets['author'], [
+            {'id': self.other_author.pk, 'name': 'Other', 'count': 1},
+            {'id': self.author.pk, 'name': 'Writer', 'count': 1},
+        ])
+
+    def test_facets_ignore_their_own_filter(self):
+        facets = self.get(category=self.finance.pk)['facets']
+        self.assertEqual([item['count'] for item in facets['category']], [2, 1])
+        self.assertEqual(facets['tag'], [{'name': 'stocks', 'count': 1}])
+        self.assertEqual(facets['author'], [{'id': self.other_author.pk, 'name': 'Other', 'count': 1}])
+
+    def test_facets_are_one_query(self):
+        self.client.get('/api/blog/posts/')  # warm up the site root paths cache
+        with CaptureQueriesContext(connection) as without:
+            self.client.get('/api/blog/posts/', {'tag': 'bonds'})
+        with CaptureQueriesContext(connection) as faceted:
+            self.client.get('/api/blog/posts/', {'tag': 'bonds', 'facets': 1})
+        self.assertEqual(len(faceted), len(without) + 1)
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class BlogTagPageTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tags_page = self.index.add_child(instance=BlogTagIndexPage(title='Tags', slug='tags'))
+
+    def create_tagged_post(self, title, *tags):
+        post = self.create_post(title, with_image=False)
+        post.tags.add(*tags)
+        post.save_revision().publish()
+        return post
+
+    def cloud(self):
+        response = self.client.get('/api/blog/tags/')
+        self.assertEqual(response.status_code, 200)
+        return {item['name']: item['count'] for item in response.json()['items']}
+
+    def test_paginated_live_posts_only(self):
+        for i in range(3):
+            self.create_tagged_post(f'Post {i}', 'bonds')
+        self.create_tagged_post('Withdrawn post', 'bonds').unpublish()
+
+        with mock.patch.object(BlogTagIndexPage, 'posts_per_page', 2):
+            response = self.client.get('/blog/tags/', {'tag': 'bonds'})
+            self.assertEqual([post.title for post in response.context['blogpages']], ['Post 2', 'Post 1'])
+            response = self.client.get('/blog/tags/', {'tag': 'bonds', 'cursor': response.context['next_cursor']})
+            self.assertEqual([post.title for post in response.context['blogpages']], ['Post 0'])
+            self.assertIsNone(response.context['next_cursor'])
+        self.assertEqual(self.client.get('/blog/tags/', {'tag': 'bonds', 'cursor': 'nonsense'}).status_code, 404)
+
+    def test_query_count_is_constant(self):
+        self.create_tagged_post('First post', 'bonds')
+        self.client.get('/blog/tags/', {'tag': 'bonds'})  # warm up the site root paths cache
+        with CaptureQueriesContext(connection) as one:
+            response = self.client.get('/blog/tags/', {'tag': 'bonds'})
+        self.assertContains(response, 'By Writer')
+        for i in range(4):
+            self.create_tagged_post(f'Post {i}', 'bonds')
+        with CaptureQueriesContext(connection) as five:
+            response = self.client.get('/blog/tags/', {'tag': 'bonds'})
+        self.assertEqual(len(response.context['blogpages']), 5)
+        self.assertEqual(len(one), len(five))
+
+    def test_tag_counts_follow_publishing(self):
+        first = self.create_tagged_post('First post', 'bonds', 'stocks')
+        self.create_tagged_post('Second post', 'bonds')
+        self.assertEqual(self.cloud(), {'bonds': 2, 'stocks': 1})
+
+        first.tags.set(['gilts'])
+        first.save_revision().publish()
+        self.assertEqual(self.cloud(), {'bonds': 1, 'gilts': 1})
+
+        first.unpublish()
+        self.assertEqual(self.cloud(), {'bonds': 1})
+        first.save_revision().publish()
+        BlogPage.objects.get(title='Second post').delete()
+        self.assertEqual(self.cloud(), {'gilts': 1})
+
+    def test_tag_cloud_reads_the_count_table(self):
+        self.create_tagged_post('First post', 'bonds', 'stocks')
+        self.create_tagged_post('Second post', 'bonds')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/blog/tags/', {'limit': 1})
+        self.assertEqual(response.json(), {'items': [{'name': 'bonds', 'slug': 'bonds', 'count': 2}]})
+        self.assertFalse([q for q in queries.captured_queries if 'blog_blogpagetag' in q['sql']])
+
+
+class RelatedPostsTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        overrides = override_settings(RELATED_POSTS_DIR=index_dir, RELATED_POSTS_COUNT=2, RELATED_POSTS_BLOCK_SIZE=2)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.posts = {
+            title: self.create_post(title, with_image=False, body=f'<p>{body}</p>')
+            for title, body in [
+                ('Bond yields rise', 'Bond markets sold off as yields rose on inflation fears.'),
+                ('Bond markets slump', 'Bond markets fell again; yields are at a decade high.'),
+                ('Inflation and bonds', 'Inflation fears push bond yields higher.'),
+                ('Stocks rally', 'Stock markets rallied on strong earnings from tech shares.'),
+                ('Tech shares climb', 'Tech shares led the stock rally after earnings.'),
+            ]
+        }
+
+    def related(self):
+        return {
+            page.title: [post.title for post in page.related_posts()]
+            for page in BlogPage.objects.live().prefetch_related(related_links_prefetch())
+        }
+
+    def test_nearest_is_exact(self):
+        rng = np.random.default_rng(1)
+        terms = [Counter({f'w{i}': int(rng.integers(1, 4)) for i in rng.choice(30, 6)}) for _ in range(23)]
+        vocabulary, idf = related.build_vocabulary(terms, 100)
+        matrix = related.Matrix.from_terms(terms, {term: i for i, term in enumerate(vocabulary)}, idf)
+
+        neighbours, scores = related.nearest(matrix, np.arange(len(terms)), 3, block_size=4)
+
+        dense = matrix.dense(np.arange(len(terms)))
+        similarity = dense @ dense.T
+        np.fill_diagonal(similarity, 0)
+        np.testing.assert_allclose(scores, -np.sort(-similarity, axis=1)[:, :3], rtol=1e-5)
+        np.testing.assert_allclose(np.take_along_axis(similarity, neighbours, axis=1), scores, rtol=1e-5)
+
+    def test_build(self):
+        self.assertEqual(related.build(), 5)
+        found = self.related()
+        self.assertEqual(sorted(found['Bond yields rise']), ['Bond markets slump', 'Inflation and bonds'])
+        self.assertEqual(found['Stocks rally'][0], 'Tech shares climb')
+        # Nothing changed, so nothing is rewritten
+        self.assertEqual(related.build(), 0)
+
+    def test_api_field_and_template(self):
+        call_command('build_related_posts', stdout=StringIO())
+        post = self.posts['Stocks rally']
+        response = self.client.get(f'/api/v2/pages/{post.pk}/')
+        self.assertEqual(response.json()['related_posts'][0]['title'], 'Tech shares climb')
+        response = self.client.get('/blog/stocks-rally/')
+        self.assertEqual(response.context['related_posts'][0].title, 'Tech shares climb')
+        self.assertContains(response, 'Related articles')
+
+    def test_api_field_follows_related_posts(self):
+        call_command('build_related_posts', stdout=StringIO())
+        post, related = self.posts['Stocks rally'], self.posts['Tech shares climb']
+
+        def related_titles():
+            return [item['title'] for item in self.client.get(f'/api/v2/pages/{post.pk}/').json()['related_posts']]
+
+        related.title = 'Tech shares soar'
+        related.save_revision().publish()
+        self.assertEqual(related_titles()[0], 'Tech shares soar')
+        related.unpublish()
+        self.assertNotIn('Tech shares soar', related_titles())
+        related.save_revision().publish()
+        related.delete()
+        self.assertNotIn('Tech shares soar', related_titles())
+
+    def test_incremental_build(self):
+        self.create_post('Roses in bloom', with_image=False, body='<p>Prune roses early for summer blooms.</p>')
+        self.create_post('Pruning roses', with_image=False, body='<p>Summer pruning keeps roses in bloom.</p>')
+        related.build()
+        new = self.create_post(
+            'Stock rally fades', with_image=False, body='<p>Tech stock shares gave back the rally.</p>'
+        )
+        self.posts['Bond markets slump'].unpublish()
+
+        recomputed = []
+        nearest = related.nearest
+
+        def recording_nearest(matrix, rows, k, block_size):
+            recomputed.extend(rows)
+            return nearest(matrix, rows, k, block_size)
+
+        with mock.patch('blog.related.nearest', recording_nearest):
+            related.build(incremental=True)
+        incremental = self.related()
+        # Posts nowhere near the changes are left alone
+        index = related.RelatedIndex.load(related.index_dir())
+        recomputed = set(BlogPage.objects.filter(pk__in=index.page_ids[recomputed]).values_list('title', flat=True))
+        self.assertFalse(recomputed & {'Roses in bloom', 'Pruning roses'})
+        self.assertIn(new.title, recomputed)
+        self.assertIn(new.title, incremental)
+        self.assertNotIn('Bond markets slump', sum(incremental.values(), []))
+
+        # The same neighbours as recomputing every post against the updated vectors
+        _, scores = related.nearest(index.matrix, np.arange(len(index.page_ids)), 2, block_size=2)
+        np.testing.assert_allclose(index.scores, scores, rtol=1e-5)
+        self.assertNotIn('fades', index.vocabulary)
+
+
+class PrerenderTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(shutil.rmtree, prerender.prerender_dir(), ignore_errors=True)
+        self.tags_page = self.index.add_child(instance=BlogTagIndexPage(title='Tags', slug='tags'))
+        self.first = self.create_post('First post', with_image=False)
+        self.first.tags.add('bonds')
+        self.first.save_revision().publish()
+        self.second = self.create_post('Second post', with_image=False)
+
+    def prerender(self, incremental=False):
+        results = list(prerender.prerender(incremental, processes=0))
+        self.assertEqual([error for _, error in results if error], [])
+        return sorted(url for url, _ in results)
+
+    def assertPrerendered(self, path, expected=True, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.has_header('X-Prerendered'), expected)
+        return b''.join(response.streaming_content).decode() if expected else response.content.decode()
+
+    def test_serves_rendered_pages(self):
+        call_command('prerender', processes=0, stdout=StringIO())
+        self.assertIn('First post', self.assertPrerendered('/blog/first-post/'))
+        self.assertIn('Second post', self.assertPrerendered('/blog/'))
+        self.assertIn('First post', self.assertPrerendered('/blog/tags/', tag='bonds'))
+        self.assertPrerendered('/blog/tags/', False, tag='stocks')
+        self.assertPrerendered('/blog/', False, utm_source='feed')
+
+        response = self.client.get('/blog/first-post/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'First post', gzip.decompress(b''.join(response.streaming_content)))
+
+        self.client.force_login(User.objects.create_superuser('admin'))
+        self.assertPrerendered('/blog/first-post/', False)
+
+    async def test_serves_rendered_pages_under_asgi(self):
+        await sync_to_async(self.prerender)()
+        response = await self.async_client.get('/blog/first-post/')
+        self.assertTrue(response.has_header('X-Prerendered'))
+
+        user = await sync_to_async(User.objects.create_superuser)('admin')
+        await sync_to_async(self.async_client.force_login)(user)
+        response = await self.async_client.get('/blog/first-post/')
+        self.assertFalse(response.has_header('X-Prerendered'))
+
+    def test_index_pages(self):
+        with mock.patch.object(BlogIndexPage, 'posts_per_page', 1):
+            self.prerender()
+        self.assertNotIn('First post', self.assertPrerendered('/blog/'))
+        cursor = keyset_paginate(BlogPage.objects.live(), None, 1)[1]
+        self.assertIn('First post', self.assertPrerendered('/blog/', cursor=cursor))
+
+    def test_publish_removes_affected_files(self):
+        self.prerender()
+        self.first.title = 'Renamed post'
+        self.first.save_revision().publish()
+
+        self.assertIn('Renamed post', self.assertPrerendered('/blog/first-post/', False))
+        self.assertPrerendered('/blog/', False)
+        self.assertPrerendered('/blog/tags/', False, tag='bonds')
+        self.assertPrerendered('/blog/second-post/')
+
+        rendered = self.prerender(incremental=True)
+        self.assertEqual(len(rendered), 3)
+        self.assertIn('/blog/first-post/', rendered)
+        self.assertIn('Renamed post', self.assertPrerendered('/blog/first-post/'))
+        self.assertEqual(self.prerender(incremental=True), [])
+
+    def test_unpublished_pages_are_removed(self):
+        self.prerender()
+        self.second.unpublish()
+        self.assertEqual(self.client.get('/blog/second-post/').status_code, 404)
+        self.prerender(incremental=True)
+        self.assertEqual(self.client.get('/blog/second-post/').status_code, 404)
+        self.assertNotIn('/blog/second-post/', prerender.load_manifest())
+
+
+class AutocompleteTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        autocomplete.state.index = None
+        self.addCleanup(setattr, autocomplete.state, 'index', None)
+
+    def complete(self, prefix):
+        response = self.client.get('/api/blog/autocomplete/', {'q': prefix})
+        self.assertEqual(response.status_code, 200)
+        return [(result['type'], result['text']) for result in response.json()['results']]
+
+    def test_titles_tags_and_categories(self):
+        post = self.create_post('Bond markets convulse', with_image=False)
+        post.tags.add('bonds')
+        post.save_revision().publish()
+
+        self.assertEqual(self.complete('bo'), [('tag', 'bonds'), ('page', 'Bond markets convulse')])
+        self.assertEqual(self.complete('MARK'), [('page', 'Bond markets convulse')])
+        self.assertEqual(self.complete('eco'), [('category', 'Economics')])
+        self.assertEqual(self.complete('x'), [])
+
+    def test_ranked_by_search_hits(self):
+        self.create_post('Bond markets', with_image=False)
+        self.create_post('Bond auctions', with_image=False)
+        QueryDailyHits.objects.create(
+            query=Query.objects.create(query_string='bond auctions'), date=timezone.now().date(), hits=10
+        )
+        self.assertEqual(self.complete('bond'), [('page', 'Bond auctions'), ('page', 'Bond markets')])
+
+    def test_publish_updates_the_index_in_place(self):
+        self.create_post('Bond markets', with_image=False)
+        self.complete('bond')
+        with mock.patch('blog.autocomplete.build_index') as build_index:
+            post = self.create_post('Bond auctions', with_image=False)
+            self.assertEqual(sorted(self.complete('bond')), [('page', 'Bond auctions'), ('page', 'Bond markets')])
+            post.unpublish()
+            self.assertEqual(self.complete('bond'), [('page', 'Bond markets')])
+        build_index.assert_not_called()
+
+    def test_lookup_time(self):
+        words = ['%s%s%s' % (a, b, c) for a in 'bcdfgklmnprst' for b in 'aeiou' for c in 'lmnrstx']
+        index = autocomplete.PrefixIndex()
+        for i in range(20000):
+            index.add(('page', i), ' '.join(words[(i * k) % len(words)] for k in (1, 7, 13, 29)))
+
+        index.warm()
+
+        # First lookups of each prefix, as after a rebuild
+        prefixes = list(dict.fromkeys(word[:n] for word in words for n in (1, 2, 3)))
+        start = time.perf_counter()
+        for prefix in prefixes:
+            index.complete(prefix)
+        self.assertLess((time.perf_counter() - start) / len(prefixes), 0.001)
+
+    def test_changes_only_forget_affected_prefixes(self):
+        index = autocomplete.PrefixIndex()
+        index.add(('page', 1), 'Bond markets')
+        index.complete('b')
+        index.complete('m')
+        index.add(('page', 2), 'Money supply')
+        self.assertEqual(set(index.memo), {'b'})
+        self.assertEqual([result['text'] for result in index.complete('m')], ['Bond markets', 'Money supply'])
+
+
+class MediaServingTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 4
+        for name in ('images/photo.fill-32x32.jpg', 'original_images/photo.jpg'):
+            os.makedirs(os.path.join(TEST_MEDIA_ROOT, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(TEST_MEDIA_ROOT, name), 'wb') as f:
+                f.write(self.content)
+        self.url = '/media/images/photo.fill-32x32.jpg'
+
+    def test_whole_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.getvalue(), self.content)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+        head = self.client.head(self.url)
+        self.assertEqual(head['Content-Length'], '1024')
+        self.assertEqual(head['ETag'], response['ETag'])
+
+    def test_versioned_urls_are_immutable(self):
+        file = mock.Mock(url=self.url)
+        file.name = 'images/photo.fill-32x32.jpg'
+        url = versioned_url(file)
+        self.assertIn('immutable', self.client.get(url)['Cache-Control'])
+
+        # Replacing the file under the same name changes its URL
+        with open(os.path.join(TEST_MEDIA_ROOT, file.name), 'wb') as f:
+            f.write(self.content[::-1])
+        os.utime(os.path.join(TEST_MEDIA_ROOT, file.name), ns=(0, 0))
+        self.assertNotEqual(versioned_url(file), url)
+        self.assertNotIn('immutable', self.client.get(url)['Cache-Control'])
+
+    def test_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.getvalue(), self.content[100:200])
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1024')
+        self.assertEqual(response['Content-Length'], '100')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-24')
+        self.assertEqual(response.getvalue(), self.content[-24:])
+        self.assertEqual(response['Content-Range'], 'bytes 1000-1023/1024')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.getvalue(), self.content[1000:])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_if_range(self):
+        etag = self.client.head(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        # The file changed since the client's copy, so it gets all of it
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.getvalue(), self.content)
+
+    def test_not_modified(self):
+        etag = self.client.head(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_is_hashed_once(self):
+        self.client.head(self.url)
+        with mock.patch('blog.media.open', create=True) as opened:
+            self.assertEqual(self.client.head(self.url).status_code, 200)
+        opened.assert_not_called()
+
+    def test_handoff_to_front_end_server(self):
+        with self.settings(MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/'):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/images/photo.fill-32x32.jpg')
+        self.assertEqual(response.content, b'')
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+        with self.settings(MEDIA_X_SENDFILE=True):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(TEST_MEDIA_ROOT, 'images/photo.fill-32x32.jpg'))
+
+    def test_sendfile_capable(self):
+        # gunicorn only uses sendfile() for file-like bodies with a fileno()
+        request = RequestFactory().get(self.url, HTTP_RANGE='bytes=10-19')
+        response = serve_media(request, 'images/photo.fill-32x32.jpg')
+        self.assertTrue(hasattr(response.file_to_stream, 'fileno'))
+        self.assertEqual(b''.join(response), self.content[10:20])
+        response.close()
+
+    def test_missing_and_outside_media_root(self):
+        self.assertEqual(self.client.get('/media/images/missing.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/images/').status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+
+class StartupTests(BlogTestCase):
+
+    def test_warm_up(self):
+        self.create_post('First post')
+        autocomplete.state.index = None
+        self.addCleanup(setattr, autocomplete.state, 'index', None)
+        # Closing the connection would end the test's transaction
+        with mock.patch('blog.warmup.connections') as connections, self.assertNoLogs('blog.warmup'):
+            timings = warm_up()
+        self.assertEqual(list(timings), ['urls', 'templates', 'sites', 'autocomplete', 'search', 'requests'])
+        connections.close_all.assert_called_once_with()
+
+        loader = engines['django'].engine.template_loaders[0]
+        self.assertIn('blog/blog_page.html', loader.get_template_cache)
+        self.assertIsNotNone(autocomplete.state.index)
+
+    def test_migrate_only_when_pending(self):
+        out = StringIO()
+        with mock.patch('blog.management.commands.migrate_if_pending.call_command') as migrate:
+            call_command('migrate_if_pending', stdout=out)
+        self.assertEqual(out.getvalue(), "No migrations to apply\n")
+        migrate.assert_not_called()
+
+
+class QueryBudgetTests(BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_post('First post')
+        query_budget.reset_query_stats()
+        self.addCleanup(query_budget.reset_query_stats)
+
+    def test_queries_counted_per_view(self):
+        counts = []
+        for page in ['1', '2']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/blog/posts/', {'page': page})
+            self.assertEqual(response['Server-Timing'].split(';desc=')[1], f'"{len(queries)} queries"')
+            counts.append(len(queries))
+
+        stats = self.client.get('/api/blog/query-stats/').json()
+        self.assertEqual(stats['blog.views.blog_posts']['requests'], 2)
+        self.assertEqual(stats['blog.views.blog_posts']['queries'], sum(counts))
+        self.assertEqual(stats['blog.views.blog_posts']['max_queries'], max(counts))
+        self.assertEqual(stats['blog.views.blog_posts']['over_budget'], 0)
+
+    def test_async_view_queries_counted(self):
+        response = self.client.post('/api/blog/create-blog/', {'title': 'Second post', 'date': '2024-01-02'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(query_budget.query_stats()['blog.views.create_blog']['queries'], 10)
+
+    @override_settings(QUERY_BUDGET=1, QUERY_BUDGET_STRICT=False)
+    def test_over_budget_logged(self):
+        with self.assertLogs('blog.query_budget', 'WARNING') as logs:
+            self.client.get('/api/blog/posts/')
+        self.assertIn('/api/blog/posts/ (blog.views.blog_posts)', logs.output[0])
+        self.assertEqual(query_budget.query_stats()['blog.views.blog_posts']['over_budget'], 1)
+
+        with override_settings(QUERY_BUDGETS={'blog.views.blog_posts': 100}), self.assertNoLogs('blog.query_budget'):
+            self.client.get('/api/blog/posts/')
+
+    @override_settings(QUERY_BUDGET=40, QUERY_BUDGETS={'blog.views.create_blogs': (50, 25)})
+    def test_batch_budget_scales_with_items(self):
+        self.assertEqual(query_budget.query_budget('blog.views.create_blogs', 4), 150)
+        self.assertEqual(query_budget.query_budget('blog.views.blog_posts', 4), 40)
+
+    @override_settings(QUERY_BUDGET=1)
+    def test_over_budget_raises_in_strict_mode(self):
+        with self.assertRaises(query_budget.QueryBudgetExceeded):
+            self.client.get('/api/blog/posts/')
+
+
+@override_settings(BLOG_RENDITION_BACKGROUND=False, BLOG_RENDITION_SPECS=['fill-160x100', 'fill-32x32'],
+                   BLOG_RESPONSIVE_FORMATS=[])
+class RenditionTests(BlogTestCase):
+
+    def test_renditions_generated_on_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = get_image_model().objects.create(title='Photo', file=get_test_image_file())
+        specs = set(image.renditions.values_list('filter_spec', flat=True))
+        self.assertEqual(specs, {'fill-160x100', 'fill-32x32'})
+
+    def test_renditions_only_scheduled_when_file_changes(self):
+        image = get_image_model().objects.create(title='Photo', file=get_test_image_file())
+        with mock.patch('blog.signals.schedule_renditions') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                image.title = 'Renamed photo'
+                image.save()
+            schedule.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                image.file = get_test_image_file(filename='other.png')
+                image.save()
+            schedule.assert_called_once_with(image.pk)
+
+    def test_warm_renditions_backfills_missing(self):
+        images = [get_image_model().objects.create(title=f'Photo {i}', file=get_test_image_file())
+                  for i in range(3)]
+        images[0].get_rendition('fill-32x32')
+        call_command('warm_renditions', processes=0, stdout=StringIO())
+        for image in images:
+            self.assertEqual(get_image_model().objects.get(pk=image.pk).renditions.count(), 2)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('warm_renditions', processes=0, stdout=StringIO())
+        self.assertEqual(len(queries), 2)
+
+
+@override_settings(BLOG_RESPONSIVE_WIDTHS=[320, 1024, 1600], BLOG_RESPONSIVE_FORMATS=['avif', 'webp'])
+class ResponsiveRenditionTests(BlogTestCase):
+
+    def test_api_serves_width_bucketed_renditions(self):
+        post = self.create_post('First post')
+        response = self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': 'main_image_renditions'})
+        # Renditions are made in the background, not while the payload is built
+        self.assertEqual(response.json()['items'][0]['main_image_renditions']['sources'], [])
+
+        generate_renditions(post.gallery_images.get().image_id)
+        response = self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': 'main_image_renditions'})
+        renditions = response.json()['items'][0]['main_image_renditions']
+
+        self.assertEqual((renditions['width'], renditions['height']), (640, 480))
+        self.assertEqual([source['type'] for source in renditions['sources']], ['image/avif', 'image/webp'])
+        for source in renditions['sources']:
+            # The original is 640px wide, so 1024 and 1600 collapse into one full-width rendition
+            self.assertEqual([(r['width'], r['height']) for r in source['renditions']], [(320, 240), (640, 480)])
+            path, version = source['renditions'][0]['url'].split('?v=')
+            self.assertTrue(path.endswith(source['type'].split('/')[1]))
+            self.assertEqual(len(version), 12)
+            self.assertIn(' 320w, ', source['srcset'])
+
+        image = post.gallery_images.get().image
+        smallest = image.get_rendition('width-320|format-webp')
+        self.assertLess(smallest.file.size, image.file.size)
+
+    def test_renditions_are_generated_once(self):
+        self.create_post('First post')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/v2/pages/', {'type': 'blog.BlogPage', 'fields': 'main_image_renditions'})
+        self.assertFalse(any('wagtailimages_rendition' in query['sql'] for query in queries))
+
+
+class StubUnsplashHandler(BaseHTTPRequestHandler):
+    """Answers like the Unsplash search API, and serves the found photo."""
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/search/photos'):
+            server.searches += 1
+            time.sleep(server.delay)
+            body = json.dumps({'results': [{'urls': {'regular': f'{server.url}/photo.jpg'}}]}).encode()
+            content_type = 'application/json'
+        else:
+            body = server.photo
+            content_type = server.photo_type
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubUnsplashMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubUnsplashHandler)
+        self.server.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.server.searches = 0
+        self.server.delay = 0
+        self.server.photo = get_test_image_file().file.getvalue()
+        self.server.photo_type = 'image/png'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def client_for_stub(self, **kwargs):
+        return UnsplashClient(api_key='key', base_url=self.server.url, **kwargs)
+
+
+class UnsplashClientTests(StubUnsplashMixin, TestCase):
+
+    def test_search_results_are_cached(self):
+        client = self.client_for_stub()
+        url = client.search('Bond  Markets')
+        self.assertEqual(url, f'{self.server.url}/photo.jpg')
+        self.assertEqual(client.search('bond markets'), url)
+        # A new client, as after a restart, still uses the stored result
+        self.assertEqual(self.client_for_stub().search('bond markets'), url)
+        self.assertEqual(self.server.searches, 1)
+        self.assertEqual(UnsplashSearch.objects.get().query, 'bond markets')
+
+    def test_expired_results_are_refetched(self):
+        client = self.client_for_stub(cache_ttl=60)
+        client.search('bond markets')
+        UnsplashSearch.objects.update(fetched_at='2000-01-01T00:00Z')
+        client.search('bond markets')
+        self.assertEqual(self.server.searches, 2)
+
+    def test_empty_results_are_refetched_sooner(self):
+        client = self.client_for_stub()
+        UnsplashSearch.objects.create(query='bond markets', url=None, fetched_at=timezone.now())
+        self.assertIsNone(client.search('bond markets'))
+        UnsplashSearch.objects.update(fetched_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(client.search('bond markets'), f'{self.server.url}/photo.jpg')
+        self.assertEqual(self.server.searches, 1)
+
+    def test_download_uses_pooled_session(self):
+        client = self.client_for_stub()
+        with client.download(client.search('bond markets')) as file:
+            self.assertEqual(file.read(), self.server.photo)
+
+
+class AsyncUnsplashClientTests(StubUnsplashMixin, TestCase):
+
+    def async_client_for_stub(self, **kwargs):
+        return AsyncUnsplashClient(api_key='key', base_url=self.server.url, **kwargs)
+
+    async def test_concurrent_searches_share_one_request(self):
+        self.server.delay = 0.2
+        client = self.async_client_for_stub()
+        start = time.monotonic()
+        urls = await asyncio.gather(*[client.search('Bond markets') for _ in range(5)],
+                                    client.search('Gardening'))
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(urls, [f'{self.server.url}/photo.jpg'] * 6)
+        self.assertEqual(self.server.searches, 2)
+        # Stored for the sync client too
+        self.assertEqual(await self.async_client_for_stub().search('bond markets'), urls[0])
+        self.assertEqual(self.server.searches, 2)
+        await client.aclose()
+
+    async def test_download_is_checked(self):
+        client = self.async_client_for_stub()
+        with await client.download(f'{self.server.url}/photo.jpg') as file:
+            self.assertEqual(file.read(), self.server.photo)
+        with self.assertRaisesMessage(InvalidImageError, '640x480'):
+            await client.download(f'{self.server.url}/photo.jpg', max_pixels=1000)
+        await client.aclose()
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, CACHES=TEST_CACHES, BLOG_RENDITION_BACKGROUND=False,
+                   BLOG_RESPONSIVE_FORMATS=[])
+class AsyncEndpointTests(StubUnsplashMixin, BlogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.settings_override = self.settings(UNSPLASH_API_URL=self.server.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_create_blog(self):
+        response = self.client.post('/api/blog/create-blog/', {
+            "date": "2025-01-03", "title": "Async post", "draft": False, "categories": [self.category.pk],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        post = BlogPage.objects.get(pk=response.json()['id'])
+        self.assertTrue(post.live)
+        self.assertEqual(post.api_payload['categories_str'], 'Economics')
+        self.assertEqual(post.image_jobs.get().pk, response.json()['image_job'])
+
+        response = self.client.post('/api/blog/create-blog/', {"title": "No date"}, content_type='application/json')
+        self.assertEqual(response.json(), {"error": "Date is required"})
+        response = self.client.post('/api/blog/create-blog/', {
+            "date": "2025-01-03", "title": "Bad reference", "references": [{"url": "https://example.com"}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Invalid reference", response.json()['error'])
+        self.assertFalse(BlogPage.objects.filter(title='Bad reference').exists())
+        response = self.client.post('/api/blog/create-blog/', 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/blog/create-blog/').status_code, 405)
+
+    def test_add_unsplash_image_and_wait(self):
+        post = self.create_post('First post', with_image=False)
+        response = self.client.post('/api/blog/add-unsplash-image/', {'id': post.pk, 'wait': True},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.json())
+        self.assertEqual(response.json()['status'], ImageJob.DONE)
+        image = post.gallery_images.get().image
+        self.assertEqual(response.json()['image'], image.pk)
+        self.assertEqual(image.title, 'First post')
+
+        response = self.client.post('/api/blog/add-unsplash-image/', {'id': 0}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(IMAGE_JOB_CONCURRENCY=1)
+    def test_wait_leaves_job_to_worker_when_busy(self):
+        post = self.create_post('First post', with_image=False)
+        ImageJob.objects.create(page=post, query=post.title, status=ImageJob.RUNNING)
+        response = self.client.post('/api/blog/add-unsplash-image/', {'id': post.pk, 'wait': True},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ImageJob.objects.get(pk=response.json()['job']).status, ImageJob.PENDING)
+        self.assertEqual(self.server.searches, 0)
+
+    def test_asgi_requests_stay_async(self):
+        # Django logs each sync middleware it has to adapt
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    @override_settings(UNSPLASH_LOOKUP_CLIENT_LIMIT=1, UNSPLASH_LOOKUP_LIMIT=2)
+    def test_wait_is_rate_limited(self):
+        post = self.create_post('First post', with_image=False)
+
+        def wait(**extra):
+            return self.client.post('/api/blog/add-unsplash-image/', {'id': post.pk, 'wait': True},
+                                    content_type='application/json', **extra)
+
+        self.assertEqual(wait().status_code, 200)
+        response = wait()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ImageJob.objects.get(pk=response.json()['job']).status, ImageJob.PENDING)
+        # Other clients share the site's limit
+        self.assertEqual(wait(HTTP_X_FORWARDED_FOR='203.0.113.7').status_code, 200)
+        self.assertEqual(wait(HTTP_X_FORWARDED_FOR='203.0.113.8').status_code, 202)
+
+    @override_settings(UNSPLASH_LOOKUP_LIMIT=1)
+    async def test_fetch_unsplash_image_within_lookup_limit(self):
+        self.assertEqual(await fetch_unsplash_image('Bond markets'), f'{self.server.url}/photo.jpg')
+        self.assertIsNone(await fetch_unsplash_image('Bond markets'))
+        self.assertEqual(self.server.searches, 1)
+
+    def test_lookups_are_not_public(self):
+        self.assertEqual(self.client.get('/api/blog/unsplash-image/', {'query': 'Bond markets'}).status_code, 404)
+        self.assertEqual(self.server.searches, 0)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class ImageDownloadTests(StubUnsplashMixin, TestCase):
+
+    def peak_download_memory(self, size):
+        # PNG readers stop at the IEND chunk, so padding keeps the image valid
+        self.server.photo = get_test_image_file().file.getvalue().ljust(size, b'\0')
+        url = f'{self.server.url}/photo.jpg'
+        with mock.patch('blog.unsplash.get_client', return_value=self.client_for_stub()):
+            tracemalloc.start()
+            image = download_image(url, 'Photo', 'photo')
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.assertEqual(image.file.size, size)
+        return peak
+
+    @override_settings(WAGTAILIMAGES_MAX_UPLOAD_SIZE=64 * 1024 * 1024)
+    def test_peak_memory_does_not_grow_with_image_size(self):
+        small = self.peak_download_memory(1024 * 1024)
+        large = self.peak_download_memory(32 * 1024 * 1024)
+        self.assertLess(large, 2 * 1024 * 1024)
+        self.assertLess(large - small, 512 * 1024)
+
+    def test_rejects_oversized_images(self):
+        self.server.photo = self.server.photo.ljust(2048, b'\0')
+        with self.assertRaisesMessage(InvalidImageError, 'limit'):
+            self.client_for_stub().download(f'{self.server.url}/photo.jpg', max_size=1024)
+
+    def test_rejects_images_with_too_many_pixels(self):
+        with self.assertRaisesMessage(InvalidImageError, '640x480'):
+            self.client_for_stub().download(f'{self.server.url}/photo.jpg', max_pixels=1000)
+
+    def test_rejects_other_content(self):
+        self.server.photo_type = 'text/html'
+        with self.assertRaisesMessage(InvalidImageError, 'text/html'):
+            self.client_for_stub().download(f'{self.server.url}/photo.jpg')
+        self.server.photo_type = 'image/png'
+        self.server.photo = b'<html></html>'
+        with self.assertRaisesMessage(InvalidImageError, 'dimensions'):
+            self.client_for_stub().download(f'{self.server.url}/photo.jpg')
+
+
+class UnsplashCoalescingTests(StubUnsplashMixin, TransactionTestCase):
+
+    def test_concurrent_identical_searches_share_one_request(self):
+        self.server.delay = 0.3
+        client = self.client_for_stub()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.search('bond markets')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(self.server.searches, 1)
+
+
+def add_keys(count):
+    return [i for i in range(count) if atomic_cache.add(f'key:{i}', threading.get_ident(), 60)]
+
+
+def increment_key(count):
+    for _ in range(count):
+        atomic_cache.increment('counter', 60)
+
+
+class AtomicCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        settings_override = self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location,
+        }})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def run_concurrently(self, function, count):
+        # Each thread opens the lock file itself, and flock() locks are held
+        # per open file, so the threads exclude each other as processes do
+        with ThreadPoolExecutor(4) as executor:
+            return list(executor.map(function, [count] * 4))
+
+    def test_only_one_caller_adds_a_key(self):
+        won = self.run_concurrently(add_keys, 100)
+        self.assertEqual(sorted(key for keys in won for key in keys), list(range(100)))
+
+    def test_no_increment_is_lost(self):
+        self.run_concurrently(increment_key, 100)
+        self.assertEqual(cache.get('counter'), 400)
+
+
+@override_settings(CACHES=TEST_CACHES, STORAGES=TEST_STORAGES, MEDIA_ROOT=TEST_MEDIA_ROOT,
+                   PRERENDER_DIR=os.path.join(TEST_MEDIA_ROOT, 'prerendered'), WAGTAILSEARCH_BACKENDS={
+                       'default': {'BACKEND': 'wagtail.search.backends.database'},
+                       'bm25': {'BACKEND': 'search.backends.bm25', 'AUTO_UPDATE': False,
+                                'INDEX_DIR': os.path.join(TEST_MEDIA_ROOT, 'search_index')},
+                   },
+                   API_LISTING_CACHE_SOFT_TTL=60, API_LISTING_CACHE_HARD_TTL=3600)
+class StaleWhileRevalidateTests(TransactionTestCase):
+    # Keep Wagtail's root pages, which come from its migrations
+    serialized_rollback = True
+
+    def setUp(self):
+        cache.clear()
+        index = Page.objects.get(depth=2).add_child(instance=BlogIndexPage(title='Blog', slug='blog'))
+        self.post = index.add_child(instance=BlogPage(
+            title='First post', slug='first-post', date='2025-01-03', intro='Intro', body='<p>Body</p>'
+        ))
+        self.post.save_revision().publish()
+
+        # Listings are computed once self.release is set
+        self.computations = 0
+        self.computing = threading.Event()
+        self.release = threading.Event()
+        lock = threading.Lock()
+        listing_view = PagesAPIViewSet.listing_view
+
+        def gated_listing_view(viewset, request):
+            with lock:
+                self.computations += 1
+            self.computing.set()
+            self.assertTrue(self.release.wait(5))
+            return listing_view(viewset, request)
+
+        self.refreshed = threading.Event()
+        refresh = stale_cache.refresh
+
+        def refresh_and_signal(*args):
+            refresh(*args)
+            self.refreshed.set()
+
+        for patcher in [mock.patch.object(PagesAPIViewSet, 'listing_view', gated_listing_view),
+                        mock.patch('blog.stale_cache.refresh', refresh_and_signal)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.clients = [Client() for _ in range(8)]
+
+    def fetch(self, client=None):
+        response = (client or Client()).get('/api/v2/pages/', {'type': 'blog.BlogPage'})
+        self.assertEqual(response.status_code, 200)
+        return [item['title'] for item in response.json()['items']]
+
+    def fetch_concurrently(self):
+        results = []
+
+        def fetch(client):
+            try:
+                results.append(self.fetch(client))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=fetch, args=(client,)) for client in self.clients]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_misses_compute_once(self):
+        # Hold the first computation until every request has asked for the lock
+        callers = set()
+        acquire_lock = stale_cache.acquire_lock
+
+        def counting_acquire_lock(*args):
+            callers.add(threading.get_ident())
+            if len(callers) == len(self.clients):
+                self.release.set()
+            return acquire_lock(*args)
+
+        with mock.patch('blog.stale_cache.acquire_lock', counting_acquire_lock):
+            threads, results = self.fetch_concurrently()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, [['First post']] * 8)
+        self.assertEqual(self.computations, 1)
+
+    def test_stale_listing_served_while_one_request_refreshes(self):
+        self.release.set()
+        self.fetch()
+        self.release.clear()
+        self.computing.clear()
+        self.post.title = 'Renamed post'
+        self.post.save_revision().publish()
+
+        # The refresh is held back, so the stale listing was served without waiting for it
+        threads, results = self.fetch_concurrently()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [['First post']] * 8)
+        self.assertTrue(self.computing.wait(5))
+
+        self.release.set()
+        self.assertTrue(self.refreshed.wait(5))
+        self.assertEqual(self.fetch(), ['Renamed post'])
+        self.assertEqual(self.computations, 2)
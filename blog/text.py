@@ -0,0 +1,20 @@
+import html
+
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+
+def text_from_html(value):
+    """
+    Plain text version of a rich text value.
+    """
+    # Space out the tags so adjacent paragraphs don't run together
+    return ' '.join(html.unescape(strip_tags((value or '').replace('<', ' <'))).split())
+
+
+def excerpt_from_html(value, length=300):
+    """
+    Plain text version of a rich text value, cut at a word boundary so it is
+    at most `length` characters long.
+    """
+    return Truncator(text_from_html(value)).chars(length, truncate='…')
@@ -0,0 +1,406 @@
+"""
+Unsplash API clients.
+
+All calls go through one pooled requests.Session with timeouts, or from
+async code, through an AsyncUnsplashClient's pooled httpx.AsyncClient (one
+per event loop, which under ASGI is one per worker). Search results are
+cached in the UnsplashSearch table for UNSPLASH_CACHE_TTL seconds, or for
+UNSPLASH_EMPTY_CACHE_TTL seconds when they found nothing, and identical
+searches running at the same time in a process share a single API call.
+Images are streamed to disk in chunks and checked against the
+WAGTAILIMAGES_MAX_UPLOAD_SIZE and WAGTAILIMAGES_MAX_IMAGE_PIXELS limits
+while they download.
+"""
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import weakref
+from concurrent.futures import Future
+from datetime import timedelta
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from dotenv import load_dotenv
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from wagtail.images import get_image_model
+
+from blog import atomic_cache
+from blog.models import UnsplashSearch
+
+load_dotenv()
+
+UNSPLASH_API_KEY = os.environ.get('UNSPLASH_API_KEY')
+UNSPLASH_API_URL = "https://api.unsplash.com"
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Any image format declares its dimensions well within this many bytes
+MAX_HEADER_SIZE = 1024 * 1024
+
+
+class InvalidImageError(ValueError):
+    """The downloaded file is not an image we are willing to store."""
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())[:255]
+
+
+def store_search(query, url):
+    # One upsert, rather than a read and a write that concurrent requests
+    # could interleave
+    UnsplashSearch.objects.bulk_create(
+        [UnsplashSearch(query=query, url=url, fetched_at=timezone.now())],
+        update_conflicts=True, unique_fields=['query'], update_fields=['url', 'fetched_at'],
+    )
+
+
+def is_fresh(cached, cache_ttl, empty_cache_ttl):
+    if cached is None:
+        return False
+    # Searches that found nothing are retried sooner, as new photos come in
+    ttl = cache_ttl if cached.url else empty_cache_ttl
+    return cached.fetched_at > timezone.now() - ttl
+
+
+class SingleFlight:
+    """
+    Runs a function once per key at a time; callers asking for a key that is
+    already in flight wait for, and share, the first caller's result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+
+class UnsplashClient:
+
+    def __init__(self, api_key=None, base_url=None, timeout=None, cache_ttl=None, pool_size=None):
+        self.api_key = api_key or UNSPLASH_API_KEY
+        self.base_url = (base_url or getattr(settings, 'UNSPLASH_API_URL', UNSPLASH_API_URL)).rstrip('/')
+        self.timeout = timeout or getattr(settings, 'UNSPLASH_TIMEOUT', (3.05, 10))
+        self.cache_ttl = timedelta(seconds=cache_ttl or getattr(settings, 'UNSPLASH_CACHE_TTL', 7 * 24 * 3600))
+        self.empty_cache_ttl = timedelta(seconds=getattr(settings, 'UNSPLASH_EMPTY_CACHE_TTL', 3600))
+        pool_size = pool_size or getattr(settings, 'UNSPLASH_POOL_SIZE', 10)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.in_flight = SingleFlight()
+
+    def search(self, query):
+        """
+        Returns the URL of the first image for the query, or None if there are
+        no results. Request errors are raised and not cached.
+        """
+        query = normalize_query(query)
+        return self.in_flight.do(query, lambda: self._cached_search(query))
+
+    def _cached_search(self, query):
+        cached = UnsplashSearch.objects.filter(query=query).first()
+        if is_fresh(cached, self.cache_ttl, self.empty_cache_ttl):
+            return cached.url
+
+        url = self._search(query)
+        store_search(query, url)
+        return url
+
+    def _search(self, query):
+        response = self.session.get(
+            f"{self.base_url}/search/photos",
+            params={"query": query, "per_page": 1},
+            headers={"Authorization": f"Client-ID {self.api_key}"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data['results']:
+            return data['results'][0]['urls']['regular']  # Return the first image's URL
+        return None
+
+    def download(self, url, max_size=None, max_pixels=None):
+        """
+        Streams the image at url into a temporary file and returns it, open
+        and rewound. Raises InvalidImageError as soon as the response turns
+        out not to be an image, or to be too big in bytes or pixels.
+        """
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            with ImageDownload(response.headers, max_size, max_pixels) as download:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    download.write(chunk)
+        return download.finish()
+
+
+class ImageDownload:
+    """
+    Writes a downloading image to a temporary file, checking it against the
+    size and pixel limits as its headers and chunks arrive.
+    """
+
+    def __init__(self, headers, max_size=None, max_pixels=None):
+        self.max_size = max_size or getattr(settings, 'WAGTAILIMAGES_MAX_UPLOAD_SIZE', 10 * 1024 * 1024)
+        self.max_pixels = max_pixels or getattr(settings, 'WAGTAILIMAGES_MAX_IMAGE_PIXELS', 128000000)
+
+        content_type = headers.get('Content-Type', '').split(';')[0].strip()
+        if not content_type.startswith('image/'):
+            raise InvalidImageError(f"Expected an image, got {content_type or 'no content type'}")
+        content_length = headers.get('Content-Length')
+        if content_length and int(content_length) > self.max_size:
+            raise InvalidImageError(f"Image is {content_length} bytes, the limit is {self.max_size}")
+
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.header = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.file.close()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise InvalidImageError(f"Image is over the {self.max_size} byte limit")
+        if self.header is not None:
+            self.header += chunk
+            if self._check_dimensions(self.header, self.max_pixels):
+                self.header = None
+        self.file.write(chunk)
+
+    def finish(self):
+        """Returns the file, rewound, once the whole image has been written."""
+        if self.header is not None:
+            self.file.close()
+            raise InvalidImageError("Could not read the image dimensions")
+        self.file.seek(0)
+        return self.file
+
+    @staticmethod
+    def _check_dimensions(header, max_pixels):
+        """
+        Returns True once the header holds enough of the file to read its
+        dimensions, and raises if they are over the limit.
+        """
+        try:
+            # Image.open only parses the header; no pixels are decoded
+            with Image.open(io.BytesIO(header)) as image:
+                width, height = image.size
+        except Image.DecompressionBombError as e:
+            raise InvalidImageError(str(e))
+        except Exception:
+            if len(header) > MAX_HEADER_SIZE:
+                raise InvalidImageError("Could not read the image dimensions")
+            return False
+
+        if width * height > max_pixels:
+            raise InvalidImageError(f"Image is {width}x{height}, over the {max_pixels} pixel limit")
+        return True
+
+
+class AsyncUnsplashClient:
+    """
+    UnsplashClient for async code. Requests wait on the network without
+    blocking the event loop, and the database work runs in Django's sync
+    thread.
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeout=None, cache_ttl=None, pool_size=None):
+        self.api_key = api_key or UNSPLASH_API_KEY
+        self.base_url = (base_url or getattr(settings, 'UNSPLASH_API_URL', UNSPLASH_API_URL)).rstrip('/')
+        connect_timeout, read_timeout = timeout or getattr(settings, 'UNSPLASH_TIMEOUT', (3.05, 10))
+        self.cache_ttl = timedelta(seconds=cache_ttl or getattr(settings, 'UNSPLASH_CACHE_TTL', 7 * 24 * 3600))
+        self.empty_cache_ttl = timedelta(seconds=getattr(settings, 'UNSPLASH_EMPTY_CACHE_TTL', 3600))
+        pool_size = pool_size or getattr(settings, 'UNSPLASH_POOL_SIZE', 10)
+
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self.in_flight = {}
+
+    async def search(self, query):
+        """
+        Returns the URL of the first image for the query, or None if there are
+        no results. Request errors are raised and not cached.
+        """
+        query = normalize_query(query)
+        future = self.in_flight.get(query)
+        if future is not None:
+            # A caller that goes away must not cancel the search for the others
+            return await asyncio.shield(future)
+
+        # The first caller searches itself rather than in a new task, which
+        # would lose track of the thread Django runs its database work in
+        future = self.in_flight[query] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            url = await self._cached_search(query)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(url)
+        finally:
+            del self.in_flight[query]
+        return url
+
+    async def _cached_search(self, query):
+        cached = await UnsplashSearch.objects.filter(query=query).afirst()
+        if is_fresh(cached, self.cache_ttl, self.empty_cache_ttl):
+            return cached.url
+
+        url = await self._search(query)
+        await sync_to_async(store_search)(query, url)
+        return url
+
+    async def _search(self, query):
+        response = await self.http.get(
+            f"{self.base_url}/search/photos",
+            params={"query": query, "per_page": 1},
+            headers={"Authorization": f"Client-ID {self.api_key}"},
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data['results']:
+            return data['results'][0]['urls']['regular']
+        return None
+
+    async def download(self, url, max_size=None, max_pixels=None):
+        """
+        Streams the image at url into a temporary file and returns it, open
+        and rewound, with the same checks as UnsplashClient.download.
+        """
+        async with self.http.stream('GET', url) as response:
+            response.raise_for_status()
+            with ImageDownload(response.headers, max_size, max_pixels) as download:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    download.write(chunk)
+        return download.finish()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = UnsplashClient()
+    return _client
+
+
+# httpx connections belong to the event loop they were opened on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncUnsplashClient()
+    return client
+
+
+def search_unsplash(query):
+    """
+    Returns the URL of the first Unsplash image for the query, or None if
+    there are no results. Request errors are raised.
+    """
+    return get_client().search(query)
+
+
+def download_image(url, title, slug):
+    """
+    Downloads the image at url into a new Wagtail image.
+    """
+    ImageModel = get_image_model()
+    with get_client().download(url) as file:
+        return ImageModel.objects.create(
+            title=f"{title}",
+            file=File(file, name=f"{slug}_unsplash.jpg")
+        )
+
+
+async def asearch_unsplash(query):
+    """
+    search_unsplash for async code.
+    """
+    return await get_async_client().search(query)
+
+
+def within_lookup_limit(key, limit):
+    """
+    Counts a lookup against `limit` lookups per UNSPLASH_LOOKUP_WINDOW
+    seconds, returning whether it is within the limit.
+    """
+    return atomic_cache.increment(key, getattr(settings, 'UNSPLASH_LOOKUP_WINDOW', 3600)) <= limit
+
+
+def lookup_allowed():
+    """
+    Whether the site may make another lookup in this window. Each one can
+    spend a request from the API key's quota.
+    """
+    return within_lookup_limit('unsplash-lookups', getattr(settings, 'UNSPLASH_LOOKUP_LIMIT', 40))
+
+
+async def fetch_unsplash_image(query):
+    """
+    asearch_unsplash within UNSPLASH_LOOKUP_LIMIT: returns None instead of
+    searching once the limit is reached.
+    """
+    if not await sync_to_async(lookup_allowed)():
+        return None
+    return await asearch_unsplash(query)
+
+
+async def adownload_image(url, title, slug):
+    """
+    download_image for async code: the download does not block the event
+    loop, and the image is saved in Django's sync thread.
+    """
+    ImageModel = get_image_model()
+    file = await get_async_client().download(url)
+    with file:
+        return await sync_to_async(ImageModel.objects.create)(
+            title=f"{title}",
+            file=File(file, name=f"{slug}_unsplash.jpg")
+        )
@@ -1,9 +1,19 @@
 from django.urls import path
 
-from .views import create_blog, documentation, add_unsplash_image
+from .views import (
+    create_blog, create_blogs, documentation, add_unsplash_image, image_job_status, blog_posts, page_cache,
+    autocomplete, tag_cloud, query_stats,
+)
 
 urlpatterns = [
     path('create-blog/', create_blog),
+    path('create-blogs/', create_blogs),
     path('add-unsplash-image/', add_unsplash_image),
+    path('image-jobs/<int:pk>/', image_job_status),
+    path('posts/', blog_posts),
+    path('page-cache/', page_cache),
+    path('query-stats/', query_stats),
+    path('autocomplete/', autocomplete),
+    path('tags/', tag_cloud),
     path('documentation/', documentation)
 ]
@@ -1,45 +1,180 @@
-import os
+import json
 import re
-
-from dotenv import load_dotenv
-
-load_dotenv()
-
-import requests
-from django.core.files.base import ContentFile
-from django.http import HttpResponse
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.db.models import F
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from wagtail.images import get_image_model
+from wagtail.models import Page
 
-from blog.models import BlogPage, BlogPageTag, BlogIndexPage, Reference
+from blog import autocomplete as autocomplete_index
+from blog.api import refresh_api_payloads
+from blog.facets import InvalidFilter, facet_counts, filter_posts, parse_filters
+from blog.jobs import arun_job, claim_job, enqueue_image_job
+from blog.models import BlogPage, BlogPageTag, BlogIndexPage, BlogCategory, BlogTagCount, ImageJob, Reference
+from blog.page_cache import page_cache_stats, page_dependency, purge
+from blog.pagination import InvalidCursor, keyset_paginate
+from blog.query_budget import query_stats as view_query_stats, scale_query_budget
+from blog.unsplash import lookup_allowed, within_lookup_limit
 
-UNSPLASH_API_KEY = os.environ.get('UNSPLASH_API_KEY')
-UNSPLASH_SEARCH_URL = "https://api.unsplash.com/search/photos"
 
+def make_slug(title, slug=None):
+    """
+    Generates a slug from the title if not provided, or sanitises the given one.
+    """
+    slug = '-'.join((slug or title).lower().split())
+
+    # Remove any non-alphanumeric characters except hyphens from slug
+    return re.sub(r'[^a-z0-9-]', '', slug)
 
-def fetch_unsplash_image(query):
+
+def clean_reference(ref):
     """
-    Fetches the first image from Unsplash based on the given query.
+    Returns an unsaved Reference for a reference in a request, or raises
+    ValidationError if the database would not take it.
     """
+    if not isinstance(ref, dict):
+        raise ValidationError("Expected a reference object")
+    values = {name: ref.get(name) for name in ('author', 'title', 'url', 'publication_date')}
+    if any(value is not None and not isinstance(value, str) for value in values.values()):
+        raise ValidationError("Reference fields must be strings")
+    reference = Reference(**values)
     try:
+        reference.clean_fields()
+    except ValidationError as e:
+        raise ValidationError(f"Invalid reference: {e.message_dict}")
+    return reference
 
-        response = requests.get(
-            UNSPLASH_SEARCH_URL,
-            params={"query": query, "per_page": 1, "client_id": UNSPLASH_API_KEY}
-        )
-        response.raise_for_status()
-        data = response.json()
-        if data['results']:
-            return data['results'][0]['urls']['regular']  # Return the first image's URL
-        return None
-    except Exception as e:
-        print(f"Error fetching image from Unsplash: {e}")
-        return None
 
+def clean_post_data(data):
+    """
+    Checks the parts of a create_blog request that are saved beside the page.
+    Returns the set of category ids and the unsaved References, or raises
+    ValidationError.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError("Expected a blog post object")
+    categories = data.get('categories') or []
+    if not isinstance(categories, list) or not all(type(pk) is int for pk in categories):
+        raise ValidationError("Categories must be a list of ids")
+    references = data.get('references') or []
+    if not isinstance(references, list):
+        raise ValidationError("References must be a list")
+    return set(categories), [clean_reference(ref) for ref in references]
 
-@api_view(['POST'])
-def create_blog(request):
+
+def reference_key(reference):
+    return reference.author, reference.title, reference.url, reference.publication_date
+
+
+def upsert_references(references):
+    """
+    Returns a dict mapping reference_key() to a saved Reference, creating the
+    missing ones with a single bulk insert.
+    """
+    keys = {reference_key(reference) for reference in references}
+    existing = {}
+    for reference in Reference.objects.filter(title__in={key[1] for key in keys}):
+        existing.setdefault(reference_key(reference), reference)
+
+    missing = [key for key in keys if key not in existing]
+    created = Reference.objects.bulk_create([
+        Reference(author=author, title=title, url=url, publication_date=publication_date)
+        for author, title, url, publication_date in missing
+    ])
+    existing.update(zip(missing, created))
+    return existing
+
+
+def async_api_view(methods):
+    """
+    api_view for async views, which DRF cannot run: the view is exempt from
+    CSRF checks, other methods get a 405, and a JSON body is parsed into
+    request.data. Views return JsonResponses.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            request.data = {}
+            if request.body:
+                try:
+                    request.data = json.loads(request.body)
+                except ValueError as e:
+                    return JsonResponse({"detail": f"JSON parse error - {e}"}, status=400)
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def lock_blog_index():
+    """
+    Returns the BlogIndexPage, locking its row until the end of the
+    transaction so that requests adding posts beneath it take turns and
+    never give two posts the same tree path.
+    """
+    return BlogIndexPage.objects.select_for_update(of=('self', 'page_ptr')).first()
+
+
+@transaction.atomic
+def save_blog(data):
+    """
+    Creates the BlogPage described by a create_blog request and queues its
+    Unsplash image job. Returns the response data and status.
+    """
+    try:
+        category_ids, references = clean_post_data(data)
+    except ValidationError as e:
+        return {"error": " ".join(e.messages)}, 400
+
+    parent_page = lock_blog_index()
+    if parent_page is None:
+        return {"error": "Parent page not found"}, 404
+
+    is_draft = bool(data.get('draft'))
+    blog = BlogPage(
+        date=data['date'],
+        intro=data.get('intro'),
+        body=data.get('body') or '',
+        slug=make_slug(data['title'], data.get('slug')),
+        title=data['title'],
+    )
+
+    parent_page.add_child(instance=blog)
+
+    reference_map = upsert_references(references)
+    blog.references.add(*{reference_map[reference_key(reference)] for reference in references})
+    # Set as draft explicitly
+    blog.live = not is_draft
+    blog.has_unpublished_changes = is_draft
+    if blog.live:
+        blog.first_published_at = blog.last_published_at = timezone.now()
+
+    # Add categories
+    blog.categories.add(*BlogCategory.objects.filter(pk__in=category_ids))
+
+    # Save the blog post
+    blog.save()
+    if blog.live:
+        refresh_api_payloads(BlogPage.objects.filter(pk=blog.pk))
+        purge(page_dependency(parent_page.pk))
+
+    # The Unsplash image is fetched in the background by run_image_worker
+    job = enqueue_image_job(blog)
+
+    return {'message': 'Successfully created', 'id': blog.id, 'image_job': job.id}, 200
+
+
+@async_api_view(['POST'])
+async def create_blog(request):
     """Receives an object and creates a draft blog post."""
     """
     Example POST request:
@@ -59,127 +194,298 @@ def create_blog(request):
             ]
         }
     """
-    from wagtail.models import Page
+    # Validate inputs
+    if not request.data.get('date'):
+        return JsonResponse({"error": "Date is required"}, status=400)
+    if not request.data.get('title'):
+        return JsonResponse({"error": "Title is required"}, status=400)
 
-    try:
-        # Extract data from the request
-        date = request.data.get('date')
-        intro = request.data.get('intro')
-        body = request.data.get('body')
-        tags = request.data.get('tags', [])
-        categories = request.data.get('categories', [])
-        title = request.data.get('title')
-        slug = request.data.get('slug')
-        is_draft = request.data.get('draft')
-        references = request.data.get('references')
-
-        # Validate inputs
-        if not date:
-            return Response({"error": "Date is required"}, status=400)
-        if not title:
-            return Response({"error": "Title is required"}, status=400)
-
-        # Generate slug if not provided
-        # Generate slug if not provided or sanitise if provided
-        if not slug:
-            slug = '-'.join(title.lower().split())
-        else:
-            slug = '-'.join(slug.lower().split())
-
-        # Remove any non-alphanumeric characters except hyphens from slug
-        slug = re.sub(r'[^a-z0-9-]', '', slug)
-
-        # Retrieve the parent page
+    data, status = await sync_to_async(save_blog)(request.data)
+    return JsonResponse(data, status=status)
+
+
+@api_view(['POST'])
+def create_blogs(request):
+    """
+    Receives a list of objects in the create_blog format and creates them all
+    beneath the BlogIndexPage in one transaction.
+
+    Responds with one result per item, in order: either {"id": ..., "slug": ...}
+    or {"error": ...}. Invalid items are skipped without affecting the others.
+    An Unsplash image job is queued for every created post. A batch holds at
+    most BLOG_CREATE_BATCH_LIMIT posts.
+    """
+    items = request.data
+    if not isinstance(items, list):
+        return Response({"error": "Expected a list of blog posts"}, status=400)
+    limit = getattr(settings, 'BLOG_CREATE_BATCH_LIMIT', 500)
+    if len(items) > limit:
+        return Response({"error": f"At most {limit} blog posts can be created at once"}, status=400)
+    scale_query_budget(request, len(items))
+
+    cleaned = []
+    for item in items:
         try:
-            parent_page = BlogIndexPage.objects.first()
-            print(BlogIndexPage.objects.all())
-        except Page.DoesNotExist:
+            cleaned.append(clean_post_data(item))
+        except ValidationError as e:
+            cleaned.append(e)
+    category_ids = {pk for item in cleaned if isinstance(item, tuple) for pk in item[0]}
+    known_categories = set(BlogCategory.objects.filter(pk__in=category_ids).values_list('pk', flat=True))
+
+    with transaction.atomic():
+        parent_page = lock_blog_index()
+        if parent_page is None:
             return Response({"error": "Parent page not found"}, status=404)
 
-        reference_set = set()
+        taken_slugs = set(parent_page.get_children().values_list('slug', flat=True))
+        last_child = parent_page.get_last_child()
+        step = Page._str2int(last_child.path[-Page.steplen:]) if last_child else 0
+
+        results = []
+        created = []
+        for item, item_data in zip(items, cleaned):
+            if isinstance(item_data, ValidationError):
+                results.append({"error": " ".join(item_data.messages)})
+                continue
+            item_categories, item_references = item_data
+            title = item.get('title')
+            if not item.get('date'):
+                results.append({"error": "Date is required"})
+                continue
+            if not title:
+                results.append({"error": "Title is required"})
+                continue
+            slug = make_slug(title, item.get('slug'))
+            if slug in taken_slugs:
+                results.append({"error": f"Slug '{slug}' is already in use"})
+                continue
+            unknown = item_categories - known_categories
+            if unknown:
+                results.append({"error": f"Unknown categories: {sorted(unknown)}"})
+                continue
+
+            # Place the page in the tree ourselves rather than through
+            # add_child, which re-reads and updates the parent per page.
+            is_draft = bool(item.get('draft'))
+            step += 1
+            blog = BlogPage(
+                date=item['date'],
+                intro=item.get('intro'),
+                body=item.get('body') or '',
+                slug=slug,
+                title=title,
+                draft_title=title,
+                live=not is_draft,
+                has_unpublished_changes=is_draft,
+                first_published_at=None if is_draft else timezone.now(),
+                last_published_at=None if is_draft else timezone.now(),
+                depth=parent_page.depth + 1,
+                path=Page._get_path(parent_page.path, parent_page.depth + 1, step),
+                locale_id=parent_page.locale_id,
+            )
+            blog._cached_parent_obj = parent_page
+            try:
+                with transaction.atomic():
+                    blog.clean_fields()
+                    blog.save(clean=False)
+            except (ValidationError, DatabaseError) as e:
+                results.append({"error": str(e)})
+                continue
+
+            taken_slugs.add(slug)
+            result = {"id": blog.id, "slug": slug}
+            results.append(result)
+            created.append((blog, (item_categories, item_references), result))
+
+        if created:
+            Page.objects.filter(pk=parent_page.pk).update(numchild=F('numchild') + len(created))
+
+            reference_map = upsert_references(
+                [reference for _, (_, references), _ in created for reference in references]
+            )
+            BlogPage.references.through.objects.bulk_create([
+                BlogPage.references.through(blogpage_id=blog.id, reference_id=saved.id)
+                for blog, (_, references), _ in created
+                for saved in {reference_map[reference_key(reference)] for reference in references}
+            ])
+            BlogPage.categories.through.objects.bulk_create([
+                BlogPage.categories.through(blogpage_id=blog.id, blogcategory_id=category_id)
+                for blog, (categories, _), _ in created
+                for category_id in categories
+            ])
+            if refresh_api_payloads(BlogPage.objects.filter(pk__in=[blog.id for blog, _, _ in created if blog.live])):
+                purge(page_dependency(parent_page.pk))
+
+            # The Unsplash images are fetched in the background by run_image_worker
+            jobs = ImageJob.objects.bulk_create([ImageJob(page=blog, query=blog.title) for blog, _, _ in created])
+            for (_, _, result), job in zip(created, jobs):
+                result["image_job"] = job.id
+
+    return Response({"results": results})
+
+
+def job_status(job):
+    return {
+        "job": job.id,
+        "page": job.page_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "error": job.error,
+        "image": job.image_id,
+    }
+
+
+@async_api_view(['POST'])
+async def add_unsplash_image(request):
+    """
+    Queues a job to get an unsplash image for an existing blog. With
+    "wait": true the image is fetched straight away instead, and the
+    finished job is returned; a failed fetch is left for the worker to retry,
+    as is the job when the client is over the Unsplash lookup limits or
+    IMAGE_JOB_CONCURRENCY jobs are already running.
+    """
+    try:
+        blog = await BlogPage.objects.aget(id=request.data.get('id'))
+    except (BlogPage.DoesNotExist, ValueError, TypeError):
+        return JsonResponse({"error": "Blog not found"}, status=404)
 
-        blog = BlogPage(
-            date=date,
-            intro=intro,
-            body=body,
-            slug=slug,
-            title=title,
-        )
+    if not request.data.get('wait'):
+        job = await sync_to_async(enqueue_image_job)(blog)
+        return JsonResponse({"job": job.id, "status": job.status}, status=202)
 
-        parent_page.add_child(instance=blog)
+    job = await sync_to_async(enqueue_image_job)(blog)
+    claimed = await unsplash_lookup_allowed(request) and await sync_to_async(claim_job)(job)
+    if not claimed:
+        # Over the lookup limits, or IMAGE_JOB_CONCURRENCY jobs are running,
+        # so leave it to the worker
+        return JsonResponse({"job": job.id, "status": job.status}, status=202)
+    job = await arun_job(claimed)
+    return JsonResponse(job_status(job), status=200 if job.status == ImageJob.DONE else 502)
 
-        for ref in references:
-            refer, created = Reference.objects.get_or_create(
-                author=ref['author'],
-                title=ref['title'],
-                url=ref['url'],
-                publication_date=ref['publication_date']
-            )
-            refer.save()
-            reference_set.add(refer)
-
-        blog.references.add(*reference_set)
-        # Set as draft explicitly
-        blog.live = not is_draft
-        blog.has_unpublished_changes = is_draft
-
-        image_url = fetch_unsplash_image(title)
-        if image_url:
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                ImageModel = get_image_model()
-                unsplash_image = ImageModel.objects.create(
-                    title=f"{title}",
-                    file=ContentFile(response.content, name=f"{slug}_unsplash.jpg")
-                )
-                blog.gallery_images.create(image=unsplash_image)
-
-        blog.save()
-        # # Add tags
-        # for tag_name in tags:
-        #     tag, created = Tag.objects.get_or_create(name=tag_name)
-        #     blog.tags.add(tag)
-
-        # Add categories
-        blog.categories.add(*categories)
-
-        # Save the blog post
-        blog.save()
-
-        return Response({'message': 'Successfully created', 'id': blog.id})
-    except Exception as e:
-        print(e)
 
+def client_address(request):
+    # Railway's proxy puts the client first in X-Forwarded-For
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+    return forwarded.split(',')[0].strip() or request.META.get('REMOTE_ADDR', '')
 
-@api_view(['POST'])
-def add_unsplash_image(request):
-    """ Gets an unsplash image for an existing blog """
 
-    print('received')
-    blog = BlogPage.objects.get(id=request.data.get('id'))
+async def unsplash_lookup_allowed(request):
+    """
+    Counts a lookup by the client against UNSPLASH_LOOKUP_CLIENT_LIMIT and
+    the site's UNSPLASH_LOOKUP_LIMIT.
+    """
+    client_limit = getattr(settings, 'UNSPLASH_LOOKUP_CLIENT_LIMIT', 10)
+    return (
+        await sync_to_async(within_lookup_limit)(f'unsplash-lookups:{client_address(request)}', client_limit)
+        and await sync_to_async(lookup_allowed)()
+    )
+
 
-    title = blog.title
-    slug = blog.slug
-    image_url = fetch_unsplash_image(title)
-    print(image_url)
+@api_view(['GET'])
+def image_job_status(request, pk):
+    """ Reports the progress of an Unsplash image job """
 
     try:
-        if image_url:
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                ImageModel = get_image_model()
-                unsplash_image = ImageModel.objects.create(
-                    title=f"{title}",
-                    file=ContentFile(response.content, name=f"{slug}_unsplash.jpg")
-                )
-                blog.gallery_images.create(image=unsplash_image)
-        blog.save()
-
-        return Response('Yay')
-
-    except Exception as e:
-        print(e)
-        return Response('You flopped')
+        job = ImageJob.objects.get(pk=pk)
+    except ImageJob.DoesNotExist:
+        return Response({"error": "Job not found"}, status=404)
+
+    return Response(job_status(job))
+
+
+def serialize_post(page, request):
+    """ The listing representation of a BlogPage, mostly from its stored api_payload """
+    return {
+        "id": page.id,
+        "title": page.title,
+        "slug": page.slug,
+        "html_url": page.get_full_url(request),
+        "first_published_at": page.first_published_at,
+        "date": page.date,
+        "intro": page.intro,
+        **(page.api_payload or page.build_api_payload()),
+    }
+
+
+@api_view(['GET'])
+def blog_posts(request):
+    """
+    Lists live blog posts, newest first. Pass the returned "next" cursor as
+    ?cursor= to get the following page; ?limit= sets the page size (max 100).
+
+    Filter with ?category=<id>, ?tag=<name> and ?author=<id>, each repeatable,
+    and ?date_from= / ?date_to= (YYYY-MM-DD). With ?facets=1 the response
+    also has the post counts per category, tag and author (see blog/facets.py).
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+    except ValueError:
+        return Response({"error": "limit must be a number"}, status=400)
+    try:
+        filters = parse_filters(request.GET)
+    except InvalidFilter as e:
+        return Response({"error": str(e)}, status=400)
+
+    live_posts = BlogPage.objects.live()
+    try:
+        posts, next_cursor = keyset_paginate(
+            filter_posts(live_posts, filters), request.GET.get('cursor'), limit
+        )
+    except InvalidCursor:
+        return Response({"error": "Invalid cursor"}, status=400)
+
+    data = {
+        "items": [serialize_post(post, request) for post in posts],
+        "next": next_cursor,
+    }
+    if request.GET.get('facets') in ('1', 'true'):
+        data["facets"] = facet_counts(live_posts, filters)
+    return Response(data)
+
+
+@api_view(['GET'])
+def autocomplete(request):
+    """
+    Suggests post titles, tags and categories starting with ?q=, most
+    searched first. ?limit= sets how many (max 20).
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 20)
+    except ValueError:
+        return Response({"error": "limit must be a number"}, status=400)
+
+    query = request.GET.get('q', '')
+    return Response({"query": query, "results": autocomplete_index.complete(query, limit)})
+
+
+@api_view(['GET'])
+def tag_cloud(request):
+    """
+    Lists the tags of live blog posts with how many posts have each, most
+    used first. ?limit= sets how many (max 200).
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 200)
+    except ValueError:
+        return Response({"error": "limit must be a number"}, status=400)
+
+    counts = BlogTagCount.objects.select_related('tag').order_by('-count', 'tag__name')[:limit]
+    return Response({
+        "items": [{"name": row.tag.name, "slug": row.tag.slug, "count": row.count} for row in counts],
+    })
+
+
+@api_view(['GET'])
+def page_cache(request):
+    """ Hit and miss counts of the full-page cache """
+    return Response(page_cache_stats())
+
+
+@api_view(['GET'])
+def query_stats(request):
+    """ Database queries and time per view, counted by the process that answers """
+    return Response(view_query_stats())
+
 
 @api_view(['GET'])
 def documentation(request):
@@ -189,6 +495,13 @@ def documentation(request):
             <h2>API Documentation</h2>
             <p>Receives an object and creates a draft blog post.</p>
             <p>Path:<br> base_url/api/blog/create-blog/</p>
+            <p>To create many posts at once, POST a list of up to 500 of these objects to base_url/api/blog/create-blogs/.
+            The response holds one result per post, with either its id or an error.</p>
+            <p>An Unsplash image is fetched for each new post in the background. Its progress can be
+            followed at base_url/api/blog/image-jobs/&lt;image_job&gt;/.</p>
+            <p>To add an image to an existing post, POST {"id": &lt;post id&gt;} to base_url/api/blog/add-unsplash-image/;
+            with "wait": true the image is fetched before the response, unless too many images were
+            fetched recently.</p>
             <p>Headers:<br>Content-Type:application/json</p>
             <h3>Example POST Request:</h3>
             <pre>
@@ -0,0 +1,100 @@
+"""
+Loads what a web process would otherwise load on its first requests.
+
+gunicorn.conf.py preloads the application and calls warm_up() in the master
+process before any worker is started, so every worker is forked with the
+URL resolvers, compiled templates, autocomplete index and search index
+already in memory. Connections are closed afterwards, as forked workers
+must not share them.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.base import BaseHandler
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.test import RequestFactory
+from django.urls import get_resolver
+from wagtail.models import Site, get_page_models
+
+from blog import autocomplete
+from search.backends import bm25
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WARMUP_URLS = ['/', '/api/blog/posts/']
+
+# Templates rendered outside of page models
+EXTRA_TEMPLATES = ['search/search.html']
+
+
+def page_templates():
+    for model in get_page_models():
+        template = getattr(model, 'template', None)
+        if isinstance(template, str):
+            yield template
+
+
+def warm_templates():
+    # The cached loader keeps each template compiled once it has been loaded
+    for name in [*page_templates(), *EXTRA_TEMPLATES]:
+        try:
+            get_template(name)
+        except TemplateDoesNotExist:
+            pass
+
+
+def warm_search_index():
+    backend = settings.WAGTAILSEARCH_BACKENDS.get('bm25')
+    if backend:
+        bm25.get_reader(backend['INDEX_DIR'])
+
+
+def warm_requests():
+    """
+    Requests WARMUP_URLS, which imports and sets up whatever the URL
+    resolvers, templates and caches above do not cover.
+    """
+    # The middleware chain the WSGI handler runs, without the test client's
+    # instrumentation
+    handler = BaseHandler()
+    handler.load_middleware()
+    factory = RequestFactory()
+    for url in getattr(settings, 'WARMUP_URLS', DEFAULT_WARMUP_URLS):
+        response = handler.get_response(factory.get(url))
+        response.close()
+        if response.status_code >= 500:
+            logger.warning("Warm-up request to %s failed with status %s", url, response.status_code)
+
+
+def warm_up():
+    """
+    Primes this process's in-memory state. Returns the seconds each step
+    took, by name.
+    """
+    steps = [
+        ('urls', lambda: get_resolver().reverse_dict),
+        ('templates', warm_templates),
+        ('sites', Site.get_site_root_paths),
+        ('autocomplete', autocomplete.state.get_index),
+        ('search', warm_search_index),
+        ('requests', warm_requests),
+    ]
+    timings = {}
+    try:
+        for name, step in steps:
+            start = time.monotonic()
+            try:
+                step()
+            except Exception:
+                # A cold process still works; it just starts slower
+                logger.exception("Warm-up step %s failed", name)
+            timings[name] = time.monotonic() - start
+    finally:
+        connections.close_all()
+        for cache in caches.all():
+            cache.close()
+    return timings
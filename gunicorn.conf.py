@@ -0,0 +1,55 @@
+"""
+gunicorn settings, read from the project root whenever gunicorn starts
+there (see railway.json).
+
+Workers are gunicorn's sync workers running mysite.wsgi. Set
+SERVER_MODE=asgi to run mysite.asgi on uvicorn workers instead, where the
+async API views wait on Unsplash without holding the worker up, at the
+cost of a thread hop for every sync view. gunicorn takes the port from
+$PORT and the number of workers from $WEB_CONCURRENCY.
+
+The application is loaded once, in the master process, which applies any
+pending migrations and warms the application up (see blog/warmup.py) before
+forking the workers from it, ready to serve. If the disk has no search
+index, a separate process builds it while the workers serve, and search uses
+the database until it is done.
+"""
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+started_at = time.monotonic()
+
+if os.getenv('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'mysite.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'mysite.wsgi:application'
+
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master once the application is loaded, before any worker
+    # starts; an exception stops gunicorn
+    from django.core.management import call_command
+    from blog.warmup import warm_up
+
+    call_command('migrate_if_pending')
+    timings = warm_up()
+    server.log.info(
+        "Warmed up in %.2fs (%s)", sum(timings.values()),
+        ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()),
+    )
+
+    # Building an index of many posts takes minutes, which the workers
+    # should not wait for
+    subprocess.Popen(
+        [sys.executable, 'manage.py', 'update_index_if_missing'], cwd=Path(__file__).resolve().parent
+    )
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s ready %.2fs after gunicorn started", worker.pid, time.monotonic() - started_at)
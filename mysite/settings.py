@@ -70,6 +70,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'blog.query_budget.QueryBudgetMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -78,7 +79,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'blog.static.StaticFilesMiddleware',
+    'blog.prerender.PrerenderedPagesMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
@@ -125,6 +127,97 @@ else:
         }
     }
 
+# Each worker keeps its connection open for DB_CONN_MAX_AGE seconds instead of
+# connecting on every request, and checks it still works before reusing it
+# after a request. Under ASGI every request runs its queries in a new thread,
+# which would leave a connection open per thread, so they are not kept there.
+DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv(
+    'DB_CONN_MAX_AGE', 0 if os.getenv('SERVER_MODE', 'wsgi') == 'asgi' else 600
+))
+DATABASES['default']['CONN_HEALTH_CHECKS'] = os.getenv('DB_CONN_HEALTH_CHECKS', '1') == '1'
+
+# Queries a request may run before it is flagged (see blog/query_budget.py), by
+# view name in QUERY_BUDGETS, else QUERY_BUDGET; and seconds of database time
+QUERY_BUDGET = 50
+QUERY_BUDGETS = {
+    # Creating a Wagtail page and its revision takes around 60 queries
+    'blog.views.create_blog': 100,
+    # (overhead, per post): each post in a batch takes around 23 queries
+    'blog.views.create_blogs': (50, 25),
+}
+QUERY_TIME_BUDGET = 0.5
+QUERY_BUDGET_STRICT = False  # raise instead of logging; the tests turn it on
+
+# Posts a create-blogs request may hold (see blog/views.py)
+BLOG_CREATE_BATCH_LIMIT = 500
+
+# Cache
+# Redis when REDIS_URL is set, so all workers share one cache; otherwise files on local disk
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        }
+    }
+
+# Seconds a rendered page is kept in the page cache (see blog/page_cache.py);
+# publishing and snippet edits purge affected pages before then
+PAGE_CACHE_TIMEOUT = 24 * 3600
+
+# Cache-Control on anonymous pages and API responses (see blog/conditional.py):
+# seconds browsers and a CDN may reuse them before revalidating
+HTTP_CACHE_MAX_AGE = 60
+HTTP_CACHE_S_MAXAGE = 300
+
+# /api/v2/pages/ listings are served from the cache for the soft TTL, then
+# served stale while one worker recomputes them, for up to the hard TTL
+# (in seconds; 0 turns the cache off)
+API_LISTING_CACHE_SOFT_TTL = 60
+API_LISTING_CACHE_HARD_TTL = 3600
+API_LISTING_CACHE_LOCK_TIMEOUT = 30
+
+# Search
+# The site search uses the BM25 backend in search/backends/bm25.py. Its index
+# is on local disk, which is empty after each deploy, so gunicorn builds it in
+# the background at start (see gunicorn.conf.py) and search uses Wagtail's
+# database backend until it is built. Publishing and unpublishing keep it up to date. Set
+# SEARCH_BACKEND = 'default' to always search with the database backend.
+WAGTAILSEARCH_BACKENDS = {
+    'default': {
+        'BACKEND': 'wagtail.search.backends.database',
+    },
+    'bm25': {
+        'BACKEND': 'search.backends.bm25',
+        'INDEX_DIR': os.path.join(BASE_DIR, 'search_index'),
+        'MODELS': ['blog.BlogPage'],
+        'AUTO_UPDATE': False,
+    },
+}
+SEARCH_BACKEND = 'bm25'
+
+# Search hits are counted in memory and written in a batch once this many are
+# waiting, or the oldest has waited this many seconds (see search/hits.py)
+SEARCH_HITS_FLUSH_SIZE = 100
+SEARCH_HITS_FLUSH_INTERVAL = 30
+
+# Ranked results of recent searches kept by each process (see search/result_cache.py);
+# publishing clears them
+SEARCH_CACHE_SIZE = 1000  # queries
+SEARCH_CACHE_TTL = 300  # seconds
+SEARCH_CACHE_MAX_RESULTS = 1000  # ids kept per query
+
+# Seconds before each process rebuilds its autocomplete index to pick up new
+# search hit counts (see blog/autocomplete.py); publishing updates it at once
+AUTOCOMPLETE_REFRESH_INTERVAL = 600
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -161,10 +254,25 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 
+# collectstatic runs once, at build time (see railway.json), and writes
+# content-hashed copies of the files with gzip and brotli versions, which
+# StaticFilesMiddleware serves with far-future caching
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
 # Media Files (uploaded from users)
 MEDIA_URL = "media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, MEDIA_URL)
 
+# Media is served by blog.media.serve_media. Set one of these to have the
+# front-end server send the files: the internal nginx location that maps to
+# MEDIA_ROOT, for X-Accel-Redirect, or MEDIA_X_SENDFILE=1 for X-Sendfile.
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX')
+MEDIA_X_SENDFILE = os.getenv('MEDIA_X_SENDFILE') == '1'
+MEDIA_CACHE_MAX_AGE = 3600  # seconds, for URLs without the file's current content hash
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -172,7 +280,50 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 WAGTAIL_SITE_NAME = "NJR"
 
+# Limits for uploaded images, also applied while downloading from Unsplash
+WAGTAILIMAGES_MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # bytes
+WAGTAILIMAGES_MAX_IMAGE_PIXELS = 40000000
+
+# Renditions generated as soon as an image is saved (see blog/renditions.py)
+BLOG_RENDITION_SPECS = ['fill-320x240', 'fill-160x100', 'fill-32x32']
+# Each web process makes them on one background thread, or with BLOG_RENDITION_WORKERS
+# set, in a pool of that many processes (each a full copy of Django)
+BLOG_RENDITION_WORKERS = int(os.getenv('BLOG_RENDITION_WORKERS', 0))
+# Width-bucketed renditions of each post's main image, served by the API for srcset
+BLOG_RESPONSIVE_WIDTHS = [320, 640, 1024, 1600]
+BLOG_RESPONSIVE_FORMATS = ['avif', 'webp']
+
+# Related posts, found by `python manage.py build_related_posts [--incremental]` (see blog/related.py)
+RELATED_POSTS_DIR = os.path.join(BASE_DIR, 'related_index')
+RELATED_POSTS_COUNT = 5
+RELATED_POSTS_BLOCK_SIZE = 512  # posts compared at a time
+RELATED_POSTS_MAX_FEATURES = 20000
+
+# Static copies of the blog pages, made by `python manage.py prerender [--incremental]`
+# and served by PrerenderedPagesMiddleware (see blog/prerender.py)
+PRERENDER_DIR = os.path.join(BASE_DIR, 'prerendered')
+PRERENDER_WORKERS = int(os.getenv('PRERENDER_WORKERS', 2))  # 0 renders them inline
+
+# Requested by each web server before its workers start (see blog/warmup.py)
+WARMUP_URLS = ['/', '/api/blog/posts/']
+
+# Unsplash client (see blog/unsplash.py)
+UNSPLASH_API_URL = os.getenv('UNSPLASH_API_URL', 'https://api.unsplash.com')
+UNSPLASH_TIMEOUT = (3.05, 10)  # connect and read timeouts, in seconds
+UNSPLASH_CACHE_TTL = 7 * 24 * 3600  # seconds a search result is reused for
+UNSPLASH_EMPTY_CACHE_TTL = 3600  # seconds a search that found nothing is reused for
+UNSPLASH_POOL_SIZE = 10
+# Unsplash lookups allowed per window (see blog/unsplash.py), like those of
+# add-unsplash-image with "wait": true
+UNSPLASH_LOOKUP_WINDOW = 3600  # seconds
+UNSPLASH_LOOKUP_CLIENT_LIMIT = 10  # from each client
+UNSPLASH_LOOKUP_LIMIT = 40  # in all
+
+# Background Unsplash image jobs, processed by `python manage.py run_image_worker`
+IMAGE_JOB_MAX_ATTEMPTS = 3
+IMAGE_JOB_RETRY_DELAY = 30  # seconds, doubled after every failed attempt
+IMAGE_JOB_CONCURRENCY = 4  # jobs running at once across all workers
+IMAGE_JOB_TIMEOUT = 300  # seconds before a running job is assumed lost and requeued
+
 if os.getenv('ENVIRONMENT') == 'LOCAL':
     DEBUG = True
-
-DEBUG=True
\ No newline at end of file
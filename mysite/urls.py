@@ -1,12 +1,11 @@
-from django.conf import settings
 from django.urls import include, path, re_path
-from django.views.static import serve
 from django.contrib import admin
 
 from wagtail.admin import urls as wagtailadmin_urls
 from wagtail import urls as wagtail_urls
 from wagtail.documents import urls as wagtaildocs_urls
 
+from blog.media import serve_media
 from search import views as search_views
 
 from mysite.api import api_router
@@ -17,7 +16,7 @@ urlpatterns = [
     path("documents/", include(wagtaildocs_urls)),
     path("search/", search_views.search, name="search"),
     path('api/blog/', include('blog.urls')),
-    re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT})
+    re_path(r'^media/(?P<path>.*)$', serve_media),
 ]
 
 urlpatterns = urlpatterns + [
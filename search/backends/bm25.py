@@ -0,0 +1,495 @@
+"""
+Search backend that ranks pages with BM25 over a local inverted index.
+
+Pages of the configured MODELS are indexed from their search_fields into
+INDEX_DIR:
+
+    CURRENT                  name of the segment in use
+    <segment>/terms.json     term -> [offset, document frequency], and totals
+    <segment>/docs.bin       page id of each document (uint32)
+    <segment>/lengths.bin    length of each document in tokens (float32)
+    <segment>/postings.bin   document numbers, grouped by term (uint32)
+    <segment>/weights.bin    boosted term frequencies, aligned with postings (float32)
+    <segment>/delta.log      pages indexed or removed since the segment was built
+
+Segments are built by `manage.py update_index --backend <name>` and memory
+mapped by every process that searches them. Publishing and unpublishing
+append to the segment's delta log (see search/signals.py), which searchers
+read incrementally and lay over the segment until the next rebuild. Until
+the first build there is no index, and nothing is logged.
+
+Only live pages are indexed, so querysets are expected to filter on live
+pages at most: other filters are applied to the results being returned, not
+to the count.
+"""
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+from html import unescape
+
+from django.apps import apps
+from django.utils.html import strip_tags
+from wagtail.models import Page
+from wagtail.search.backends.base import BaseSearchBackend, BaseSearchQueryCompiler, BaseSearchResults
+from wagtail.search.query import Boost, Fuzzy, MatchAll, Phrase, PlainText
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_terms(obj):
+    """
+    Returns the boosted frequency of each term in the object's search
+    fields, and the number of tokens in them.
+    """
+    weights = Counter()
+    length = 0
+    for field in type(obj).get_searchable_search_fields():
+        value = field.get_value(obj)
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(str(item) for item in value)
+        tokens = tokenize(unescape(strip_tags(str(value))))
+        boost = field.boost or 1
+        for token in tokens:
+            weights[token] += boost
+        length += len(tokens)
+    return dict(weights), length
+
+
+def load_array(path, typecode):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'').cast(typecode)
+        # The mapping stays valid after the file is closed
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+# Changes made before the index is first built
+PENDING_LOG = 'pending.log'
+
+
+def current_segment_name(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class Segment:
+    """
+    A memory mapped, read only index segment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'terms.json')) as f:
+            meta = json.load(f)
+        self.terms = meta['terms']
+        self.total_length = meta['total_length']
+        self.page_ids = load_array(os.path.join(path, 'docs.bin'), 'I')
+        self.lengths = load_array(os.path.join(path, 'lengths.bin'), 'f')
+        self.postings = load_array(os.path.join(path, 'postings.bin'), 'I')
+        self.weights = load_array(os.path.join(path, 'weights.bin'), 'f')
+        self.doc_numbers = {page_id: number for number, page_id in enumerate(self.page_ids)}
+
+
+class SegmentWriter:
+    """
+    Collects documents in memory and writes them out as a new segment.
+    """
+
+    def __init__(self):
+        self.page_ids = array('I')
+        self.lengths = array('f')
+        self.postings = defaultdict(lambda: (array('I'), array('f')))
+        self.total_length = 0
+
+    def add(self, page_id, weights, length):
+        number = len(self.page_ids)
+        self.page_ids.append(page_id)
+        self.lengths.append(length)
+        self.total_length += length
+        for term, weight in weights.items():
+            documents, term_weights = self.postings[term]
+            documents.append(number)
+            term_weights.append(weight)
+
+    def write(self, index_dir, delta=''):
+        """
+        Writes the segment, starting its delta log with delta, and makes it
+        the current one. Searchers switch over on their next search.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        name = f'segment-{time.time_ns()}'
+        tmp_path = os.path.join(index_dir, f'.{name}')
+        os.makedirs(tmp_path)
+
+        terms = {}
+        offset = 0
+        with open(os.path.join(tmp_path, 'postings.bin'), 'wb') as postings, \
+                open(os.path.join(tmp_path, 'weights.bin'), 'wb') as weights:
+            for term in sorted(self.postings):
+                documents, term_weights = self.postings[term]
+                documents.tofile(postings)
+                term_weights.tofile(weights)
+                terms[term] = [offset, len(documents)]
+                offset += len(documents)
+        with open(os.path.join(tmp_path, 'docs.bin'), 'wb') as f:
+            self.page_ids.tofile(f)
+        with open(os.path.join(tmp_path, 'lengths.bin'), 'wb') as f:
+            self.lengths.tofile(f)
+        with open(os.path.join(tmp_path, 'terms.json'), 'w') as f:
+            json.dump({'terms': terms, 'total_length': self.total_length}, f)
+        with open(os.path.join(tmp_path, 'delta.log'), 'w') as f:
+            f.write(delta)
+
+        os.rename(tmp_path, os.path.join(index_dir, name))
+        previous = current_segment_name(index_dir)
+        with open(os.path.join(index_dir, '.CURRENT'), 'w') as f:
+            f.write(name)
+        os.replace(os.path.join(index_dir, '.CURRENT'), os.path.join(index_dir, 'CURRENT'))
+
+        # Processes still searching the previous segment keep their mappings
+        if previous:
+            shutil.rmtree(os.path.join(index_dir, previous), ignore_errors=True)
+        return name
+
+
+class IndexReader:
+    """
+    A segment together with the changes logged since it was built.
+    """
+
+    def __init__(self, index_dir, name):
+        self.name = name
+        self.segment = Segment(os.path.join(index_dir, name))
+        self.log_path = os.path.join(index_dir, name, 'delta.log')
+        self.log_offset = 0
+        self.lock = threading.Lock()
+        # Documents indexed since the segment was built, by page id
+        self.docs = {}
+        self.delta_length = 0
+        # Segment documents that have since been reindexed or removed
+        self.removed = set()
+        self.removed_length = 0
+
+    def catch_up(self):
+        with self.lock:
+            try:
+                size = os.path.getsize(self.log_path)
+            except FileNotFoundError:
+                return
+            if size <= self.log_offset:
+                return
+            with open(self.log_path, 'rb') as f:
+                f.seek(self.log_offset)
+                data = f.read(size - self.log_offset)
+            # Only whole lines; a writer may be halfway through the last one
+            data = data[:data.rfind(b'\n') + 1]
+            self.log_offset += len(data)
+            for line in data.splitlines():
+                self.apply(json.loads(line))
+
+    def apply(self, entry):
+        page_id = entry['id']
+        number = self.segment.doc_numbers.get(page_id)
+        if number is not None and page_id not in self.removed:
+            self.removed.add(page_id)
+            self.removed_length += self.segment.lengths[number]
+        if page_id in self.docs:
+            self.delta_length -= self.docs.pop(page_id)[1]
+        if entry.get('terms') is not None:
+            self.docs[page_id] = (entry['terms'], entry['length'])
+            self.delta_length += entry['length']
+
+    def rank(self, terms, require_all=False):
+        """
+        Returns (page id, score) pairs for the documents matching the terms,
+        best first.
+        """
+        segment = self.segment
+        doc_count = len(segment.page_ids) - len(self.removed) + len(self.docs)
+        if not doc_count or not terms:
+            return []
+        average_length = (segment.total_length - self.removed_length + self.delta_length) / doc_count or 1
+
+        scores = defaultdict(float)
+        matches = Counter()
+        for term in set(terms):
+            entry = segment.terms.get(term)
+            delta_hits = [(page_id, weights[term], length)
+                          for page_id, (weights, length) in self.docs.items() if term in weights]
+            frequency = (entry[1] if entry else 0) + len(delta_hits)
+            if not frequency:
+                if require_all:
+                    return []
+                continue
+
+            idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+            if entry:
+                offset, count = entry
+                for number, weight in zip(segment.postings[offset:offset + count],
+                                          segment.weights[offset:offset + count]):
+                    page_id = segment.page_ids[number]
+                    if page_id in self.removed:
+                        continue
+                    norm = K1 * (1 - B + B * segment.lengths[number] / average_length)
+                    scores[page_id] += idf * weight * (K1 + 1) / (weight + norm)
+                    matches[page_id] += 1
+            for page_id, weight, length in delta_hits:
+                norm = K1 * (1 - B + B * length / average_length)
+                scores[page_id] += idf * weight * (K1 + 1) / (weight + norm)
+                matches[page_id] += 1
+
+        if require_all:
+            wanted = len(set(terms))
+            scores = {page_id: score for page_id, score in scores.items() if matches[page_id] == wanted}
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def get_reader(index_dir):
+    """
+    Returns the reader of the index's current segment, caught up with its
+    delta log, or None if the index has not been built.
+    """
+    for attempt in range(3):
+        name = current_segment_name(index_dir)
+        if name is None:
+            return None
+        try:
+            with _readers_lock:
+                reader = _readers.get(index_dir)
+                if reader is None or reader.name != name:
+                    reader = _readers[index_dir] = IndexReader(index_dir, name)
+            break
+        except FileNotFoundError:
+            # A rebuild replaced the segment while we were opening it
+            continue
+    reader.catch_up()
+    return reader
+
+
+class BM25Index:
+    """
+    Applies incremental changes by appending them to the current segment's
+    delta log.
+    """
+    name = 'pages'
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.index_dir = backend.index_dir
+
+    def add_model(self, model):
+        pass
+
+    def refresh(self):
+        pass
+
+    def log(self, entries):
+        name = current_segment_name(self.index_dir)
+        if name is None:
+            # Kept for the first build, which may already be reading pages,
+            # to lay over them
+            os.makedirs(self.index_dir, exist_ok=True)
+            path = os.path.join(self.index_dir, PENDING_LOG)
+        else:
+            path = os.path.join(self.index_dir, name, 'delta.log')
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add_item(self, item):
+        self.add_items(type(item), [item])
+
+    def add_items(self, model, items):
+        entries = []
+        for item in items:
+            if self.backend.is_indexable(item):
+                weights, length = document_terms(item)
+                entries.append({'id': item.pk, 'terms': weights, 'length': length})
+            else:
+                entries.append({'id': item.pk, 'terms': None})
+        if entries:
+            self.log(entries)
+
+    def delete_item(self, item):
+        self.log([{'id': item.pk, 'terms': None}])
+
+
+class BM25IndexRebuilder:
+    """
+    Used by update_index: collects every page into a new segment, then swaps
+    it in. Changes logged while it runs are carried over.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def start(self):
+        self.writer = SegmentWriter()
+        name = current_segment_name(self.index.index_dir)
+        if name:
+            self.log_path = os.path.join(self.index.index_dir, name, 'delta.log')
+            self.log_offset = os.path.getsize(self.log_path)
+        else:
+            # Changes from before the build started are replayed too, which
+            # leaves each page as it was last logged
+            self.log_path = os.path.join(self.index.index_dir, PENDING_LOG)
+            self.log_offset = 0
+        return self
+
+    def add_model(self, model):
+        pass
+
+    def add_items(self, model, items):
+        for item in items:
+            if self.index.backend.is_indexable(item):
+                self.writer.add(item.pk, *document_terms(item))
+
+    def finish(self):
+        try:
+            with open(self.log_path) as f:
+                f.seek(self.log_offset)
+                delta = f.read()
+        except FileNotFoundError:
+            delta = ''
+        self.writer.write(self.index.index_dir, delta)
+        try:
+            os.remove(os.path.join(self.index.index_dir, PENDING_LOG))
+        except FileNotFoundError:
+            pass
+
+
+class BM25SearchQueryCompiler(BaseSearchQueryCompiler):
+
+    # Filters are applied through the queryset when results are loaded, so
+    # any lookup on a FilterField is accepted
+    def _process_lookup(self, field, lookup, value):
+        return True
+
+    def _connect_filters(self, filters, connector, negated):
+        return True
+
+    def terms(self, query=None):
+        """
+        Returns the query's terms, and whether documents must match all of them.
+        """
+        query = self.query if query is None else query
+        if isinstance(query, Boost):
+            return self.terms(query.subquery)
+        if isinstance(query, PlainText):
+            return tokenize(query.query_string), query.operator == 'and'
+        if isinstance(query, Phrase):
+            return tokenize(query.query_string), True
+        if isinstance(query, Fuzzy):
+            return tokenize(query.query_string), False
+        raise NotImplementedError(f"The BM25 backend does not support {type(query).__name__} queries")
+
+
+class BM25SearchResults(BaseSearchResults):
+
+    def ranked(self):
+        # Shared by the clones made for slicing, so a paginator's count and
+        # page reuse one ranking
+        compiler = self.query_compiler
+        if not hasattr(compiler, 'ranked'):
+            if isinstance(compiler.query, MatchAll):
+                compiler.ranked = [(pk, 0) for pk in compiler.queryset.values_list('pk', flat=True)]
+            else:
+                reader = get_reader(self.backend.index_dir)
+                terms, require_all = compiler.terms()
+                compiler.ranked = reader.rank(terms, require_all) if reader else []
+        return compiler.ranked
+
+    def page_ids(self):
+        """
+        Returns the ids of the results, best first, without loading them.
+        """
+        return [pk for pk, _ in self.ranked()[self.start:self.stop]]
+
+    def _do_search(self):
+        ranked = self.ranked()[self.start:self.stop]
+        scores = dict(ranked)
+        queryset = self.query_compiler.queryset.filter(pk__in=scores)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if not self.query_compiler.order_by_relevance:
+            return list(queryset)
+
+        objects = queryset.in_bulk()
+        results = [objects[pk] for pk, _ in ranked if pk in objects]
+        if self._score_field:
+            for obj in results:
+                setattr(obj, self._score_field, scores[obj.pk])
+        return results
+
+    def _do_count(self):
+        return len(self.ranked())
+
+
+class BM25SearchBackend(BaseSearchBackend):
+    query_compiler_class = BM25SearchQueryCompiler
+    results_class = BM25SearchResults
+    rebuilder_class = BM25IndexRebuilder
+
+    def __init__(self, params):
+        super().__init__(params)
+        self.index_dir = params['INDEX_DIR']
+        self.models = tuple(apps.get_model(label) for label in params.get('MODELS', ['blog.BlogPage']))
+        self.index = BM25Index(self)
+
+    def is_indexable(self, obj):
+        return isinstance(obj, self.models) and (not isinstance(obj, Page) or obj.live)
+
+    def is_built(self):
+        return current_segment_name(self.index_dir) is not None
+
+    def get_index_for_model(self, model):
+        if issubclass(model, self.models):
+            return self.index
+        return None
+
+    def reset_index(self):
+        SegmentWriter().write(self.index_dir)
+
+    def refresh_index(self):
+        pass
+
+    def add(self, obj):
+        self.index.add_item(obj)
+
+    def add_bulk(self, model, obj_list):
+        self.index.add_items(model, obj_list)
+
+    def delete(self, obj):
+        self.index.delete_item(obj)
+
+
+SearchBackend = BM25SearchBackend
@@ -0,0 +1,119 @@
+"""
+Buffered recording of search hits.
+
+Searches are counted in memory, per process, and written to Wagtail's
+Query and QueryDailyHits tables in one batch once SEARCH_HITS_FLUSH_SIZE
+hits are waiting or the oldest has waited SEARCH_HITS_FLUSH_INTERVAL
+seconds. Whatever is left is written when the process exits.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, When
+from django.utils import timezone
+from wagtail.search.models import Query, QueryDailyHits
+from wagtail.search.utils import normalise_query_string
+
+logger = logging.getLogger(__name__)
+
+
+def write_hits(hits):
+    """
+    Adds the hits, a Counter of (query string, date) pairs, to the database
+    with one insert per table and one update.
+    """
+    query_strings = {query_string for query_string, _ in hits}
+    with transaction.atomic():
+        Query.objects.bulk_create(
+            [Query(query_string=query_string) for query_string in query_strings], ignore_conflicts=True
+        )
+        query_ids = dict(Query.objects.filter(query_string__in=query_strings).values_list('query_string', 'id'))
+
+        # Create missing rows at zero, then add to all of them, so hits
+        # written by another process at the same time are not overwritten
+        QueryDailyHits.objects.bulk_create([
+            QueryDailyHits(query_id=query_ids[query_string], date=date, hits=0)
+            for query_string, date in hits
+        ], ignore_conflicts=True)
+        rows = {
+            (query_id, date): pk
+            for pk, query_id, date in QueryDailyHits.objects.filter(
+                query_id__in=query_ids.values(), date__in={date for _, date in hits}
+            ).values_list('pk', 'query_id', 'date')
+        }
+        increments = {rows[query_ids[query_string], date]: count for (query_string, date), count in hits.items()}
+        QueryDailyHits.objects.filter(pk__in=increments).update(
+            hits=F('hits') + Case(*[When(pk=pk, then=count) for pk, count in increments.items()])
+        )
+
+
+class HitBuffer:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.pending = 0
+        self.oldest = None
+        self.timer = None
+
+    def record(self, query_string):
+        query_string = normalise_query_string(query_string)
+        if not query_string:
+            return
+        with self.lock:
+            self.hits[query_string, timezone.now().date()] += 1
+            self.pending += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            due = (
+                self.pending >= getattr(settings, 'SEARCH_HITS_FLUSH_SIZE', 100)
+                or time.monotonic() - self.oldest >= getattr(settings, 'SEARCH_HITS_FLUSH_INTERVAL', 30)
+            )
+            if not due and self.timer is None:
+                self.start_timer()
+        if due:
+            self.flush()
+
+    def start_timer(self):
+        # Flushes a quiet process's hits without waiting for another search
+        self.timer = threading.Timer(getattr(settings, 'SEARCH_HITS_FLUSH_INTERVAL', 30), self.flush_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        with self.lock:
+            hits, self.hits = self.hits, Counter()
+            self.pending = 0
+            self.oldest = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not hits:
+            return
+        try:
+            write_hits(hits)
+        except Exception:
+            logger.exception("Could not write %d search hits", sum(hits.values()))
+            # Keep them for the next flush
+            with self.lock:
+                self.hits.update(hits)
+                self.pending += sum(hits.values())
+
+
+buffer = HitBuffer()
+atexit.register(buffer.flush)
+
+
+def record_hit(query_string):
+    buffer.record(query_string)
@@ -0,0 +1,91 @@
+import random
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from wagtail.models import Page
+from wagtail.search.backends import get_search_backend
+
+from blog.models import BlogIndexPage, BlogPage
+
+SYLLABLES = ['ba', 'ko', 'ri', 'tan', 'mel', 'vo', 'sun', 'dri', 'pel', 'gar', 'nu', 'zo', 'lin', 'fex', 'ta']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares search times of the BM25 backend and Wagtail's database backend on synthetic "
+        "posts. The posts are created in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, action='append',
+                            help="Number of posts to search; repeat for several sizes. Defaults to 10000 and 100000.")
+        parser.add_argument('--queries', type=int, default=100, help="Number of searches timed per backend.")
+        parser.add_argument('--words', type=int, default=300, help="Words in each post body.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = sorted({
+            ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(20000)
+        })
+        rng.shuffle(vocabulary)
+        # Word frequencies follow Zipf's law, as in natural text
+        weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+        queries = [' '.join(rng.choices(vocabulary[:5000], k=rng.randint(1, 2))) for _ in range(options['queries'])]
+
+        for posts in sorted(options['posts'] or [10000, 100000]):
+            with transaction.atomic():
+                self.create_posts(posts, rng, vocabulary, weights, options['words'])
+                with tempfile.TemporaryDirectory() as index_dir:
+                    bm25 = get_search_backend('bm25', INDEX_DIR=index_dir)
+                    start = time.perf_counter()
+                    rebuilder = bm25.rebuilder_class(bm25.index)
+                    index = rebuilder.start()
+                    index.add_items(BlogPage, BlogPage.objects.live().iterator(chunk_size=1000))
+                    rebuilder.finish()
+                    self.stdout.write(f"{posts} posts: BM25 index built in {time.perf_counter() - start:.1f}s")
+
+                    for name, backend in [('database', get_search_backend('default')), ('bm25', bm25)]:
+                        timings = [self.time_search(backend, query) for query in queries]
+                        self.stdout.write(
+                            f"  {name:<9} mean {statistics.mean(timings) * 1000:8.2f} ms   "
+                            f"p95 {sorted(timings)[int(len(timings) * 0.95)] * 1000:8.2f} ms"
+                        )
+                transaction.set_rollback(True)
+
+    def create_posts(self, count, rng, vocabulary, weights, words):
+        parent = BlogIndexPage.objects.first()
+        if parent is None:
+            parent = Page.objects.get(depth=2).add_child(instance=BlogIndexPage(title='Blog', slug='blog'))
+        last_child = parent.get_last_child()
+        step = Page._str2int(last_child.path[-Page.steplen:]) if last_child else 0
+
+        start = time.perf_counter()
+        for i in range(count):
+            step += 1
+            title = ' '.join(rng.choices(vocabulary, weights, k=6))
+            BlogPage(
+                title=title,
+                draft_title=title,
+                slug=f'benchmark-{i}',
+                date='2025-01-03',
+                intro=' '.join(rng.choices(vocabulary, weights, k=20)),
+                body='<p>%s</p>' % ' '.join(rng.choices(vocabulary, weights, k=words)),
+                live=True,
+                depth=parent.depth + 1,
+                path=Page._get_path(parent.path, parent.depth + 1, step),
+                locale_id=parent.locale_id,
+            ).save(clean=False)
+        self.stdout.write(f"{count} posts created and indexed by the database backend "
+                          f"in {time.perf_counter() - start:.1f}s")
+
+    def time_search(self, backend, query):
+        # What the search view does: count the results and load the first page
+        start = time.perf_counter()
+        results = backend.search(query, Page.objects.live())
+        results.count()
+        list(results[:10])
+        return time.perf_counter() - start
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from wagtail.search.backends import get_search_backend
+
+from search.backends.bm25 import BM25SearchBackend
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds each BM25 search index that does not exist yet, as on a new server or "
+        "after a deploy that started from an empty disk. Built indexes are left alone."
+    )
+
+    def handle(self, *args, **options):
+        for name in getattr(settings, 'WAGTAILSEARCH_BACKENDS', {}):
+            backend = get_search_backend(name)
+            if not isinstance(backend, BM25SearchBackend):
+                continue
+            if backend.is_built():
+                self.stdout.write(f"The {name} index is already built")
+                continue
+            self.stdout.write(f"Building the {name} index")
+            call_command('update_index', backend_name=name, verbosity=options['verbosity'], stdout=self.stdout)
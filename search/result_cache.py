@@ -0,0 +1,83 @@
+"""
+Per-process cache of search results.
+
+Maps a normalized query to the ranked ids of the live pages matching it, in
+a least-recently-used dict of at most SEARCH_CACHE_SIZE queries, each kept
+for SEARCH_CACHE_TTL seconds. Every entry records the content version it
+was computed at, the page cache's "pages" dependency, which publishing,
+unpublishing and snippet edits bump in every process at once.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from wagtail.models import Page
+from wagtail.search.utils import normalise_query_string
+
+from blog.page_cache import PAGES_DEPENDENCY, current_versions
+
+
+def content_version():
+    return current_versions([PAGES_DEPENDENCY])[PAGES_DEPENDENCY]
+
+
+class SearchResultCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            page_ids, entry_version, expires = entry
+            if entry_version != version or expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return page_ids
+
+    def set(self, key, version, page_ids):
+        with self.lock:
+            self.entries[key] = (page_ids, version, time.monotonic() + getattr(settings, 'SEARCH_CACHE_TTL', 300))
+            self.entries.move_to_end(key)
+            while len(self.entries) > getattr(settings, 'SEARCH_CACHE_SIZE', 1000):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+results = SearchResultCache()
+
+
+def search_page_ids(query_string, backend='default'):
+    """
+    Returns the ids of the live pages matching the query, best first, at
+    most SEARCH_CACHE_MAX_RESULTS of them.
+    """
+    query_string = normalise_query_string(query_string)
+    key = (backend, query_string)
+    version = content_version()
+    page_ids = results.get(key, version)
+    if page_ids is None:
+        found = Page.objects.live().search(query_string, backend=backend)
+        limit = getattr(settings, 'SEARCH_CACHE_MAX_RESULTS', 1000)
+        if hasattr(found, 'page_ids'):
+            page_ids = found.page_ids()[:limit]
+        else:
+            page_ids = [page.pk for page in found[:limit]]
+        results.set(key, version, page_ids)
+    return page_ids
+
+
+def load_pages(page_ids):
+    """
+    Loads the live pages with the given ids in one query, in the given order.
+    """
+    pages = Page.objects.live().in_bulk(page_ids)
+    return [pages[pk] for pk in page_ids if pk in pages]
@@ -0,0 +1,30 @@
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from wagtail.models import Page
+from wagtail.search.backends import get_search_backends
+from wagtail.signals import page_published, page_unpublished
+
+from search.backends.bm25 import BM25SearchBackend
+
+
+# The BM25 backends are not auto-updated on every save; they follow what is live.
+
+def bm25_backends(page):
+    for backend in get_search_backends():
+        if isinstance(backend, BM25SearchBackend) and backend.get_index_for_model(type(page)):
+            yield backend
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def page_changed(sender, instance, **kwargs):
+    for backend in bm25_backends(instance):
+        transaction.on_commit(lambda backend=backend: backend.add(instance))
+
+
+@receiver(post_delete)
+def page_deleted(sender, instance, **kwargs):
+    if isinstance(instance, Page):
+        for backend in bm25_backends(instance):
+            transaction.on_commit(lambda backend=backend: backend.delete(instance))
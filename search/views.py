@@ -1,26 +1,40 @@
+from django.conf import settings
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.template.response import TemplateResponse
+from wagtail.search.backends import get_search_backend
 
-from wagtail.models import Page
-from wagtail.search.models import Query
+from search.backends.bm25 import BM25SearchBackend
+from search.hits import record_hit
+from search.result_cache import load_pages, search_page_ids
+
+
+def search_backend():
+    """
+    SEARCH_BACKEND, or Wagtail's database backend while SEARCH_BACKEND is a
+    BM25 index that has not been built yet.
+    """
+    name = getattr(settings, 'SEARCH_BACKEND', 'default')
+    backend = get_search_backend(name)
+    if isinstance(backend, BM25SearchBackend) and not backend.is_built():
+        return 'default'
+    return name
 
 
 def search(request):
     search_query = request.GET.get("query", None)
     page = request.GET.get("page", 1)
 
-    # Search
+    # Search; the ranked ids are cached per query until content changes
     if search_query:
-        search_results = Page.objects.live().search(search_query)
-        query = Query.get(search_query)
+        page_ids = search_page_ids(search_query, backend=search_backend())
 
-        # Record hit
-        query.add_hit()
+        # Record hit; written to the database in batches
+        record_hit(search_query)
     else:
-        search_results = Page.objects.none()
+        page_ids = []
 
     # Pagination
-    paginator = Paginator(search_results, 10)
+    paginator = Paginator(page_ids, 10)
     try:
         search_results = paginator.page(page)
     except PageNotAnInteger:
@@ -28,6 +42,9 @@ def search(request):
     except EmptyPage:
         search_results = paginator.page(paginator.num_pages)
 
+    # Only the pages shown are loaded
+    search_results.object_list = load_pages(search_results.object_list)
+
     return TemplateResponse(
         request,
         "search/search.html",